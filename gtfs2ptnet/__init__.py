@@ -10,51 +10,257 @@ Tool development: Nov 2022 - Feb 2023.
 
 import pandas as pd
 import geopandas as gpd
+from geopandas.io.file import infer_schema
+import fiona
 import os
 import numpy as np
-from shapely.geometry import  LineString, Point, MultiPoint
-import matplotlib.pyplot as plt
-import matplotlib
-matplotlib.interactive(False)
-import networkx as nx
-import textwrap
+from shapely.geometry import  LineString, Point, box
+from shapely.ops import unary_union
+from shapely.prepared import prep
+from heapq import heappush, heappop
+from bisect import insort
+from itertools import count
+import re
 import warnings
 warnings.filterwarnings("ignore")
-import dbf
+import rtree
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+import hashlib
+import zipfile
+import io
+import json
+import shutil
+import shapely.wkb
+import functools
+import time
+import cProfile
+import pstats
+import struct
+import datetime
 
+# Profile of the run, set by start_profile: spans (time and calls of the profiled functions) and counters of the run and of each shape ID.
+# None when profiling is off, then profiled functions only check it
+run_profile = None
+
+def profiled(func):
+    # Span named after the function, recorded in run_profile (and in the shape ID being profiled)
+    @functools.wraps(func)
+    def profiled_func(*args, **kwargs):
+        if run_profile is None:
+            return func(*args, **kwargs)
+        depth = run_profile['depth']
+        depth[func.__name__] = depth.get(func.__name__, 0) + 1
+        t = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            depth[func.__name__] -= 1
+            seconds = time.perf_counter() - t if depth[func.__name__] == 0 else 0 # nested calls of the same function are timed once
+            add_profile_span(run_profile['spans'], func.__name__, seconds)
+            if run_profile['shp'] is not None:
+                add_profile_span(run_profile['shp']['spans'], func.__name__, seconds)
+    return profiled_func
+
+def add_profile_span(spans, name, seconds, calls=1):
+    span = spans.setdefault(name, [0, 0.0])
+    span[0] += calls
+    span[1] += seconds
+
+def start_profile(profile_cprofile=0):
+    global run_profile
+    run_profile = {'t0':time.perf_counter(), 'spans':dict(), 'counters':dict(), 'depth':dict(), 'shp':None, 'shps':list(), 'cprofile':None}
+    if profile_cprofile == 1:
+        run_profile['cprofile'] = cProfile.Profile()
+        run_profile['cprofile'].enable()
+    return run_profile
+
+def stop_profile():
+    global run_profile
+    profile, run_profile = run_profile, None
+    if profile is not None and profile['cprofile'] is not None:
+        profile['cprofile'].disable()
+    return profile
+
+def profile_count(name, n=1):
+    # Add n to counter name of the run and of the shape ID being profiled
+    if run_profile is None:
+        return
+    run_profile['counters'][name] = run_profile['counters'].get(name, 0) + n
+    if run_profile['shp'] is not None:
+        run_profile['shp']['counters'][name] = run_profile['shp']['counters'].get(name, 0) + n
+
+def start_profile_shp(shp_id):
+    if run_profile is not None:
+        run_profile['shp'] = {'shp_id':shp_id, 't0':time.perf_counter(), 'spans':dict(), 'counters':dict()}
+
+def end_profile_shp():
+    # Returns the profile of the shape ID, also kept in run_profile['shps']
+    if run_profile is None or run_profile['shp'] is None:
+        return None
+    profile_shp, run_profile['shp'] = run_profile['shp'], None
+    profile_shp['seconds'] = time.perf_counter() - profile_shp.pop('t0')
+    run_profile['shps'].append(profile_shp)
+    return profile_shp
+
+def add_profile_shp(profile_shp):
+    # Profile of a shape ID matched by a parallel worker
+    if run_profile is None or profile_shp is None:
+        return
+    for name, (calls, seconds) in profile_shp['spans'].items():
+        add_profile_span(run_profile['spans'], name, seconds, calls)
+    for name, n in profile_shp['counters'].items():
+        run_profile['counters'][name] = run_profile['counters'].get(name, 0) + n
+    run_profile['shps'].append(profile_shp)
+
+def write_profile_report(profile, out_folder, profile_top=10):
+    # run_profile.json with the spans, counters and shape IDs, run_profile_spans.csv, run_profile_shps.csv and, with cProfile, run_profile.prof
+    # and run_profile_cprofile.txt. Returns the profile_top slowest shape IDs
+    os.makedirs(out_folder, exist_ok=True)
+    total_seconds = time.perf_counter() - profile['t0']
+    spans_df = pd.DataFrame([{'span':name, 'calls':calls, 'seconds':seconds} for name, (calls, seconds) in profile['spans'].items()], columns=['span','calls','seconds'])
+    spans_df = spans_df.sort_values(by='seconds', ascending=False, kind='mergesort')
+    spans_df['share'] = spans_df.seconds / total_seconds
+    spans_df.to_csv(os.path.join(out_folder, 'run_profile_spans.csv'), index=False)
+    
+    shps = sorted(profile['shps'], key=lambda shp: -shp['seconds'])
+    shps_df = pd.DataFrame([dict({'shp_id':shp['shp_id'], 'seconds':shp['seconds']}, **shp['counters'], **{f'{name}_seconds':seconds for name, (calls, seconds) in shp['spans'].items()}) for shp in shps])
+    counters = [c for c in shps_df.columns if c not in ['shp_id', 'seconds'] and not c.endswith('_seconds')]
+    shps_df[counters] = shps_df[counters].fillna(0).astype('int64')
+    shps_df.fillna(0).to_csv(os.path.join(out_folder, 'run_profile_shps.csv'), index=False)
+    slowest_shps = [{'shp_id':shp['shp_id'], 'seconds':shp['seconds'], 'top_spans':sorted([name for name in shp['spans'] if name != 'match_shp_to_network'], key=lambda name: -shp['spans'][name][1])[:3]}
+                    for shp in shps[:profile_top]]
+    
+    with open(os.path.join(out_folder, 'run_profile.json'), 'w') as report_file:
+        json.dump({'total_seconds':total_seconds, 'spans':spans_df.to_dict(orient='records'), 'counters':profile['counters'], 'slowest_shps':slowest_shps,
+                   'shps':[{'shp_id':shp['shp_id'], 'seconds':shp['seconds'], 'counters':shp['counters'], 'spans':shp['spans']} for shp in profile['shps']]}, report_file, indent=1, default=json_number)
+    if profile['cprofile'] is not None:
+        profile['cprofile'].dump_stats(os.path.join(out_folder, 'run_profile.prof'))
+        with open(os.path.join(out_folder, 'run_profile_cprofile.txt'), 'w') as stats_file:
+            pstats.Stats(profile['cprofile'], stream=stats_file).sort_stats('cumulative').print_stats(50)
+    return slowest_shps
+
+def read_shp(shp_path, crs, mask=None, rows=None):
+    # Shapefile projected to crs (or set to crs if it has none). Only the features intersecting mask (geometry in crs) and in rows (slice) are read
+    if mask is not None:
+        if mask.is_empty:
+            mask, rows = None, 0
+        elif gpd.read_file(shp_path, rows=0).crs != None:
+            mask = gpd.GeoSeries([mask], crs=crs) # projected to the crs of the shapefile by read_file
+    gdf = gpd.read_file(shp_path, mask=mask, rows=rows)
+    if gdf.crs == None:
+        gdf.crs = crs
+    else:
+        gdf = gdf.to_crs(crs)
+    return gdf
+
+@profiled
 def read_network_shp(net_folder, nodes_file, links_file, crs):
     print('Reading Network Nodes...')
-    nodes_df = gpd.read_file(os.path.join(net_folder, nodes_file))
-    if nodes_df.crs == None:
-        nodes_df.crs = crs
-    else:
-        nodes_df = nodes_df.to_crs(crs)
+    nodes_df = read_shp(os.path.join(net_folder, nodes_file), crs)
     print('Reading Network Links...')
-    links_df = gpd.read_file(os.path.join(net_folder, links_file))
-    if links_df.crs == None:
-        links_df.crs = crs
-    else:
-        links_df = links_df.to_crs(crs)
+    links_df = read_shp(os.path.join(net_folder, links_file), crs)
     return nodes_df, links_df
 
-def write_network_csv_shp(scen_dir, nodes_df, links_df, nodes_file, links_file):
+@profiled
+def read_network_cells(net_folder, nodes_file, links_file, crs, cells_area):
+    # Links intersecting cells_area (see select_service_area_cells) and nodes within it or within the bounds of the links that leave it,
+    # so that the end nodes of the links read are read as well
+    print('Reading Network Links of the service area...')
+    links_df = read_shp(os.path.join(net_folder, links_file), crs, mask=cells_area)
+    cells_area_prep = prep(cells_area)
+    links_out = [box(*g.bounds) for g in links_df.geometry if g is not None and not g.is_empty and not cells_area_prep.contains(g)]
+    print('Reading Network Nodes of the service area...')
+    nodes_df = read_shp(os.path.join(net_folder, nodes_file), crs, mask=unary_union([cells_area] + links_out) if len(links_out) != 0 else cells_area)
+    return nodes_df, links_df
+
+def read_shp_fields(shp_path, fields):
+    # Attributes in fields of all the features of a shapefile, without the geometries and the other attributes
+    with fiona.open(shp_path) as features:
+        other_fields = [c for c in features.schema['properties'] if c not in fields]
+    with fiona.open(shp_path, ignore_fields=other_fields, ignore_geometry=True) as features:
+        return pd.DataFrame([[record['properties'][c] for c in fields] for record in features], columns=fields)
+
+@profiled
+def read_network_keys(net_folder, nodes_file, links_file):
+    # Node IDs and link keys (see ab_keys) of the whole base network, for a network read by cells
+    nodes_N = read_shp_fields(os.path.join(net_folder, nodes_file), ['N']).N
+    links_AB = read_shp_fields(os.path.join(net_folder, links_file), ['A','B'])
+    return {'N':np.asarray(nodes_N, dtype='int64'), 'AB':ab_keys(links_AB.A, links_AB.B)}
+
+def read_shp_chunks(shp_path, crs, chunk_size):
+    # Shapefile read by chunks of chunk_size features (at least one chunk, maybe empty), so that it is not held in memory at once
+    start = 0
+    while True:
+        chunk = read_shp(shp_path, crs, rows=slice(start, start + chunk_size))
+        if chunk.shape[0] != 0 or start == 0:
+            yield chunk
+        if chunk.shape[0] < chunk_size:
+            return
+        start += chunk_size
+
+def create_base_network(base_nodes_df, base_links_df, crs, shp_files=None, base_keys=None):
+    # Base network written with the transit-only layer: nodes and links read, node IDs ('N') and link keys ('AB') of the whole base network
+    # and, if only part of it was read (read_network_cells), the nodes and links shapefiles streamed to the outputs
+    if base_keys is None:
+        base_keys = {'N':base_nodes_df.N.to_numpy(), 'AB':ab_keys(base_links_df.A, base_links_df.B)}
+    return {'nodes':base_nodes_df, 'links':base_links_df, 'N':base_keys['N'], 'AB':base_keys['AB'], 'shp_files':shp_files, 'crs':crs}
+
+@profiled
+def write_network_csv_shp(scen_dir, base_network, transit_only_nodes_df, transit_only_links_df, nodes_file, links_file, chunk_size=50000):
     print('Writing Network...')
     net_folder = os.path.join(scen_dir, 'network')
-    # write shp files
-    nodes_df.to_file(os.path.join(net_folder, f"{nodes_file.replace('.shp','_wTransit.shp')}"))
-    links_df.to_file(os.path.join(net_folder, f"{links_file.replace('.shp','_wTransit.shp')}"))
-    # prepare dataframes for csv (without geometry attribute)
-    nodes_cols = [c for c in nodes_df.columns if c != 'geometry']
-    nodes_df = nodes_df[nodes_cols].copy()
-    links_cols = [c for c in links_df.columns if c != 'geometry']
-    links_df = links_df[links_cols].copy()
-    # write csv files
-    pd.DataFrame(nodes_df).to_csv(os.path.join(net_folder, f"{nodes_file.replace('.shp','_wTransit.csv')}"), index=False)
-    pd.DataFrame(links_df).to_csv(os.path.join(net_folder, f"{links_file.replace('.shp','_wTransit.csv')}"), index=False)
-    # write txt with rename text for CUBE's NODEI and LINKI
+    new_nodes_df, new_links_df = new_transit_only_nodes_links(base_network, transit_only_nodes_df, transit_only_links_df)
+    # base network held in memory, or streamed from the shapefiles by chunks if only part of it was read
+    if base_network['shp_files'] is None:
+        nodes_chunks, links_chunks = iter([base_network['nodes']]), iter([base_network['links']])
+    else:
+        nodes_chunks, links_chunks = (read_shp_chunks(shp_file, base_network['crs'], chunk_size) for shp_file in base_network['shp_files'])
+    # write shp files (one after the other) and csv files, then txt with rename text for CUBE's NODEI and LINKI
+    nodes_cols = write_network_layer(nodes_chunks, new_nodes_df, update_nodes_with_transit_only, os.path.join(net_folder, f"{nodes_file.replace('.shp','_wTransit.shp')}"),
+                                     os.path.join(net_folder, f"{nodes_file.replace('.shp','_wTransit.csv')}"))
+    links_cols = write_network_layer(links_chunks, new_links_df, update_links_with_transit_only, os.path.join(net_folder, f"{links_file.replace('.shp','_wTransit.shp')}"),
+                                     os.path.join(net_folder, f"{links_file.replace('.shp','_wTransit.csv')}"))
     write_net_attributes_renaming_file(nodes_cols, os.path.join(net_folder,'nodes_rename.txt'), os.path.join(net_folder,f"{nodes_file.replace('.shp','_wTransit.dbf')}"), 'NODE')
     write_net_attributes_renaming_file(links_cols, os.path.join(net_folder,'links_rename.txt'), os.path.join(net_folder, f"{links_file.replace('.shp','_wTransit.dbf')}"), 'LINK')
-    
+
+def write_network_layer(base_chunks, new_df, update_layer, shp_file, csv_file):
+    # Chunks of a base layer written to shp_file and csv_file (without geometry attribute), with the transit-only rows new_df appended by
+    # update_layer to the last chunk. All the chunks take the schema and types of the first chunk with new_df, so the files are the same as
+    # the ones of the whole layer. The csv file is written while the next chunk is read. Returns the columns of the csv file
+    chunk = next(base_chunks)
+    layer_df = update_layer(chunk, new_df)
+    schema, layer_dtypes = infer_schema(layer_df), layer_df.dtypes
+    layer_cols = [c for c in layer_df.columns if c != 'geometry']
+    csv_futures = list()
+    with ThreadPoolExecutor(max_workers=1) as csv_executor:
+        for chunk_pos in count():
+            next_chunk = next(base_chunks, None)
+            if chunk_pos != 0 or next_chunk is not None:
+                layer_df = update_layer(chunk, new_df if next_chunk is None else new_df.iloc[:0] if new_df is not None else None)
+                layer_df = layer_df.astype({c:t for c, t in layer_dtypes.items() if layer_df[c].dtype != t}, errors='ignore')
+            mode = 'w' if chunk_pos == 0 else 'a'
+            layer_df.to_file(shp_file, schema=schema, mode=mode)
+            csv_futures.append(csv_executor.submit(write_csv, pd.DataFrame(layer_df[layer_cols]), csv_file, mode))
+            if next_chunk is None:
+                break
+            chunk = next_chunk
+    for future in csv_futures:
+        future.result()
+    return layer_cols
+
+@profiled
+def write_outputs(writers, max_workers=4):
+    # Run the writers [(function, args)] in threads. Most of the time is spent in file I/O, GDAL and pandas, which release the GIL
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(writer, *args) for writer, args in writers]
+    for future in futures:
+        future.result() # raise the errors of the writers
+
+def write_csv(df, csv_file, mode='w'):
+    # mode 'a' appends the rows without header
+    df.to_csv(csv_file, index=False, header=(mode == 'w'), mode=mode)
+
+@profiled
 def net_cleaning(nodes_df, links_df, nodes_ranges_to_avoid, factype_to_avoid):
     nodes_df, links_df = nodes_df.copy(), links_df.copy()
     for r in nodes_ranges_to_avoid:
@@ -62,32 +268,367 @@ def net_cleaning(nodes_df, links_df, nodes_ranges_to_avoid, factype_to_avoid):
         links_df.drop(links_df[(links_df.A >= r[0]) & (links_df.B <= r[1])].index, inplace=True)
     for f in factype_to_avoid:
         links_df.drop(links_df[links_df.FACTYPE == f].index, inplace=True)
-    return nodes_df, links_df
+    links_sindex = create_links_sindex(links_df)
+    return nodes_df, links_df, links_sindex
+
+def create_links_sindex(links_df, links_bounds=None):
+    # R-tree over the links bounds, built once per run. Transit-only links are inserted as they are created (ID = n_links + position in store).
+    # links_bounds (minx, miny, maxx, maxy per link, NaN for empty geometries) is kept to save the index with the network snapshot
+    if links_bounds is None:
+        links_bounds = np.array([g.bounds if g is not None and not g.is_empty else (np.nan,)*4 for g in links_df.geometry], dtype=float).reshape(-1, 4)
+    links_stream = [(i, tuple(b), None) for i, b in enumerate(links_bounds) if not np.isnan(b[0])]
+    links_sindex = rtree.index.Index(iter(links_stream)) if len(links_stream) != 0 else rtree.index.Index()
+    return {'index':links_sindex, 'n_links':links_df.shape[0], 'bounds':links_bounds}
+
+def hash_network_file(net_file_path, cache_dir=None, block_size=1<<20):
+    # Digest of a network shapefile component read by blocks. With cache_dir, the digest is kept in file_hashes.json with the size and
+    # modification time of the file, as hash_gtfs_file, and the file is only read again when they change
+    net_file_path = os.path.abspath(net_file_path)
+    net_file_stat = os.stat(net_file_path)
+    file_stamp = [net_file_stat.st_size, net_file_stat.st_mtime_ns]
+    file_hashes = read_file_hashes(cache_dir) if cache_dir is not None else dict()
+    if net_file_path in file_hashes and file_hashes[net_file_path]['stamp'] == file_stamp:
+        return bytes.fromhex(file_hashes[net_file_path]['md5'])
+    file_hash = hashlib.md5()
+    with open(net_file_path, 'rb') as net_file:
+        for block in iter(lambda: net_file.read(block_size), b''):
+            file_hash.update(block)
+    if cache_dir is not None:
+        file_hashes[net_file_path] = {'stamp':file_stamp, 'md5':file_hash.hexdigest()}
+        write_file_hashes(cache_dir, file_hashes)
+    return file_hash.digest()
+
+@profiled
+def read_clean_network(net_folder, nodes_file, links_file, crs, nodes_ranges_to_avoid, factype_to_avoid, cache_dir=None, service_area=None, cell_size=10560):
+    # read_network_shp and net_cleaning. Returns the base network (create_base_network), the cleaned nodes and links and the links spatial index.
+    # If service_area is given, only the nodes and links of the grid cells intersecting it are read (read_network_cells) and the base network
+    # outputs are streamed from the shapefiles. If cache_dir is given, the projected network read and the positions of the cleaned nodes and
+    # links are kept in a snapshot that is reused while the shapefiles, crs, nodes_ranges_to_avoid, factype_to_avoid (and the cells) do not change
+    shp_files = [os.path.join(net_folder, nodes_file), os.path.join(net_folder, links_file)]
+    if cache_dir is not None or service_area is not None:
+        net_files = list()
+        for shp_file in [nodes_file, links_file]:
+            shp_name = os.path.splitext(shp_file)[0]
+            for f in sorted(os.listdir(net_folder)):
+                if os.path.splitext(f)[0] == shp_name:
+                    net_files += [f, hash_network_file(os.path.join(net_folder, f), cache_dir)]
+        network_key = hash_cache_key(net_files + [str(crs), str(nodes_ranges_to_avoid), str(factype_to_avoid)])
+        cache_key = network_key
+    if service_area is not None:
+        cells, cells_area = select_service_area_cells(service_area, cell_size)
+        cache_key = hash_cache_key([network_key, str(cell_size), repr(cells)])
+    
+    net_arrays = None
+    if cache_dir is not None:
+        cache_folder = os.path.join(cache_dir, f'network_{cache_key}')
+        if os.path.exists(os.path.join(cache_folder, 'tables.json')):
+            print('Reading Network from cache...')
+            net_tables, net_arrays = read_tables_cache(cache_folder)
+            base_nodes_df, base_links_df = net_tables['nodes'], net_tables['links']
+            nodes_df, links_df = base_nodes_df.iloc[net_arrays['nodes_pos']].copy(), base_links_df.iloc[net_arrays['links_pos']].copy()
+            links_sindex = create_links_sindex(links_df, net_arrays['links_bounds'])
+    if net_arrays is None:
+        if service_area is None:
+            base_nodes_df, base_links_df = read_network_shp(net_folder, nodes_file, links_file, crs)
+            net_arrays = dict()
+        else:
+            base_nodes_df, base_links_df = read_network_cells(net_folder, nodes_file, links_file, crs, cells_area)
+            net_arrays = read_network_keys(net_folder, nodes_file, links_file)
+        nodes_df, links_df, links_sindex = net_cleaning(base_nodes_df, base_links_df, nodes_ranges_to_avoid, factype_to_avoid)
+        net_arrays.update({'nodes_pos':base_nodes_df.index.get_indexer(nodes_df.index), 'links_pos':base_links_df.index.get_indexer(links_df.index), 'links_bounds':links_sindex['bounds']})
+        if cache_dir is not None:
+            write_tables_cache(cache_folder, {'nodes':base_nodes_df, 'links':base_links_df}, net_arrays)
+            print('\tNetwork snapshot saved.')
+    
+    if service_area is None:
+        links_sindex['network_key'] = create_network_key(nodes_df, links_df, links_sindex['bounds'])
+        return create_base_network(base_nodes_df, base_links_df, crs), nodes_df, links_df, links_sindex
+    # the network key does not change with the service area
+    links_sindex['network_key'] = network_key
+    print(f"\tService area: {len(cells)} network cells, with {base_nodes_df.shape[0]} of {net_arrays['N'].shape[0]} nodes and {base_links_df.shape[0]} of {net_arrays['AB'].shape[0]} links read for matching.")
+    return create_base_network(base_nodes_df, base_links_df, crs, shp_files, net_arrays), nodes_df, links_df, links_sindex
+
+@profiled
+def create_service_area(gtfs_shape_index, modes_gtfs, bffr):
+    # Union of the buffers of the shapes processed (modes in modes_gtfs): the part of the network used to match them
+    shp_buffers = [shp_id_index['line'].buffer(bffr, cap_style=3) for shp_id_index in gtfs_shape_index.values() if shp_id_index['route_mode'] in modes_gtfs and shp_id_index['line'] is not None]
+    return unary_union(shp_buffers) if len(shp_buffers) != 0 else Point().buffer(0)
+
+@profiled
+def select_service_area_cells(service_area, cell_size):
+    # Square cells of cell_size, on a grid aligned with the origin of crs, that intersect service_area. Returns the cells (column, row)
+    # and their union, the area of the network read for matching
+    if service_area.is_empty:
+        return list(), Point().buffer(0)
+    minx, miny, maxx, maxy = service_area.bounds
+    service_area_prep = prep(service_area)
+    cells = [(i, j) for i in range(int(np.floor(minx / cell_size)), int(np.floor(maxx / cell_size)) + 1) for j in range(int(np.floor(miny / cell_size)), int(np.floor(maxy / cell_size)) + 1)
+             if service_area_prep.intersects(box(i * cell_size, j * cell_size, (i + 1) * cell_size, (j + 1) * cell_size))]
+    return cells, unary_union([box(i * cell_size, j * cell_size, (i + 1) * cell_size, (j + 1) * cell_size) for i, j in cells])
 
-def read_gtfs(gtfs_folder, crs=None):
+def test_links_predicate(shp_buffer, predicate):
+    if predicate not in ['within', 'intersects']:
+        raise Exception(f"Predicate {predicate} not acceptable. Use 'within' or 'intersects'.")
+    shp_buffer_prep = prep(shp_buffer)
+    return shp_buffer_prep.contains if predicate == 'within' else shp_buffer_prep.intersects
+
+def query_links_sindex(links_sindex, links_geoms, shp_buffer, predicate):
+    # Positions of the base links that are 'within' or 'intersects' the shape buffer, and transit-only links candidates (bounds only)
+    predicate_test = test_links_predicate(shp_buffer, predicate)
+    base_pos, transit_only_pos = list(), list()
+    for i in sorted(links_sindex['index'].intersection(shp_buffer.bounds)):
+        if i < links_sindex['n_links']:
+            base_pos.append(i)
+        else:
+            transit_only_pos.append(i - links_sindex['n_links'])
+    base_pos = [i for i in base_pos if predicate_test(links_geoms[i])]
+    return base_pos, transit_only_pos
+
+gtfs_file_names = ['stops.txt', 'shapes.txt', 'trips.txt', 'routes.txt', 'stop_times.txt', 'calendar.txt']
+stop_times_cols = ['trip_id', 'arrival_time', 'stop_id', 'stop_sequence'] # only columns of 'stop_times.txt' used
+gtfs_id_dtypes = {'trip_id':str, 'stop_id':str} # IDs joining the files, read as text so their type does not depend on the rows read
+
+@profiled
+def read_gtfs(gtfs_path, crs=None, cache_dir=None, day_type=None, modes_gtfs=None, chunksize=1000000):
+    # gtfs_path is the folder with the GTFS files or the GTFS .zip file.
+    # If cache_dir is given, the normalized and projected tables are reused while the GTFS files, crs, day_type and modes_gtfs do not change.
+    # 'stop_times.txt' is read by chunks and only keeps the stop times of the trips needed (see select_gtfs_trips), arrival times in seconds
     print('Reading GTFS...')
-    gtfs_stops_df = pd.read_csv(os.path.join(gtfs_folder, 'stops.txt'))
+    gtfs_files = read_gtfs_files(gtfs_path, [f for f in gtfs_file_names if f != 'stop_times.txt'])
+    if cache_dir is not None:
+        cache_key = hash_cache_key([gtfs_files[f] if f != 'stop_times.txt' else hash_gtfs_file(gtfs_path, f, cache_dir) for f in gtfs_file_names] + [str(crs), str(day_type), str(modes_gtfs)])
+        cache_folder = os.path.join(cache_dir, f'gtfs_{cache_key}')
+        if os.path.exists(os.path.join(cache_folder, 'tables.json')):
+            print('\tGTFS read from cache.')
+            gtfs_tables, _ = read_tables_cache(cache_folder)
+            return tuple(gtfs_tables[f] for f in gtfs_file_names)
+    
+    gtfs_stops_df = pd.read_csv(io.BytesIO(gtfs_files['stops.txt']), dtype=gtfs_id_dtypes)
     gtfs_stops_df = gpd.GeoDataFrame(gtfs_stops_df, geometry=gpd.points_from_xy(gtfs_stops_df.stop_lon, gtfs_stops_df.stop_lat), crs="EPSG:4326").to_crs(crs)
     gtfs_stops_df = change_id_cols_type(gtfs_stops_df)
     
-    gtfs_shapes_df = pd.read_csv(os.path.join(gtfs_folder, 'shapes.txt'))
+    gtfs_shapes_df = pd.read_csv(io.BytesIO(gtfs_files['shapes.txt']))
     gtfs_shapes_df = gpd.GeoDataFrame(gtfs_shapes_df, geometry=gpd.points_from_xy(gtfs_shapes_df.shape_pt_lon, gtfs_shapes_df.shape_pt_lat), crs="EPSG:4326").to_crs(crs)
     gtfs_shapes_df = change_id_cols_type(gtfs_shapes_df)
     
-    gtfs_trips_df = pd.read_csv(os.path.join(gtfs_folder, 'trips.txt'))
+    gtfs_trips_df = pd.read_csv(io.BytesIO(gtfs_files['trips.txt']), dtype=gtfs_id_dtypes)
     gtfs_trips_df = change_id_cols_type(gtfs_trips_df)
     
-    gtfs_routes_df = pd.read_csv(os.path.join(gtfs_folder, 'routes.txt'))
+    gtfs_routes_df = pd.read_csv(io.BytesIO(gtfs_files['routes.txt']))
     gtfs_routes_df = change_id_cols_type(gtfs_routes_df)
     
-    gtfs_stop_times_df = pd.read_csv(os.path.join(gtfs_folder, 'stop_times.txt'))
-    gtfs_stop_times_df['arrival_time'] = pd.to_datetime('2022-10-03', format='%Y-%m-%d') + pd.to_timedelta(gtfs_stop_times_df.arrival_time.str.strip())
-    gtfs_stop_times_df = change_id_cols_type(gtfs_stop_times_df)
-    
-    gtfs_calendar_df = pd.read_csv(os.path.join(gtfs_folder, 'calendar.txt'))
+    gtfs_calendar_df = pd.read_csv(io.BytesIO(gtfs_files['calendar.txt']))
     gtfs_calendar_df = change_id_cols_type(gtfs_calendar_df)
+    
+    trip_ids = select_gtfs_trips(gtfs_shapes_df, gtfs_trips_df, gtfs_routes_df, gtfs_calendar_df, day_type, modes_gtfs)
+    gtfs_stop_times_df = read_gtfs_stop_times(gtfs_path, trip_ids, chunksize)
+    
+    if cache_dir is not None:
+        write_tables_cache(cache_folder, dict(zip(gtfs_file_names, [gtfs_stops_df, gtfs_shapes_df, gtfs_trips_df, gtfs_routes_df, gtfs_stop_times_df, gtfs_calendar_df])))
+        print('\tGTFS cache saved.')
     return gtfs_stops_df, gtfs_shapes_df, gtfs_trips_df, gtfs_routes_df, gtfs_stop_times_df, gtfs_calendar_df
 
+def open_gtfs_file(gtfs_path, f):
+    # Binary stream of a GTFS file, from the GTFS folder or straight from the GTFS .zip file (files may be in a subfolder of the .zip)
+    if zipfile.is_zipfile(gtfs_path):
+        with zipfile.ZipFile(gtfs_path) as gtfs_zip: # the stream keeps the .zip file open until it is closed
+            gtfs_zip_files = {os.path.basename(z):z for z in gtfs_zip.namelist()}
+            if f not in gtfs_zip_files:
+                raise Exception(f"File {f} not found in {gtfs_path}.")
+            return gtfs_zip.open(gtfs_zip_files[f])
+    return open(os.path.join(gtfs_path, f), 'rb')
+
+def read_gtfs_files(gtfs_path, file_names=gtfs_file_names):
+    # Raw content of the GTFS files
+    gtfs_files = dict()
+    for f in file_names:
+        with open_gtfs_file(gtfs_path, f) as gtfs_file:
+            gtfs_files[f] = gtfs_file.read()
+    return gtfs_files
+
+def hash_gtfs_file(gtfs_path, f, cache_dir=None, block_size=1<<20):
+    # Digest of a GTFS file read by blocks, for files too big to be kept in memory. With cache_dir, the digest is kept in file_hashes.json
+    # with the size and modification time of the file (of the .zip file for a zipped GTFS), and the file is only read again when they change
+    gtfs_file_path = os.path.abspath(gtfs_path if zipfile.is_zipfile(gtfs_path) else os.path.join(gtfs_path, f))
+    gtfs_file_stat = os.stat(gtfs_file_path)
+    file_key, file_stamp = os.path.join(gtfs_file_path, f) if zipfile.is_zipfile(gtfs_path) else gtfs_file_path, [gtfs_file_stat.st_size, gtfs_file_stat.st_mtime_ns]
+    file_hashes = read_file_hashes(cache_dir) if cache_dir is not None else dict()
+    if file_key in file_hashes and file_hashes[file_key]['stamp'] == file_stamp:
+        return bytes.fromhex(file_hashes[file_key]['md5'])
+    file_hash = hashlib.md5()
+    with open_gtfs_file(gtfs_path, f) as gtfs_file:
+        for block in iter(lambda: gtfs_file.read(block_size), b''):
+            file_hash.update(block)
+    if cache_dir is not None:
+        file_hashes[file_key] = {'stamp':file_stamp, 'md5':file_hash.hexdigest()}
+        write_file_hashes(cache_dir, file_hashes)
+    return file_hash.digest()
+
+def read_file_hashes(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'file_hashes.json')) as hashes_file:
+            return json.load(hashes_file)
+    except (OSError, ValueError):
+        return dict()
+
+def write_file_hashes(cache_dir, file_hashes):
+    # Written to a temporary file and renamed, so an interrupted run never leaves a partial file
+    os.makedirs(cache_dir, exist_ok=True)
+    hashes_tmp = os.path.join(cache_dir, f'file_hashes.json.tmp{os.getpid()}')
+    with open(hashes_tmp, 'w') as hashes_file:
+        json.dump(file_hashes, hashes_file)
+    os.replace(hashes_tmp, os.path.join(cache_dir, 'file_hashes.json'))
+
+@profiled
+def select_gtfs_trips(gtfs_shapes_df, gtfs_trips_df, gtfs_routes_df, gtfs_calendar_df, day_type=None, modes_gtfs=None):
+    # Trips whose stop times are used: trips of the day_type service (headways) and the first trip of each shape ID (stop sequence),
+    # only for the shape IDs with shape points and whose route mode is in modes_gtfs. None if all trips are used
+    if day_type is None and modes_gtfs is None:
+        return None
+    first_trips_df = gtfs_trips_df[gtfs_trips_df.shape_id.isin(gtfs_shapes_df.shape_id.unique())].drop_duplicates(subset=['shape_id'])
+    if modes_gtfs is not None:
+        route_types = gtfs_routes_df.drop_duplicates(subset=['route_id']).set_index('route_id').route_type
+        first_trips_df = first_trips_df[first_trips_df.route_id.map(route_types).isin(modes_gtfs)]
+    shp_trips_df = gtfs_trips_df[gtfs_trips_df.shape_id.isin(first_trips_df.shape_id)]
+    if day_type is not None:
+        shp_trips_df = shp_trips_df[(shp_trips_df.service_id == find_service_id(gtfs_calendar_df, day_type)) | shp_trips_df.trip_id.isin(first_trips_df.trip_id)]
+    return set(shp_trips_df.trip_id)
+
+@profiled
+def read_gtfs_stop_times(gtfs_path, trip_ids=None, chunksize=1000000):
+    # 'stop_times.txt' read by chunks with only the columns used, keeping the stop times of trip_ids (all trips if None).
+    # Arrival times as int32 seconds from the start of the service day (-1 if missing), each distinct time converted once
+    stop_times_df, time_secs = list(), dict()
+    with open_gtfs_file(gtfs_path, 'stop_times.txt') as gtfs_file:
+        for chunk_df in pd.read_csv(gtfs_file, usecols=stop_times_cols, dtype=gtfs_id_dtypes, chunksize=chunksize):
+            if trip_ids is not None:
+                chunk_df = chunk_df[chunk_df.trip_id.isin(trip_ids)]
+            arr_codes, arr_times = pd.factorize(chunk_df.arrival_time)
+            for t in arr_times:
+                if t not in time_secs:
+                    time_secs[t] = time_to_seconds(t) if t.strip() != '' else -1
+            # Missing times have code -1, the -1 appended at the end
+            chunk_df = chunk_df[stop_times_cols].assign(arrival_time=np.append([time_secs[t] for t in arr_times], -1).astype('int32')[arr_codes])
+            stop_times_df.append(change_id_cols_type(chunk_df))
+    if len(stop_times_df) == 0:
+        return pd.DataFrame({c:pd.Series(dtype='int32' if c == 'arrival_time' else object) for c in stop_times_cols})
+    return pd.concat(stop_times_df, ignore_index=True)
+
+def hash_cache_key(items):
+    # items are bytes (file contents) or strings (parameters). Cache format version included so old caches are not read
+    cache_key = hashlib.md5(b'gtfs2ptnet cache v4')
+    for item in items:
+        item = item if isinstance(item, bytes) else item.encode()
+        cache_key.update(hashlib.md5(item).digest())
+    return cache_key.hexdigest()
+
+def write_tables_cache(cache_folder, tables, arrays=dict()):
+    # One .npy file per column (and per array) so numeric columns can be memory-mapped when read. Point geometries are kept as X and Y arrays,
+    # linestrings as one array of coordinates plus offsets, and other geometries as WKB.
+    # Written to a temporary folder and renamed, so an interrupted run never leaves a partial cache. Older caches of the same kind are removed.
+    cache_dir, cache_name = os.path.split(cache_folder)
+    cache_tmp = os.path.join(cache_dir, f'{cache_name}.tmp{os.getpid()}')
+    os.makedirs(cache_tmp, exist_ok=True)
+    tables_meta = dict()
+    for t, (table_name, table_df) in enumerate(tables.items()):
+        table_meta = {'columns':list(), 'crs':None}
+        for c, col in enumerate(table_df.columns):
+            col_file = f'{t}_{c}'
+            if isinstance(table_df, gpd.GeoDataFrame) and col == table_df.geometry.name:
+                geoms = table_df.geometry
+                geom_types = set(geoms.geom_type) if not geoms.isnull().any() and not geoms.has_z.any() else set()
+                if geom_types == {'Point'}:
+                    np.save(os.path.join(cache_tmp, f'{col_file}_x.npy'), geoms.x.to_numpy(dtype=float))
+                    np.save(os.path.join(cache_tmp, f'{col_file}_y.npy'), geoms.y.to_numpy(dtype=float))
+                    table_meta['columns'].append({'name':col, 'file':col_file, 'type':'point'})
+                elif geom_types == {'LineString'}:
+                    coords = [np.asarray(g.coords, dtype=float).reshape(-1, 2) for g in geoms]
+                    np.save(os.path.join(cache_tmp, f'{col_file}_coords.npy'), np.concatenate(coords) if len(coords) != 0 else np.empty((0, 2)))
+                    np.save(os.path.join(cache_tmp, f'{col_file}_offsets.npy'), np.cumsum([0] + [c.shape[0] for c in coords]))
+                    table_meta['columns'].append({'name':col, 'file':col_file, 'type':'linestring'})
+                else:
+                    np.save(os.path.join(cache_tmp, f'{col_file}.npy'), np.array([g.wkb_hex if g is not None else '' for g in geoms], dtype='U'))
+                    table_meta['columns'].append({'name':col, 'file':col_file, 'type':'wkb'})
+                table_meta['crs'] = table_df.crs.to_string() if table_df.crs is not None else None
+                continue
+            values = table_df[col].to_numpy()
+            if values.dtype.kind in 'biufcmM':
+                np.save(os.path.join(cache_tmp, f'{col_file}.npy'), values)
+                table_meta['columns'].append({'name':col, 'file':col_file, 'type':'array'})
+            else:
+                nulls = pd.isnull(values)
+                np.save(os.path.join(cache_tmp, f'{col_file}.npy'), np.array([str(v) for v in values], dtype='U'))
+                np.save(os.path.join(cache_tmp, f'{col_file}_null.npy'), nulls)
+                table_meta['columns'].append({'name':col, 'file':col_file, 'type':'str'})
+        tables_meta[table_name] = table_meta
+    for array_name, array in arrays.items():
+        np.save(os.path.join(cache_tmp, f'{array_name}.npy'), array)
+    with open(os.path.join(cache_tmp, 'tables.json'), 'w') as meta_file:
+        json.dump({'tables':tables_meta, 'arrays':list(arrays.keys())}, meta_file)
+    shutil.rmtree(cache_folder, ignore_errors=True)
+    os.replace(cache_tmp, cache_folder)
+    cache_kind = cache_name.split('_')[0]
+    for old_cache in os.listdir(cache_dir):
+        if old_cache.split('_')[0] == cache_kind and old_cache != cache_name and '.tmp' not in old_cache:
+            shutil.rmtree(os.path.join(cache_dir, old_cache), ignore_errors=True)
+
+# Cache folders already read, kept in memory by the resident worker (gtfs2ptnet_worker.py). Cache folder names have the key of their inputs
+tables_memory = {'folders':dict(), 'max_entries':0}
+
+def keep_tables_in_memory(max_entries=4):
+    # The last max_entries cache folders read are kept in memory, so the next runs with the same inputs do not read them again
+    tables_memory['max_entries'] = max_entries
+    tables_memory['folders'].clear()
+
+def read_tables_cache(cache_folder):
+    # Tables are copies of the ones kept in memory, since runs can change them
+    if cache_folder in tables_memory['folders']:
+        tables, arrays = tables_memory['folders'][cache_folder]
+        return {table_name:table_df.copy() for table_name, table_df in tables.items()}, arrays
+    tables, arrays = read_tables_cache_files(cache_folder)
+    if tables_memory['max_entries'] > 0:
+        # Arrays loaded in memory, not memory-mapped, so the cache folder can still be replaced
+        arrays = {array_name:np.array(array) for array_name, array in arrays.items()}
+        for array in arrays.values():
+            array.flags.writeable = False
+        tables_memory['folders'][cache_folder] = ({table_name:table_df.copy() for table_name, table_df in tables.items()}, arrays)
+        for old_folder in list(tables_memory['folders'])[:-tables_memory['max_entries']]:
+            del tables_memory['folders'][old_folder]
+    return tables, arrays
+
+def read_tables_cache_files(cache_folder):
+    # Numeric columns and point coordinates are memory-mapped copy-on-write and used by the tables without a copy: a run can change
+    # its tables, never the cache files
+    with open(os.path.join(cache_folder, 'tables.json')) as meta_file:
+        cache_meta = json.load(meta_file)
+    tables = dict()
+    for table_name, table_meta in cache_meta['tables'].items():
+        table_cols, geometry = dict(), None
+        for col in table_meta['columns']:
+            col_file = os.path.join(cache_folder, col['file'])
+            if col['type'] == 'point':
+                geometry = (col['name'], gpd.points_from_xy(np.load(f'{col_file}_x.npy', mmap_mode='c'), np.load(f'{col_file}_y.npy', mmap_mode='c')))
+                table_cols[col['name']] = geometry[1]
+            elif col['type'] == 'linestring':
+                coords, offsets = np.load(f'{col_file}_coords.npy', mmap_mode='r'), np.load(f'{col_file}_offsets.npy')
+                geometry = (col['name'], gpd.array.from_shapely([LineString(coords[a:b]) for a, b in zip(offsets[:-1], offsets[1:])]))
+                table_cols[col['name']] = geometry[1]
+            elif col['type'] == 'wkb':
+                geometry = (col['name'], gpd.array.from_shapely([shapely.wkb.loads(g, hex=True) if g != '' else None for g in np.load(f'{col_file}.npy')]))
+                table_cols[col['name']] = geometry[1]
+            elif col['type'] == 'array':
+                table_cols[col['name']] = np.load(f'{col_file}.npy', mmap_mode='c')
+            else:
+                values = np.load(f'{col_file}.npy').astype(object)
+                values[np.load(f'{col_file}_null.npy')] = np.nan
+                table_cols[col['name']] = values
+        if geometry is not None:
+            tables[table_name] = gpd.GeoDataFrame(pd.DataFrame(table_cols, copy=False), geometry=geometry[0], crs=table_meta['crs'])
+        else:
+            tables[table_name] = pd.DataFrame(table_cols, copy=False)
+    arrays = {array_name:np.load(os.path.join(cache_folder, f'{array_name}.npy'), mmap_mode='r') for array_name in cache_meta['arrays']}
+    return tables, arrays
+
 def change_id_cols_type(df, type_to='str'):
     df = df.copy()
     for c in df.columns:
@@ -97,53 +638,278 @@ def change_id_cols_type(df, type_to='str'):
             df[c] = df[c].apply(lambda x: x.lstrip('0')) # remove leading zeros
     return df
 
-def read_route_mode_id(rte_mode_table, route_id):
-    modes_df = pd.read_csv(rte_mode_table)
+@profiled
+def create_gtfs_shape_index(gtfs_shapes_df, gtfs_trips_df, gtfs_routes_df):
+    # Group trips, route and shape points by shape ID once, so the main loop does lookups instead of table scans
+    route_types = gtfs_routes_df.drop_duplicates(subset=['route_id']).set_index('route_id').route_type.to_dict()
+    shapes_pos = gtfs_shapes_df.groupby('shape_id', sort=False).indices
+    gtfs_shape_index = dict()
+    for shp_id, trips_pos in gtfs_trips_df.groupby('shape_id', sort=False).indices.items():
+        if shp_id not in shapes_pos: # trips without shape points are never processed
+            continue
+        shp_trips_df = gtfs_trips_df.iloc[trips_pos] # trips keep the order found in 'trips.txt'
+        shp_id_df = gtfs_shapes_df.iloc[shapes_pos[shp_id]].reset_index(drop=True) # shape points keep the order found in 'shapes.txt'
+        route_id = shp_trips_df.route_id.values[0]
+        gtfs_shape_index[shp_id] = {'route_trip_id': shp_trips_df.trip_id.values[0], # first trip ID represents the shape
+                                    'route_id': route_id,
+                                    'route_mode': route_types.get(route_id),
+                                    'headsign': shp_trips_df.trip_headsign.values[0],
+                                    'shape_df': shp_id_df,
+                                    'line': LineString(shp_id_df.geometry.values) if shp_id_df.shape[0] > 1 else None}
+    return gtfs_shape_index
+
+def read_route_modes(rte_mode_table):
+    # Mode of each route ID in modes_table.csv, read once per run. The first row of a route ID wins
+    modes_df = pd.read_csv(rte_mode_table).drop_duplicates('ROUTE_ID')
+    return dict(zip(modes_df.ROUTE_ID, modes_df.MODE))
+
+def read_route_mode_id(route_modes, route_id):
     try:
-        return modes_df.loc[modes_df.ROUTE_ID == route_id, 'MODE'].values[0]
-    except:
+        return route_modes[route_id]
+    except KeyError:
         raise Exception(f'Route ID {route_id} not found in modes_table.csv.')
 
 def find_nodes_within_shp(nodes, links, shapes):
-    nodes_within_shp_list = np.unique(links.A.values.tolist() + links.B.values.tolist())
-    nodes_within_shp_df = nodes[nodes.N.isin(nodes_within_shp_list)]
+    nodes_within_shp_df = nodes[isin_keys(nodes.N, create_keys_index(np.concatenate([links.A.to_numpy(), links.B.to_numpy()])))]
     return nodes_within_shp_df.reset_index(drop=True)
 
-def nearest_node_to_stop(stop, nodes, threshold=np.inf):
-    # stop is geometry and nodes is geodataframe
-    if nodes.shape[0] == 0:
-        return None
-    else:
-        distances = np.array([stop.distance(n) for n in nodes.geometry])
-        if np.min(distances) <= threshold:
-            near_node = np.argmin(distances)
-            return nodes.N.to_list()[near_node]
+def bulk_nearest_available():
+    # geopandas spatial indexes query the nearest geometries of many points in one call with the shapely 2 or pygeos backend, not with rtree
+    return int(shapely.__version__.split('.')[0]) >= 2 or getattr(gpd.options, 'use_pygeos', False)
+
+def create_nodes_sindex(nodes):
+    # Spatial index of nodes (geodataframe), built once per shape and reused for its stops and for every gap of its line
+    nodes_xy = np.array([(n.x, n.y) for n in nodes.geometry], dtype=float).reshape(-1, 2)
+    nodes_sindex = {'N':nodes.N.to_list(), 'xy':nodes_xy, 'bulk':bulk_nearest_available(), 'index':None}
+    if nodes_xy.shape[0] != 0:
+        if nodes_sindex['bulk']:
+            nodes_sindex['index'] = gpd.GeoSeries(gpd.points_from_xy(nodes_xy[:,0], nodes_xy[:,1])).sindex
         else:
-            return None
+            nodes_sindex['index'] = rtree.index.Index(((i, (x, y, x, y), None) for i, (x, y) in enumerate(nodes_xy)))
+    return nodes_sindex
 
+def nearest_nodes_to_stops(stops, nodes_sindex, threshold=np.inf, return_distance=False):
+    # stops are point geometries and nodes_sindex comes from create_nodes_sindex. Returns the nearest node N to each stop, or None if farther
+    # than threshold. Ties are all returned by the index and the first node wins
+    stops_xy = np.array([(s.x, s.y) for s in stops], dtype=float).reshape(-1, 2)
+    near_pos = np.full(stops_xy.shape[0], -1)
+    near_distances = np.full(stops_xy.shape[0], np.inf)
+    if nodes_sindex['index'] is not None and stops_xy.shape[0] != 0:
+        if nodes_sindex['bulk']: # all stops in one query
+            (stops_pos, nodes_pos), distances = nodes_sindex['index'].nearest(gpd.points_from_xy(stops_xy[:,0], stops_xy[:,1]), return_all=True,
+                                                                              max_distance=threshold if np.isfinite(threshold) else None, return_distance=True)
+            order = np.lexsort((nodes_pos, stops_pos))
+            first = order[np.unique(stops_pos[order], return_index=True)[1]]
+            near_pos[stops_pos[first]], near_distances[stops_pos[first]] = nodes_pos[first], distances[first]
+        else:
+            nodes_xy = nodes_sindex['xy']
+            for s, (x, y) in enumerate(stops_xy):
+                near_candidates = np.sort(list(nodes_sindex['index'].nearest((x, y, x, y), 1)))
+                distances = np.sqrt((nodes_xy[near_candidates,0] - x)**2 + (nodes_xy[near_candidates,1] - y)**2)
+                near_pos[s], near_distances[s] = near_candidates[np.argmin(distances)], np.min(distances)
+    near_nodes = [nodes_sindex['N'][p] if p != -1 and d <= threshold else None for p, d in zip(near_pos, near_distances)]
+    near_nodes = pd.Series(near_nodes, index=stops.index if isinstance(stops, pd.Series) else None)
+    if return_distance:
+        return near_nodes, near_distances
+    return near_nodes
+
+@profiled
 def match_stops_and_nodes(gtfs_stop_times_df, gtfs_stops_df, nodes_within_shp_df, route_trip_id, threshold=np.inf):
     line_stops = gpd.GeoDataFrame(gtfs_stop_times_df[gtfs_stop_times_df.trip_id == route_trip_id].merge(gtfs_stops_df[['stop_id','geometry']])).sort_values(by='stop_sequence')
-    line_stops['N'] = line_stops.geometry.apply(lambda x: nearest_node_to_stop(x, nodes_within_shp_df, threshold))
+    line_stops['N'] = nearest_nodes_to_stops(line_stops.geometry, create_nodes_sindex(nodes_within_shp_df), threshold)
     line_stops['N'] = line_stops['N'].astype('object')
     return line_stops
 
-def match_stops_and_transit_nodes(line_stops, transit_only_nodes_df, gtfs_stop_times_df, gtfs_stops_df, nodes_within_shp_df, route_trip_id):
-    if transit_only_nodes_df.shape[0] != 0 and nodes_within_shp_df.shape[0] != 0:
-        line_stops_transit_only = transit_only_nodes_df[transit_only_nodes_df.N.isin(nodes_within_shp_df.N.to_list())].copy()
-        if line_stops_transit_only.shape[0] != 0: # Only transit-only nodes related to the current route
-            line_stops_transit_only = match_stops_and_nodes(gtfs_stop_times_df, gtfs_stops_df, line_stops_transit_only, route_trip_id, 328)
-            for _,s in line_stops_transit_only[~line_stops_transit_only.N.isnull()][['stop_sequence','N']].iterrows():
-                line_stops.loc[line_stops.stop_sequence == s.stop_sequence, 'N'] = s.N
+@profiled
+def match_stops_and_transit_nodes(line_stops, transit_only_nodes, nodes_within_shp_n):
+    # Stops are set to the nearest transit-only node within 328 ft, among the transit-only nodes related to the current route
+    # (node IDs in nodes_within_shp_n). The nodes near each stop_id are kept by the stops registry of transit_only_nodes
+    if len(transit_only_nodes['cols']['N']) != 0 and len(nodes_within_shp_n) != 0:
+        stops_registry = get_stops_registry(transit_only_nodes)
+        stop_nodes, n_matched = dict(), 0
+        for stop_id, stop_sequence, stop in zip(line_stops.stop_id, line_stops.stop_sequence, line_stops.geometry):
+            if stop_id not in stops_registry['stops']:
+                register_stop(stops_registry, transit_only_nodes, stop_id, stop.x, stop.y)
+            for _, _, N in stops_registry['near_nodes'][stops_registry['stops'][stop_id]]:
+                if N in nodes_within_shp_n:
+                    stop_nodes[stop_sequence] = N
+                    n_matched += 1
+                    break
+        if len(stop_nodes) != 0:
+            # Node IDs are floats when a stop is not matched, as in a pandas column with None values (and in the outputs)
+            node_type = int if n_matched == line_stops.shape[0] else float
+            matched = line_stops.stop_sequence.isin(list(stop_nodes))
+            line_stops.loc[matched, 'N'] = pd.Series([node_type(stop_nodes[s]) for s in line_stops.stop_sequence[matched]], index=line_stops.index[matched], dtype='object')
     return line_stops.sort_values(by='stop_sequence').reset_index(drop=True)
 
-def create_netx(nodes, links):
-    G = nx.DiGraph()
-    G.add_nodes_from([(node.N, {'pos':(node.X, node.Y)}) for i,node in nodes.iterrows()])
-    G.add_edges_from([(link.A, link.B, {'length':link.geometry.length}) for i,link in links.iterrows()])
+def get_stops_registry(transit_only_nodes, threshold=328):
+    # Registry of the stops seen by the shapes: for each stop_id, the transit-only nodes within threshold sorted by distance and position
+    # (the nearest node wins and ties go to the first created, as in nearest_nodes_to_stops). Kept by transit_only_nodes across segments
+    # and shapes, and updated as transit-only nodes are created, so stops already seen are not matched again
+    if transit_only_nodes['stops_registry'] is None:
+        stops_registry = {'threshold':threshold, 'stops':dict(), 'stops_xy':list(), 'near_nodes':list(), 'stops_sindex':rtree.index.Index(), 'nodes_sindex':rtree.index.Index()}
+        for node_pos, node in enumerate(transit_only_nodes['cols']['geometry']):
+            stops_registry['nodes_sindex'].insert(node_pos, (node.x, node.y, node.x, node.y))
+        transit_only_nodes['stops_registry'] = stops_registry
+    return transit_only_nodes['stops_registry']
+
+def register_stop(stops_registry, transit_only_nodes, stop_id, x, y):
+    t = stops_registry['threshold']
+    stop_pos = len(stops_registry['stops_xy'])
+    stops_registry['stops'][stop_id] = stop_pos
+    stops_registry['stops_xy'].append((x, y))
+    stops_registry['stops_sindex'].insert(stop_pos, (x, y, x, y))
+    nodes_pos = np.sort(list(stops_registry['nodes_sindex'].intersection((x - t, y - t, x + t, y + t))))
+    nodes_xy = np.array([(transit_only_nodes['cols']['geometry'][p].x, transit_only_nodes['cols']['geometry'][p].y) for p in nodes_pos], dtype=float).reshape(-1, 2)
+    distances = np.sqrt((nodes_xy[:,0] - x)**2 + (nodes_xy[:,1] - y)**2)
+    stops_registry['near_nodes'].append(sorted([(d, p, transit_only_nodes['cols']['N'][p]) for d, p in zip(distances, nodes_pos) if d <= t]))
+
+def register_transit_only_node(stops_registry, node_pos, N, x, y):
+    # New transit-only node added to the near nodes of the stops within threshold
+    t = stops_registry['threshold']
+    stops_registry['nodes_sindex'].insert(node_pos, (x, y, x, y))
+    stops_pos = list(stops_registry['stops_sindex'].intersection((x - t, y - t, x + t, y + t)))
+    stops_xy = np.array([stops_registry['stops_xy'][p] for p in stops_pos], dtype=float).reshape(-1, 2)
+    distances = np.sqrt((x - stops_xy[:,0])**2 + (y - stops_xy[:,1])**2)
+    for d, stop_pos in zip(distances, stops_pos):
+        if d <= t:
+            insort(stops_registry['near_nodes'][stop_pos], (d, node_pos, N))
+
+@profiled
+def create_routing_graph(links_df):
+    # Directed graph of the cleaned network built once per run, in CSR form: edges sorted by A (in links order) with precomputed lengths,
+    # and the same edges sorted by B (in links order) for the backward search. Nodes are the network node IDs. A repeated A-B keeps its
+    # first position and its last length
+    links_A, links_B = links_df.A.to_numpy(), links_df.B.to_numpy()
+    nodes = pd.unique(np.concatenate([links_A, links_B]))
+    links_src, links_dst = pd.Index(nodes).get_indexer(links_A), pd.Index(nodes).get_indexer(links_B)
+    edges_order = np.argsort(links_src, kind='mergesort')
+    edges_src, edges_dst, edges_length = links_src[edges_order], links_B[edges_order].tolist(), links_df.geometry.length.to_numpy()[edges_order].tolist()
+    edge_pos = dict()
+    for e, (a, b) in enumerate(zip(links_A[edges_order].tolist(), edges_dst)):
+        if (a, b) in edge_pos:
+            edges_length[edge_pos[(a, b)]] = edges_length[e]
+        else:
+            edge_pos[(a, b)] = e
+    rev_order = np.lexsort((edges_order, links_dst[edges_order])) # edges by B, then by position in links
+    return {'node_row':{n:i for i, n in enumerate(nodes.tolist())}, 'indptr':np.searchsorted(edges_src, np.arange(len(nodes) + 1)).tolist(),
+            'dst':edges_dst, 'length':edges_length, 'edge_pos':edge_pos, 'n_edges':len(edges_dst),
+            'rev_indptr':np.searchsorted(links_dst[edges_order][rev_order], np.arange(len(nodes) + 1)).tolist(), 'rev_src':links_A[edges_order][rev_order].tolist(), 'rev_edge':rev_order.tolist()}
+
+@profiled
+def create_shp_graph(routing_graph, links, path_cache=None):
+    # View of the routing graph restricted to the shape links: base edges are enabled in a mask, other links (transit-only) are kept
+    # in 'extra' (by A) and 'extra_pred' (by B) in the order they are added. Edges added and removed while creating the node sequence
+    # only change the view. 'view_key' is a digest of the view, updated with each edge added or removed, for the path cache
+    G = {'graph':routing_graph, 'mask':bytearray(routing_graph['n_edges']), 'extra':dict(), 'extra_pred':dict(), 'length':dict(), 'path_cache':path_cache}
+    links_geoms = links.geometry.values
+    for i, (A, B) in enumerate(zip(links.A.tolist(), links.B.tolist())):
+        e = routing_graph['edge_pos'].get((A, B))
+        if e is not None:
+            G['mask'][e] = 1
+        else:
+            G['extra'].setdefault(A, dict())[B] = links_geoms[i].length
+            G['extra_pred'].setdefault(B, dict())[A] = links_geoms[i].length
+    if path_cache is not None:
+        view_key = hashlib.md5(G['mask'])
+        view_key.update(repr(list(G['extra'].items())).encode())
+        G['view_key'] = view_key.digest()
     return G
 
-def add_nodes_to_seq(G, source, target, line_node_seq):
-    stops_node_seq = nx.shortest_path(G, source=source.N, target=target.N, weight='length')
+def update_shp_graph_key(G, change):
+    if G['path_cache'] is not None:
+        G['view_key'] = hashlib.md5(G['view_key'] + repr(change).encode()).digest()
+
+def add_shp_graph_edge(G, A, B, length):
+    e = G['graph']['edge_pos'].get((A, B))
+    if e is not None and G['mask'][e]:
+        G['length'][(A, B)] = length
+    else:
+        G['extra'].setdefault(A, dict())[B] = length
+        G['extra_pred'].setdefault(B, dict())[A] = length
+    update_shp_graph_key(G, ('add', A, B, length))
+    return G
+
+def remove_shp_graph_edge(G, A, B):
+    if B in G['extra'].get(A, dict()):
+        del G['extra'][A][B]
+        del G['extra_pred'][B][A]
+    else:
+        G['mask'][G['graph']['edge_pos'][(A, B)]] = 0
+        G['length'].pop((A, B), None)
+    update_shp_graph_key(G, ('remove', A, B))
+    return G
+
+def create_path_cache():
+    # Paths between stop nodes shared by the shape views of a network overlay, keyed on (view_key, source, target). A path is only
+    # reused by a view with the same edges and lengths (same links within the shape buffer and the same transit-only links), where the
+    # search would find it again. A view with a new transit-only edge has another key, so no path that it could shorten is reused
+    return {'paths':dict(), 'hits':0, 'misses':0}
+
+def shp_graph_neighbors(G, v, backward=False):
+    # (neighbor, length) of the edges leaving v, or entering v if backward, in the order the edges were added to the view
+    graph, mask, new_length = G['graph'], G['mask'], G['length']
+    i = graph['node_row'].get(v)
+    if backward:
+        neighbors = [(graph['rev_src'][k], new_length.get((graph['rev_src'][k], v), graph['length'][graph['rev_edge'][k]]))
+                     for k in range(graph['rev_indptr'][i], graph['rev_indptr'][i+1]) if mask[graph['rev_edge'][k]]] if i is not None else list()
+        return neighbors + list(G['extra_pred'].get(v, dict()).items())
+    neighbors = [(graph['dst'][e], new_length.get((v, graph['dst'][e]), graph['length'][e])) for e in range(graph['indptr'][i], graph['indptr'][i+1]) if mask[e]] if i is not None else list()
+    return neighbors + list(G['extra'].get(v, dict()).items())
+
+@profiled
+def find_shortest_path(G, source, target):
+    # Bidirectional Dijkstra between source and target, alternating forward and backward steps. Returns None if there is no path.
+    # Same steps and tie-breaking as networkx bidirectional_dijkstra (used by networkx shortest_path with source, target and weight),
+    # with the neighbors in the order the edges were added, so the paths are the ones of a networkx DiGraph of the shape links.
+    # Paths already found on the same view are taken from the path cache of G (create_path_cache)
+    if source == target:
+        return [source]
+    profile_count('shortest_path_calls')
+    path_cache = G['path_cache']
+    if path_cache is not None:
+        if (G['view_key'], source, target) in path_cache['paths']:
+            path_cache['hits'] += 1
+            profile_count('path_cache_hits')
+            cached_path = path_cache['paths'][(G['view_key'], source, target)]
+            return list(cached_path) if cached_path is not None else None
+        path_cache['misses'] += 1
+        shortest_path = find_bidirectional_shortest_path(G, source, target)
+        path_cache['paths'][(G['view_key'], source, target)] = tuple(shortest_path) if shortest_path is not None else None
+        return shortest_path
+    return find_bidirectional_shortest_path(G, source, target)
+
+def find_bidirectional_shortest_path(G, source, target):
+    dists, paths, fringe, seen = [dict(), dict()], [{source:[source]}, {target:[target]}], [list(), list()], [{source:0}, {target:0}]
+    c = count()
+    heappush(fringe[0], (0, next(c), source))
+    heappush(fringe[1], (0, next(c), target))
+    final_dist, final_path = None, list()
+    direction = 1
+    while fringe[0] and fringe[1]:
+        direction = 1 - direction # 0 is forward from source, 1 is backward from target
+        (d, _, v) = heappop(fringe[direction])
+        if v in dists[direction]:
+            continue
+        dists[direction][v] = d
+        if v in dists[1 - direction]:
+            return final_path
+        for w, cost in shp_graph_neighbors(G, v, direction == 1):
+            vw_dist = d + cost
+            if w in dists[direction]:
+                continue
+            if w not in seen[direction] or vw_dist < seen[direction][w]:
+                seen[direction][w] = vw_dist
+                heappush(fringe[direction], (vw_dist, next(c), w))
+                paths[direction][w] = paths[direction][v] + [w]
+                if w in seen[0] and w in seen[1]:
+                    total_dist = seen[0][w] + seen[1][w]
+                    if final_path == [] or final_dist > total_dist:
+                        final_dist = total_dist
+                        final_path = paths[0][w] + paths[1][w][::-1][1:]
+    return None
+
+def add_nodes_to_seq(stops_node_seq, line_node_seq):
     stops_node_seq = [int(n) for n in stops_node_seq]
     if len(line_node_seq) != 0:
         line_node_seq.extend(stops_node_seq[1:])
@@ -151,18 +917,22 @@ def add_nodes_to_seq(G, source, target, line_node_seq):
         line_node_seq.extend(stops_node_seq)
     return line_node_seq
 
+@profiled
 def test_new_link(G, A, B, source, target, new_link, full_link):
-    G.add_edges_from([(A, B, {'length':new_link.length})])
-    G.add_edges_from([(B, A, {'length':new_link.length})])
-    if not nx.has_path(G, source=source.N, target=target.N):
-        G.remove_edge(A, B)
-        G.remove_edge(B, A)
+    # Returns the path from source to target with the new link
+    G = add_shp_graph_edge(G, A, B, new_link.length)
+    G = add_shp_graph_edge(G, B, A, new_link.length)
+    stops_node_seq = find_shortest_path(G, source.N, target.N)
+    if stops_node_seq is None:
+        G = remove_shp_graph_edge(G, A, B)
+        G = remove_shp_graph_edge(G, B, A)
         A = source.N
         B = target.N
         new_link = full_link
-        G.add_edges_from([(A, B, {'length':new_link.length})])
-        G.add_edges_from([(B, A, {'length':new_link.length})])
-    return A, B, new_link, G
+        G = add_shp_graph_edge(G, A, B, new_link.length)
+        G = add_shp_graph_edge(G, B, A, new_link.length)
+        stops_node_seq = find_shortest_path(G, source.N, target.N)
+    return A, B, new_link, G, stops_node_seq
     
 def update_nodes_when_new_link(nodes_df, new_node, cols=['N','X','Y','geometry']):
     if isinstance(new_node, gpd.GeoDataFrame) or isinstance(new_node, pd.DataFrame):
@@ -178,7 +948,7 @@ def update_nodes_when_new_link(nodes_df, new_node, cols=['N','X','Y','geometry']
                 nodes_temp_df[c] = new_node[c]
     else:
         raise Exception(f"new_link must be pandas/geopandas DataFrame or pandas/geopandas GeoSeries. Type {type(new_node)} not acceptable.")
-    return nodes_df.append(nodes_temp_df, ignore_index=True)
+    return pd.concat([nodes_df, nodes_temp_df], ignore_index=True)
 
 def update_links_when_new_link(links_df, new_link, cols=['A','B','geometry']):
     if isinstance(new_link, gpd.GeoDataFrame) or isinstance(new_link, pd.DataFrame):
@@ -189,66 +959,116 @@ def update_links_when_new_link(links_df, new_link, cols=['A','B','geometry']):
             links_temp_df[c] = new_link[c]
     else:
         raise Exception(f"new_link must be GeoDataFrame or GeoSeries. Type {type(new_link)} not acceptable.")
-    return links_df.append(links_temp_df, ignore_index=True)
+    return pd.concat([links_df, links_temp_df], ignore_index=True)
 
 def update_links_buffer_when_new_link(links_within_shp_buffer_df, w_bffr, new_link):
     # new_link is linestring
     links_within_shp_buffer_df.loc[links_within_shp_buffer_df.shape[0],'geometry'] = new_link.buffer(w_bffr, cap_style=3)
     return links_within_shp_buffer_df
 
-def find_near_shp_points_to_source_target(shp_nodes, source, target):
-    if pd.isnull(source.N):
-        source['N'] = 1 # temporarily assign a node number to source if None
-    if pd.isnull(target.N):
-        target['N'] = 2 # temporarily assign a node number to target if None
-    source_target_nodes_df = gpd.GeoDataFrame(pd.DataFrame([source, target]))
-    source_target_nodes_df['N'] = source_target_nodes_df.N.astype('int')
-    for ft_dist in range(164,820+1,82):
-        shp_nodes['NEAR_SHP_POINTS'] = shp_nodes.apply(lambda x: nearest_node_to_stop(x.geometry, source_target_nodes_df, ft_dist), axis=1)
-        shp_nodes_not_null = shp_nodes[~shp_nodes.NEAR_SHP_POINTS.isnull()]
-        near_point_to_source, near_point_to_target = None, None
-        for _,n in shp_nodes_not_null.iterrows():
-            if int(n.NEAR_SHP_POINTS) == int(source.N):
-                near_point_to_source = int(n.N)
-            if not pd.isnull(near_point_to_source) and int(n.NEAR_SHP_POINTS) == int(target.N):
-                near_point_to_target = int(n.N)
-                break
-        if not pd.isnull(near_point_to_source) and not pd.isnull(near_point_to_target):
-            break
-    shp_points_gap_df = shp_nodes[(shp_nodes.N >= near_point_to_source) & (shp_nodes.N <= near_point_to_target)]
-    shp_nodes = shp_nodes[shp_nodes.N >= near_point_to_target]
-    return shp_points_gap_df, shp_nodes, near_point_to_source, near_point_to_target
-
-def create_new_link(source, target, transit_only_nodes_df, nodes_within_shp_df, shp_points_gap_df):
-    shp_points_gap_df['NEAR_NET_NODE'] = shp_points_gap_df.apply(lambda x: nearest_node_to_stop(x.geometry, nodes_within_shp_df, 328), axis=1)
+def densify_line(line, step=30):
+    # X,Y of points every step along the line plus its last vertex. Same points as line.interpolate(d), with array math
+    coords = np.array(line.coords, dtype=float)[:,:2]
+    seg_starts, seg_ends = coords[:-1], coords[1:]
+    seg_dx, seg_dy = seg_ends[:,0] - seg_starts[:,0], seg_ends[:,1] - seg_starts[:,1]
+    seg_lengths = np.sqrt(seg_dx*seg_dx + seg_dy*seg_dy)
+    cum_lengths = np.cumsum(seg_lengths)
+    seg_cum_starts = np.append(0, cum_lengths[:-1])
+    distances = np.arange(0, cum_lengths[-1], step)
+    segs = np.minimum(np.searchsorted(cum_lengths, distances, side='right'), seg_lengths.shape[0] - 1) # segment where each distance falls
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fracs = np.clip((distances - seg_cum_starts[segs]) / seg_lengths[segs], 0, 1)
+    fracs[np.isnan(fracs)] = 1
+    points_xy = np.column_stack([seg_dx[segs]*fracs + seg_starts[segs,0], seg_dy[segs]*fracs + seg_starts[segs,1]])
+    points_xy[fracs == 1] = seg_ends[segs[fracs == 1]]
+    return np.vstack([points_xy, coords[-1:]])
+
+def first_local_minimum(distances, radii=range(164,820+1,82), rise=82):
+    # Walks the distances forward from the first one within the smallest radius reached, and returns the index of the
+    # smallest distance before they rise more than rise above it (the shape moving away from the stop). Later passes of
+    # the shape near the stop are not reached. Falls back to the smallest distance if no radius is reached
+    for radius in radii:
+        within = np.flatnonzero(distances <= radius)
+        if within.shape[0] != 0:
+            pass_distances = distances[within[0]:]
+            rises = np.flatnonzero(pass_distances > np.minimum.accumulate(pass_distances) + rise)
+            pass_end = rises[0] if rises.shape[0] != 0 else pass_distances.shape[0]
+            return int(within[0] + np.argmin(pass_distances[:pass_end]))
+    return int(np.argmin(distances))
+
+@profiled
+def locate_gap_on_shp(shp_points_xy, shp_start, source, target):
+    # Finds source and target on the shape points not yet used by the line (from shp_start on), target after source, walking
+    # the shape forward so loop and out-and-back shapes do not jump to a later pass near the stop.
+    # Returns the shape points in the gap as geodataframe, the next shp_start, and the shape points nearest to source and target
+    profile_count('gaps')
+    source_distances = np.sqrt((shp_points_xy[shp_start:,0] - source.geometry.x)**2 + (shp_points_xy[shp_start:,1] - source.geometry.y)**2)
+    near_point_to_source = shp_start + first_local_minimum(source_distances)
+    target_start = min(near_point_to_source + 1, shp_points_xy.shape[0] - 1)
+    target_distances = np.sqrt((shp_points_xy[target_start:,0] - target.geometry.x)**2 + (shp_points_xy[target_start:,1] - target.geometry.y)**2)
+    near_point_to_target = target_start + first_local_minimum(target_distances)
+    gap_points = np.arange(near_point_to_source, near_point_to_target + 1)
+    shp_points_gap_df = gpd.GeoDataFrame({'N':gap_points, 'X':shp_points_xy[gap_points,0], 'Y':shp_points_xy[gap_points,1]},
+                                         geometry=gpd.points_from_xy(shp_points_xy[gap_points,0], shp_points_xy[gap_points,1]), index=gap_points)
+    return shp_points_gap_df, near_point_to_target, near_point_to_source, near_point_to_target
+
+def nearest_nodes_within_shp(points, nodes_within_shp_sindex, new_nodes_within_shp, threshold=np.inf):
+    # Nearest node N to each point among the nodes within the shape (their index from create_nodes_sindex) and, after them, the nodes
+    # added by the line's new links (list of dicts with N and geometry). As with one index over both, ties go to the first node
+    near_nodes, near_distances = nearest_nodes_to_stops(points, nodes_within_shp_sindex, np.inf, return_distance=True)
+    near_nodes = near_nodes.to_list()
+    if len(new_nodes_within_shp) != 0 and len(near_nodes) != 0:
+        points_xy = np.array([(p.x, p.y) for p in points], dtype=float).reshape(-1, 2)
+        new_nodes_xy = np.array([(n['geometry'].x, n['geometry'].y) for n in new_nodes_within_shp], dtype=float)
+        new_distances = np.sqrt((new_nodes_xy[None,:,0] - points_xy[:,None,0])**2 + (new_nodes_xy[None,:,1] - points_xy[:,None,1])**2)
+        new_near = np.argmin(new_distances, axis=1)
+        new_near_distances = new_distances[np.arange(points_xy.shape[0]), new_near]
+        near_nodes = [new_nodes_within_shp[new_near[p]]['N'] if new_near_distances[p] < near_distances[p] else near_nodes[p] for p in range(len(near_nodes))]
+        near_distances = np.minimum(near_distances, new_near_distances)
+    near_nodes = [n if d <= threshold else None for n, d in zip(near_nodes, near_distances)]
+    return pd.Series(near_nodes, index=points.index if isinstance(points, pd.Series) else None)
+
+def find_node_within_shp(N, nodes_within_shp_df, new_nodes_within_shp):
+    # Node N among the nodes within the shape, else among the nodes added by the line's new links
+    node_within_shp_df = nodes_within_shp_df.loc[nodes_within_shp_df.N == N]
+    if node_within_shp_df.shape[0] != 0:
+        return node_within_shp_df.iloc[0]
+    return pd.Series([n for n in new_nodes_within_shp if n['N'] == N][0])
+
+@profiled
+def create_new_link(source, target, transit_only_nodes, nodes_within_shp_df, nodes_within_shp_sindex, new_nodes_within_shp, shp_points_gap_df):
+    shp_points_gap_df['NEAR_NET_NODE'] = nearest_nodes_within_shp(shp_points_gap_df.geometry, nodes_within_shp_sindex, new_nodes_within_shp, 328)
     shp_points_gap_full_df = shp_points_gap_df.copy()
     A, B = int(source.N), int(target.N)
     if shp_points_gap_df[~shp_points_gap_df.NEAR_NET_NODE.isnull()].shape[0] != 0:
-        source_is_transit_bool = False if transit_only_nodes_df.shape[0]==0 else True if source.N in transit_only_nodes_df.N.to_list() else False
-        target_is_transit_bool = False if transit_only_nodes_df.shape[0]==0 else True if target.N in transit_only_nodes_df.N.to_list() else False
+        source_is_transit_bool = source.N in transit_only_nodes['cols']['N']
+        target_is_transit_bool = target.N in transit_only_nodes['cols']['N']
         if source_is_transit_bool and not target_is_transit_bool: # only source is transit-only
             inter_shp_points_gap_df = shp_points_gap_df[(~shp_points_gap_df.NEAR_NET_NODE.isnull()) & (shp_points_gap_df.NEAR_NET_NODE != A)]
             if inter_shp_points_gap_df.shape[0] != 0:
                 intermediary_net_node_ind = inter_shp_points_gap_df.index[0]
                 shp_points_gap_df = shp_points_gap_df.loc[:intermediary_net_node_ind]
                 B = int(shp_points_gap_df.loc[intermediary_net_node_ind,'NEAR_NET_NODE'])
-                target = nodes_within_shp_df.loc[nodes_within_shp_df.N == B].iloc[0]
+                target = find_node_within_shp(B, nodes_within_shp_df, new_nodes_within_shp)
         elif not source_is_transit_bool and target_is_transit_bool: # only target is transit-only
             inter_shp_points_gap_df = shp_points_gap_df[(~shp_points_gap_df.NEAR_NET_NODE.isnull()) & (shp_points_gap_df.NEAR_NET_NODE != B)]
             if inter_shp_points_gap_df.shape[0] != 0:
                 intermediary_net_node_ind = inter_shp_points_gap_df.index[-1]
                 shp_points_gap_df = shp_points_gap_df.loc[intermediary_net_node_ind:]
                 A = int(shp_points_gap_df.loc[intermediary_net_node_ind,'NEAR_NET_NODE'])
-                source = nodes_within_shp_df.loc[nodes_within_shp_df.N == A].iloc[0]
+                source = find_node_within_shp(A, nodes_within_shp_df, new_nodes_within_shp)
     new_link = LineString([source.geometry] + shp_points_gap_df.geometry.to_list() + [target.geometry])
     full_link = LineString([source.geometry] + shp_points_gap_full_df.geometry.to_list() + [target.geometry])
     return A, B, new_link, full_link
 
-def create_node_seq(G, line_stops, transit_only_nodes_df, transit_only_links_df, transit_only_attributes, shp_id_line, nodes_within_shp_df, new_nodes_from, w_bffr, gtfs_stop_times_df, gtfs_stops_df, route_trip_id):
+@profiled
+def create_node_seq(G, line_stops, transit_only_nodes, transit_only_links, transit_only_attributes, shp_id_line, nodes_within_shp_df, new_nodes_from, w_bffr):
     line_node_seq = list()
-    shp_distances = np.arange(0, shp_id_line.length, 30)
-    shp_points = MultiPoint([shp_id_line.interpolate(d) for d in shp_distances] + [Point(np.array(shp_id_line.coords)[-1])])
-    shp_nodes = gpd.GeoDataFrame({'N':[p for p in range(len(shp_points.geoms))], 'X':[p.x for p in shp_points.geoms], 'Y':[p.y for p in shp_points.geoms], 'geometry':[shp_points.geoms[p] for p in range(len(shp_points.geoms))]})
+    nodes_within_shp_n = set(nodes_within_shp_df.N.to_list())
+    nodes_within_shp_sindex = create_nodes_sindex(nodes_within_shp_df) # the nodes within the shape do not change, one index for all gaps
+    new_nodes_within_shp = list() # source and target of the new links, seen by the next gaps without growing nodes_within_shp_df
+    shp_points_xy = densify_line(shp_id_line, 30)
+    shp_start = 0
     for ind in range(0, line_stops.shape[0]-1):
         source = line_stops.loc[ind]
         target = line_stops.loc[ind+1]
@@ -256,138 +1076,601 @@ def create_node_seq(G, line_stops, transit_only_nodes_df, transit_only_links_df,
         if not pd.isnull(source.N) and not pd.isnull(target.N): # both nodes exist
             if int(source.N) == int(target.N):
                 continue
-            if nx.has_path(G, source=source.N, target=target.N): # with connection
-                line_node_seq = add_nodes_to_seq(G, source, target, line_node_seq)
+            stops_node_seq = find_shortest_path(G, source.N, target.N)
+            if stops_node_seq is not None: # with connection
+                line_node_seq = add_nodes_to_seq(stops_node_seq, line_node_seq)
             else: # without connection
-                shp_points_gap_df, shp_nodes, near_point_to_source, near_point_to_target = find_near_shp_points_to_source_target(shp_nodes, source, target)
+                shp_points_gap_df, shp_start, near_point_to_source, near_point_to_target = locate_gap_on_shp(shp_points_xy, shp_start, source, target)
                 
-                A, B, new_link, full_link = create_new_link(source, target, transit_only_nodes_df, nodes_within_shp_df, shp_points_gap_df)
-                A, B, new_link, G = test_new_link(G, A, B, source, target, new_link, full_link)
-
-                nodes_within_shp_df = update_nodes_when_new_link(nodes_within_shp_df, source)
-                nodes_within_shp_df = update_nodes_when_new_link(nodes_within_shp_df, target)
-                transit_only_links_df = append_transit_only_links(transit_only_links_df, {'A':A, 'B':B, 'geometry':new_link}, transit_only_attributes)
-                transit_only_links_df = append_transit_only_links(transit_only_links_df, {'A':B, 'B':A, 'geometry':LineString(list(new_link.coords)[::-1])}, transit_only_attributes)
-                line_node_seq = add_nodes_to_seq(G, source, target, line_node_seq)
+                A, B, new_link, full_link = create_new_link(source, target, transit_only_nodes, nodes_within_shp_df, nodes_within_shp_sindex, new_nodes_within_shp, shp_points_gap_df)
+                A, B, new_link, G, stops_node_seq = test_new_link(G, A, B, source, target, new_link, full_link)
+
+                new_nodes_within_shp.append({'N':source.N, 'geometry':source.geometry})
+                new_nodes_within_shp.append({'N':target.N, 'geometry':target.geometry})
+                nodes_within_shp_n |= {source.N, target.N}
+                transit_only_links = append_transit_only_links(transit_only_links, {'A':A, 'B':B, 'geometry':new_link}, transit_only_attributes)
+                transit_only_links = append_transit_only_links(transit_only_links, {'A':B, 'B':A, 'geometry':LineString(list(new_link.coords)[::-1])}, transit_only_attributes)
+                line_node_seq = add_nodes_to_seq(stops_node_seq, line_node_seq)
         elif pd.isnull(source.N) and not pd.isnull(target.N): # source does not exist
-            shp_points_gap_df, shp_nodes, near_point_to_source, near_point_to_target = find_near_shp_points_to_source_target(shp_nodes, source, target)
+            shp_points_gap_df, shp_start, near_point_to_source, near_point_to_target = locate_gap_on_shp(shp_points_xy, shp_start, source, target)
             
             new_node = {'N': new_nodes_from, # projecting stop to route shape
                         'X': shp_points_gap_df.loc[shp_points_gap_df.N == near_point_to_source, 'X'].values[0], 
                         'Y': shp_points_gap_df.loc[shp_points_gap_df.N == near_point_to_source, 'Y'].values[0], 
                         'geometry': shp_points_gap_df.loc[shp_points_gap_df.N == near_point_to_source, 'geometry'].values[0]}
-            transit_only_nodes_df = append_transit_only_nodes(transit_only_nodes_df, new_node, transit_only_attributes)
+            transit_only_nodes = append_transit_only_nodes(transit_only_nodes, new_node, transit_only_attributes)
             new_nodes_from += 1
             line_stops.loc[ind, 'N'] = new_node['N']
             source = line_stops.loc[ind]
             source['geometry'] = new_node['geometry'] # update new geometry of the projected stop to the route
-            G.add_nodes_from([(new_node['N'], {'pos':(new_node['X'], new_node['Y'])})])
             
-            A, B, new_link, full_link = create_new_link(source, target, transit_only_nodes_df, nodes_within_shp_df, shp_points_gap_df)
-            A, B, new_link, G = test_new_link(G, A, B, source, target, new_link, full_link)
+            A, B, new_link, full_link = create_new_link(source, target, transit_only_nodes, nodes_within_shp_df, nodes_within_shp_sindex, new_nodes_within_shp, shp_points_gap_df)
+            A, B, new_link, G, stops_node_seq = test_new_link(G, A, B, source, target, new_link, full_link)
 
-            nodes_within_shp_df = update_nodes_when_new_link(nodes_within_shp_df, source)
-            transit_only_links_df = append_transit_only_links(transit_only_links_df, {'A':A, 'B':B, 'geometry':new_link}, transit_only_attributes)
-            transit_only_links_df = append_transit_only_links(transit_only_links_df, {'A':B, 'B':A, 'geometry':LineString(list(new_link.coords)[::-1])}, transit_only_attributes)
-            line_node_seq = add_nodes_to_seq(G, source, target, line_node_seq)
+            new_nodes_within_shp.append({'N':source.N, 'geometry':source.geometry})
+            nodes_within_shp_n.add(source.N)
+            transit_only_links = append_transit_only_links(transit_only_links, {'A':A, 'B':B, 'geometry':new_link}, transit_only_attributes)
+            transit_only_links = append_transit_only_links(transit_only_links, {'A':B, 'B':A, 'geometry':LineString(list(new_link.coords)[::-1])}, transit_only_attributes)
+            line_node_seq = add_nodes_to_seq(stops_node_seq, line_node_seq)
         elif not pd.isnull(source.N) and pd.isnull(target.N): # target does not exist
-            shp_points_gap_df, shp_nodes, near_point_to_source, near_point_to_target = find_near_shp_points_to_source_target(shp_nodes, source, target)
+            shp_points_gap_df, shp_start, near_point_to_source, near_point_to_target = locate_gap_on_shp(shp_points_xy, shp_start, source, target)
             new_node = {'N': new_nodes_from, # projecting stop to route shape
                         'X': shp_points_gap_df.loc[shp_points_gap_df.N == near_point_to_target, 'X'].values[0], 
                         'Y': shp_points_gap_df.loc[shp_points_gap_df.N == near_point_to_target, 'Y'].values[0], 
                         'geometry': shp_points_gap_df.loc[shp_points_gap_df.N == near_point_to_target, 'geometry'].values[0]}
-            transit_only_nodes_df = append_transit_only_nodes(transit_only_nodes_df, new_node, transit_only_attributes)
+            transit_only_nodes = append_transit_only_nodes(transit_only_nodes, new_node, transit_only_attributes)
             new_nodes_from += 1
             line_stops.loc[ind+1, 'N'] = new_node['N']
             target = line_stops.loc[ind+1]
             target['geometry'] = new_node['geometry'] # update new geometry of the projected stop to the route
-            G.add_nodes_from([(new_node['N'], {'pos':(new_node['X'], new_node['Y'])})])
             
-            A, B, new_link, full_link = create_new_link(source, target, transit_only_nodes_df, nodes_within_shp_df, shp_points_gap_df)
-            A, B, new_link, G = test_new_link(G, A, B, source, target, new_link, full_link)
+            A, B, new_link, full_link = create_new_link(source, target, transit_only_nodes, nodes_within_shp_df, nodes_within_shp_sindex, new_nodes_within_shp, shp_points_gap_df)
+            A, B, new_link, G, stops_node_seq = test_new_link(G, A, B, source, target, new_link, full_link)
 
-            nodes_within_shp_df = update_nodes_when_new_link(nodes_within_shp_df, target)
-            transit_only_links_df = append_transit_only_links(transit_only_links_df, {'A':A, 'B':B, 'geometry':new_link}, transit_only_attributes)
-            transit_only_links_df = append_transit_only_links(transit_only_links_df, {'A':B, 'B':A, 'geometry':LineString(list(new_link.coords)[::-1])}, transit_only_attributes)
-            line_node_seq = add_nodes_to_seq(G, source, target, line_node_seq)
+            new_nodes_within_shp.append({'N':target.N, 'geometry':target.geometry})
+            nodes_within_shp_n.add(target.N)
+            transit_only_links = append_transit_only_links(transit_only_links, {'A':A, 'B':B, 'geometry':new_link}, transit_only_attributes)
+            transit_only_links = append_transit_only_links(transit_only_links, {'A':B, 'B':A, 'geometry':LineString(list(new_link.coords)[::-1])}, transit_only_attributes)
+            line_node_seq = add_nodes_to_seq(stops_node_seq, line_node_seq)
         elif pd.isnull(source.N) and pd.isnull(target.N): # neither source or target exist
-            shp_points_gap_df, shp_nodes, near_point_to_source, near_point_to_target = find_near_shp_points_to_source_target(shp_nodes, source, target)
+            shp_points_gap_df, shp_start, near_point_to_source, near_point_to_target = locate_gap_on_shp(shp_points_xy, shp_start, source, target)
             
             new_node = {'N': new_nodes_from, # projecting stop to route shape
                         'X': shp_points_gap_df.loc[shp_points_gap_df.N == near_point_to_source, 'X'].values[0], 
                         'Y': shp_points_gap_df.loc[shp_points_gap_df.N == near_point_to_source, 'Y'].values[0], 
                         'geometry': shp_points_gap_df.loc[shp_points_gap_df.N == near_point_to_source, 'geometry'].values[0]}
-            transit_only_nodes_df = append_transit_only_nodes(transit_only_nodes_df, new_node, transit_only_attributes)
+            transit_only_nodes = append_transit_only_nodes(transit_only_nodes, new_node, transit_only_attributes)
             new_nodes_from += 1
             line_stops.loc[ind, 'N'] = new_node['N']
             source = line_stops.loc[ind]
             source['geometry'] = new_node['geometry'] # update new geometry of the projected stop to the route
-            G.add_nodes_from([(new_node['N'], {'pos':(new_node['X'], new_node['Y'])})])
             
             new_node = {'N': new_nodes_from, # projecting stop to route shape
                         'X': shp_points_gap_df.loc[shp_points_gap_df.N == near_point_to_target, 'X'].values[0], 
                         'Y': shp_points_gap_df.loc[shp_points_gap_df.N == near_point_to_target, 'Y'].values[0], 
                         'geometry': shp_points_gap_df.loc[shp_points_gap_df.N == near_point_to_target, 'geometry'].values[0]}
-            transit_only_nodes_df = append_transit_only_nodes(transit_only_nodes_df, new_node, transit_only_attributes)
+            transit_only_nodes = append_transit_only_nodes(transit_only_nodes, new_node, transit_only_attributes)
             new_nodes_from += 1
             line_stops.loc[ind+1, 'N'] = new_node['N']
             target = line_stops.loc[ind+1]
             target['geometry'] = new_node['geometry'] # update new geometry of the projected stop to the route
-            G.add_nodes_from([(new_node['N'], {'pos':(new_node['X'], new_node['Y'])})])
             
-            A, B, new_link, full_link = create_new_link(source, target, transit_only_nodes_df, nodes_within_shp_df, shp_points_gap_df)
-            A, B, new_link, G = test_new_link(G, A, B, source, target, new_link, full_link)
-
-            nodes_within_shp_df = update_nodes_when_new_link(nodes_within_shp_df, source)
-            nodes_within_shp_df = update_nodes_when_new_link(nodes_within_shp_df, target)
-            transit_only_links_df = append_transit_only_links(transit_only_links_df, {'A':A, 'B':B, 'geometry':new_link}, transit_only_attributes)
-            transit_only_links_df = append_transit_only_links(transit_only_links_df, {'A':B, 'B':A, 'geometry':LineString(list(new_link.coords)[::-1])}, transit_only_attributes)
-            line_node_seq = add_nodes_to_seq(G, source, target, line_node_seq)
+            A, B, new_link, full_link = create_new_link(source, target, transit_only_nodes, nodes_within_shp_df, nodes_within_shp_sindex, new_nodes_within_shp, shp_points_gap_df)
+            A, B, new_link, G, stops_node_seq = test_new_link(G, A, B, source, target, new_link, full_link)
+
+            new_nodes_within_shp.append({'N':source.N, 'geometry':source.geometry})
+            new_nodes_within_shp.append({'N':target.N, 'geometry':target.geometry})
+            nodes_within_shp_n |= {source.N, target.N}
+            transit_only_links = append_transit_only_links(transit_only_links, {'A':A, 'B':B, 'geometry':new_link}, transit_only_attributes)
+            transit_only_links = append_transit_only_links(transit_only_links, {'A':B, 'B':A, 'geometry':LineString(list(new_link.coords)[::-1])}, transit_only_attributes)
+            line_node_seq = add_nodes_to_seq(stops_node_seq, line_node_seq)
         # Before creating new nodes for the nodes with None values, search for them in the transit-only nodes
-        line_stops = match_stops_and_transit_nodes(line_stops, transit_only_nodes_df, gtfs_stop_times_df, gtfs_stops_df, nodes_within_shp_df, route_trip_id)
+        line_stops = match_stops_and_transit_nodes(line_stops, transit_only_nodes, nodes_within_shp_n)
     line_node_seq = [int(n) for n in line_node_seq]
-    return line_node_seq, G, line_stops, transit_only_nodes_df, transit_only_links_df, new_nodes_from
+    return line_node_seq, G, line_stops, transit_only_nodes, transit_only_links, new_nodes_from
 
+@profiled
 def create_node_and_link_seq_gdf(line_node_seq, line_stops, nodes_within_shp_df, links_within_shp_df, transit_only_nodes_df, transit_only_links_df):
     if transit_only_nodes_df.shape[0] != 0:
-        nodes_within_shp_df = update_nodes_when_new_link(nodes_within_shp_df, transit_only_nodes_df[~transit_only_nodes_df.N.isin(nodes_within_shp_df.N.to_list())])
+        nodes_within_shp_df = update_nodes_when_new_link(nodes_within_shp_df, transit_only_nodes_df[~isin_keys(transit_only_nodes_df.N, create_keys_index(nodes_within_shp_df.N))])
     line_node_seq_df = gpd.GeoDataFrame(pd.DataFrame({'N':line_node_seq}).merge(pd.DataFrame(nodes_within_shp_df), how='left'))
     if transit_only_links_df.shape[0] != 0:
-        links_within_shp_df = update_links_when_new_link(links_within_shp_df, transit_only_links_df[~transit_only_links_df.AB.isin(links_within_shp_df.AB.to_list())])
+        links_within_shp_df = update_links_when_new_link(links_within_shp_df, transit_only_links_df[~isin_keys(transit_only_links_df.AB, create_keys_index(links_within_shp_df.AB))])
     line_link_seq_df = gpd.GeoDataFrame(pd.DataFrame({'A':line_node_seq[:-1], 'B':line_node_seq[1:]}).merge(pd.DataFrame(links_within_shp_df), how='left'))
     
-    # Set stop nodes to negative
-    line_node_seq_df['N'] = line_node_seq_df['N'].apply(lambda x: abs(x) * (-1) if x not in line_stops.N.to_list() else x)
-    line_link_seq_df['A'] = line_link_seq_df['A'].apply(lambda x: abs(x) * (-1) if x not in line_stops.N.to_list() else x)
-    line_link_seq_df['B'] = line_link_seq_df['B'].apply(lambda x: abs(x) * (-1) if x not in line_stops.N.to_list() else x)
+    # Set non-stop nodes to negative
+    stop_nodes = create_keys_index(line_stops.N.dropna())
+    line_node_seq_df['N'] = np.where(isin_keys(line_node_seq_df.N, stop_nodes), line_node_seq_df.N, -abs(line_node_seq_df.N))
+    line_link_seq_df['A'] = np.where(isin_keys(line_link_seq_df.A, stop_nodes), line_link_seq_df.A, -abs(line_link_seq_df.A))
+    line_link_seq_df['B'] = np.where(isin_keys(line_link_seq_df.B, stop_nodes), line_link_seq_df.B, -abs(line_link_seq_df.B))
     return line_node_seq_df, line_link_seq_df
 
-def update_nodes_links_with_transit_only(nodes_df, links_df, transit_only_nodes_df, transit_only_links_df):
-    nodes_df, links_df, transit_only_nodes_df, transit_only_links_df = nodes_df.copy(), links_df.copy(), transit_only_nodes_df.copy(), transit_only_links_df.copy()
+def new_transit_only_nodes_links(base_network, transit_only_nodes_df, transit_only_links_df):
+    # Transit-only nodes and links not in the whole base network, added to its outputs (None if there is no transit-only node or link)
+    new_nodes_df, new_links_df = None, None
     if transit_only_nodes_df.shape[0] != 0:
-        nodes_cols = transit_only_nodes_df.columns.to_list()
-        nodes_df = update_nodes_when_new_link(nodes_df, transit_only_nodes_df[~transit_only_nodes_df.N.isin(nodes_df.N.to_list())], nodes_cols)
+        new_nodes_df = transit_only_nodes_df[~isin_keys(transit_only_nodes_df.N, create_keys_index(base_network['N']))]
     if transit_only_links_df.shape[0] != 0:
-        links_df['AB'] = abs(links_df.A).astype('int').astype('str') + '_' + abs(links_df.B).astype('int').astype('str')
-        links_cols = transit_only_links_df.columns.to_list()
-        links_df = update_links_when_new_link(links_df, transit_only_links_df[~transit_only_links_df.AB.isin(links_df.AB.to_list())], links_cols)
-    return nodes_df, links_df
+        new_links_df = transit_only_links_df[~isin_keys(transit_only_links_df.AB, create_keys_index(base_network['AB']))]
+    return new_nodes_df, new_links_df
+
+def update_nodes_with_transit_only(nodes_df, new_nodes_df):
+    if new_nodes_df is not None:
+        nodes_df = update_nodes_when_new_link(nodes_df, new_nodes_df, new_nodes_df.columns.to_list())
+    return nodes_df
 
-def append_transit_only_nodes(transit_only_nodes_df, transit_only_nodes, transit_only_attributes):
-    transit_only_nodes_df = transit_only_nodes_df.append(pd.DataFrame(transit_only_nodes, index=[0]))
-    return transit_only_nodes_df
-
-def append_transit_only_links(transit_only_links_df, transit_only_links, transit_only_attributes):
-    transit_only_links_temp_df = pd.DataFrame(transit_only_links, index=[0])
-    for att in transit_only_attributes:
-        transit_only_links_temp_df[att] = transit_only_attributes[att]
-    transit_only_links_temp_df['DIST'] = transit_only_links_temp_df.geometry.apply(lambda x: x.length/5280)
-    transit_only_links_temp_df['AB'] = abs(transit_only_links_temp_df.A).astype('int').astype('str') + '_' + abs(transit_only_links_temp_df.B).astype('int').astype('str')
-    transit_only_links_temp_df = transit_only_links_temp_df[['A','B','AB','DIST'] + list(transit_only_attributes.keys()) + ['geometry']]
-    transit_only_links_df = transit_only_links_df.append(transit_only_links_temp_df)
+def update_links_with_transit_only(links_df, new_links_df):
+    if new_links_df is not None:
+        links_df = links_df.copy()
+        links_df['AB'] = ab_keys(links_df.A, links_df.B)
+        links_df = update_links_when_new_link(links_df, new_links_df, new_links_df.columns.to_list())
+        links_df['AB'] = ab_strings(links_df.AB) # "A_B" attribute of the outputs
+    return links_df
+
+def ab_keys(A, B):
+    # Link identity: node IDs |A| and |B| (below 2**32) packed in one int64 key, used for link membership tests and joins
+    return (np.abs(np.asarray(A, dtype='int64')) << 32) | np.abs(np.asarray(B, dtype='int64'))
+
+def ab_key(A, B):
+    return (abs(int(A)) << 32) | abs(int(B))
+
+def ab_strings(ab):
+    ab = np.asarray(ab, dtype='int64')
+    return (pd.Series(ab >> 32).astype('str') + '_' + pd.Series(ab & 0xffffffff).astype('str')).to_numpy()
+
+def create_keys_index(keys):
+    # Membership index of node IDs or link keys: sorted unique int64 array, searched by bisection in isin_keys
+    return np.unique(np.asarray(keys, dtype='int64'))
+
+def isin_keys(keys, keys_index):
+    keys = np.asarray(keys, dtype='int64')
+    if keys_index.shape[0] == 0:
+        return np.zeros(keys.shape[0], dtype=bool)
+    return keys_index[np.minimum(np.searchsorted(keys_index, keys), keys_index.shape[0] - 1)] == keys
+
+def transit_only_keys(transit_only):
+    # Membership index of the transit-only nodes (N) or links (AB), cached until the next append
+    if transit_only['keys'] is None:
+        transit_only['keys'] = create_keys_index(transit_only['cols']['AB' if 'AB' in transit_only['cols'] else 'N'])
+    return transit_only['keys']
+
+def create_transit_only_store(cols):
+    # Transit-only nodes or links kept as one growable list per column (amortized O(1) appends).
+    # 'gdf' caches the geodataframe view and 'keys' the membership index until the next append. 'sindex' is the links spatial index
+    # that new links are inserted into and 'stops_registry' the nodes near each stop (get_stops_registry)
+    return {'cols':{c:list() for c in cols}, 'gdf':None, 'keys':None, 'sindex':None, 'stops_registry':None}
+
+def create_transit_only_nodes():
+    return create_transit_only_store(['N','X','Y','geometry'])
+
+def create_transit_only_links(transit_only_attributes):
+    return create_transit_only_store(['A','B','AB','DIST'] + list(transit_only_attributes.keys()) + ['geometry'])
+
+def transit_only_gdf(transit_only):
+    if transit_only['gdf'] is None:
+        transit_only['gdf'] = gpd.GeoDataFrame(pd.DataFrame(transit_only['cols']))
+    return transit_only['gdf']
+
+@profiled
+def create_network_overlay(nodes_df, links_df, links_sindex, transit_only_nodes, transit_only_links):
+    # Cleaned network as an immutable base layer plus the transit-only stores as a delta layer.
+    # Both layers are queried together without merging them into a copy of the network
+    if nodes_df.shape[0] != 0 and np.abs(nodes_df.N.to_numpy(dtype='int64')).max() >= 2**32:
+        raise Exception(f'Node IDs must be below {2**32} to be packed in link keys.')
+    links_ab = create_keys_index(ab_keys(links_df.A, links_df.B))
+    transit_only_links['sindex'] = links_sindex
+    for link_pos, link_geom in enumerate(transit_only_links['cols']['geometry']):
+        insert_transit_only_link_sindex(links_sindex, link_pos, link_geom)
+    return {'nodes':nodes_df, 'links':links_df, 'links_geoms':links_df.geometry.values, 'links_ab':links_ab, 'links_sindex':links_sindex, 'routing_graph':create_routing_graph(links_df),
+            'path_cache':create_path_cache(), 'transit_only_nodes':transit_only_nodes, 'transit_only_links':transit_only_links}
+
+def overlay_transit_only_links(network):
+    # Transit-only links not coded in the base layer (first link created for each AB)
+    transit_only_links_df = transit_only_gdf(network['transit_only_links'])
+    if transit_only_links_df.shape[0] != 0:
+        transit_only_links_df = transit_only_links_df[~isin_keys(transit_only_links_df.AB, network['links_ab'])].drop_duplicates(subset=['AB'])
+        transit_only_links_df = transit_only_links_df.set_crs(network['links'].crs, allow_override=True)
     return transit_only_links_df
 
-def plot(scen_dir, shp_id_df, gtfs_trips_df, line_node_seq_df, line_link_seq_df, links_intersecting_shp_df, transit_only_nodes_df, transit_only_links_df, w_bffr, i_bffr, title, figsize=(20,20)):
+@profiled
+def sjoin_overlay_links(network, shp_buffer_df, predicate):
+    # Same as gpd.sjoin(links, shp_buffer_df, how='inner', predicate=predicate) on both layers, answered by the persistent links spatial index
+    transit_only_links_df = overlay_transit_only_links(network)
+    links_shp_df, transit_only_links_shp_df = list(), list()
+    for index_right, shp_buffer in shp_buffer_df.iterrows():
+        base_pos, transit_only_pos = query_links_sindex(network['links_sindex'], network['links_geoms'], shp_buffer.geometry, predicate)
+        links_shp_df.append(join_shp_buffer(network['links'].iloc[base_pos], shp_buffer, index_right))
+        if transit_only_links_df.shape[0] != 0:
+            transit_only_shp_df = transit_only_links_df[transit_only_links_df.index.isin(transit_only_pos)]
+            transit_only_shp_df = transit_only_shp_df[transit_only_shp_df.geometry.apply(test_links_predicate(shp_buffer.geometry, predicate))]
+            transit_only_links_shp_df.append(join_shp_buffer(transit_only_shp_df, shp_buffer, index_right))
+    links_shp_df = pd.concat(links_shp_df)
+    if transit_only_links_df.shape[0] != 0:
+        links_shp_df = pd.concat([links_shp_df] + transit_only_links_shp_df, ignore_index=True)
+    return links_shp_df
+
+def join_shp_buffer(links_shp_df, shp_buffer, index_right):
+    # Add the buffer attributes to the links found, as gpd.sjoin does
+    links_shp_df = links_shp_df.copy()
+    links_shp_df['index_right'] = index_right
+    for c in shp_buffer.index.drop('geometry'):
+        links_shp_df[c] = shp_buffer[c]
+    return links_shp_df
+
+@profiled
+def find_overlay_nodes_within_shp(network, links, shapes):
+    nodes_within_shp_df = find_nodes_within_shp(network['nodes'], links, shapes)
+    transit_only_nodes_df = transit_only_gdf(network['transit_only_nodes'])
+    if transit_only_nodes_df.shape[0] != 0:
+        nodes_cols = transit_only_nodes_df.columns.to_list()
+        nodes_within_shp_df = update_nodes_when_new_link(nodes_within_shp_df, find_nodes_within_shp(transit_only_nodes_df, links, shapes), nodes_cols)
+    return nodes_within_shp_df
+
+@profiled
+def match_shp_to_network(shp_id, shp_id_index, network, transit_only_nodes, transit_only_links, transit_only_attributes, new_nodes_from, w_bffr, i_bffr, gtfs_stop_times_df, gtfs_stops_df):
+    # Match one shape ID to the network overlay. New transit-only nodes and links are appended to transit_only_nodes and transit_only_links
+    shp_id_df = shp_id_index['shape_df']
+    shp_id_line = shp_id_index['line']
+    route_trip_id = shp_id_index['route_trip_id']
+    
+    # Transit-only nodes and links visible in the network overlay
+    transit_only_nodes_df, transit_only_links_df = transit_only_gdf(network['transit_only_nodes']), transit_only_gdf(network['transit_only_links'])
+    
+    # Find links within route shape and intersecting route shape
+    shp_id_line_buffer_w = gpd.GeoDataFrame({'shp_id':shp_id, 'geometry':[shp_id_line.buffer(w_bffr, cap_style=3)]}, crs=shp_id_df.crs)
+    links_within_shp_df = sjoin_overlay_links(network, shp_id_line_buffer_w, 'within')
+    links_within_shp_df['AB'] = ab_keys(links_within_shp_df.A, links_within_shp_df.B)
+    links_within_shp_no_transit_df = links_within_shp_df[~isin_keys(links_within_shp_df.AB, transit_only_keys(network['transit_only_links']))] if transit_only_links_df.shape[0] != 0 else links_within_shp_df
+    shp_id_line_buffer_i = gpd.GeoDataFrame({'shp_id':shp_id, 'geometry':[shp_id_line.buffer(i_bffr)]}, crs=shp_id_df.crs)
+    links_intersecting_shp_df = sjoin_overlay_links(network, shp_id_line_buffer_i, 'intersects')
+    links_intersecting_shp_df['AB'] = ab_keys(links_intersecting_shp_df.A, links_intersecting_shp_df.B)
+    links_intersecting_shp_no_transit_df = links_intersecting_shp_df[~isin_keys(links_intersecting_shp_df.AB, transit_only_keys(network['transit_only_links']))] if transit_only_links_df.shape[0] != 0 else links_intersecting_shp_df
+    
+    # Find nodes within route shape
+    nodes_within_shp_df = find_overlay_nodes_within_shp(network, links_within_shp_df, shp_id_df)
+    nodes_within_shp_no_transit_df = nodes_within_shp_df[~isin_keys(nodes_within_shp_df.N, transit_only_keys(network['transit_only_nodes']))] if transit_only_nodes_df.shape[0] != 0 else nodes_within_shp_df
+    
+    # Line's stops matched to nodes
+    line_stops = match_stops_and_nodes(gtfs_stop_times_df, gtfs_stops_df, nodes_within_shp_no_transit_df, route_trip_id)
+    
+    # Set node to None if stop not within original network links
+    links_within_shp_buffer_df = gpd.GeoDataFrame({'geometry':[link.buffer(w_bffr, cap_style=3) for link in links_within_shp_no_transit_df.geometry]}, crs=shp_id_df.crs)
+    stops_within_links_df = gpd.sjoin(line_stops, links_within_shp_buffer_df, how='inner', predicate='within').sort_values(by='stop_sequence').drop_duplicates(subset=['stop_sequence'])
+    line_stops.loc[~isin_keys(line_stops.stop_sequence, create_keys_index(stops_within_links_df.stop_sequence)), 'N'] = None
+    
+    # Before creating new nodes for the nodes with None values, search for them in the transit-only nodes
+    line_stops = match_stops_and_transit_nodes(line_stops, network['transit_only_nodes'], set(nodes_within_shp_df.N.to_list()))
+    profile_count('unmatched_stops', int(line_stops.N.isnull().sum())) # stops without network or transit-only node, new nodes are created for them
+    
+    # Routing graph restricted to the links within the shape
+    G = create_shp_graph(network['routing_graph'], links_within_shp_df, network['path_cache'])
+    profile_count('stops', line_stops.shape[0])
+    profile_count('graph_nodes', nodes_within_shp_df.shape[0])
+    profile_count('graph_links', G['mask'].count(1) + sum(len(B) for B in G['extra'].values()))
+    
+    # Create node and link sequence
+    created_pos = (len(transit_only_nodes['cols']['N']), len(transit_only_links['cols']['A']))
+    line_node_seq, G, line_stops, transit_only_nodes, transit_only_links, new_nodes_from = create_node_seq(G, line_stops, transit_only_nodes, transit_only_links, transit_only_attributes, shp_id_line, nodes_within_shp_df, new_nodes_from, w_bffr)
+    profile_count('transit_only_nodes_created', len(transit_only_nodes['cols']['N']) - created_pos[0])
+    profile_count('transit_only_links_created', len(transit_only_links['cols']['A']) - created_pos[1])
+    transit_only_nodes_df, transit_only_links_df = transit_only_gdf(transit_only_nodes), transit_only_gdf(transit_only_links)
+    line_node_seq_df, line_link_seq_df = create_node_and_link_seq_gdf(line_node_seq, line_stops, nodes_within_shp_df, links_within_shp_df, transit_only_nodes_df, transit_only_links_df)
+    return line_node_seq_df, line_link_seq_df, links_intersecting_shp_no_transit_df, transit_only_nodes, transit_only_links, new_nodes_from
+
+# Read-only inputs of the parallel workers, set once per worker process by init_parallel_worker
+parallel_context = dict()
+
+def init_parallel_worker(nodes_df, links_df, transit_only_attributes, new_nodes_from, w_bffr, i_bffr, gtfs_stop_times_df, gtfs_stops_df, plot_bool, profile_bool=0):
+    # Each worker matches shapes against the base network only (empty transit-only layer), so the results do not depend on scheduling
+    start_profile() if profile_bool == 1 else stop_profile()
+    parallel_context['network'] = create_network_overlay(nodes_df, links_df, create_links_sindex(links_df), create_transit_only_nodes(), create_transit_only_links(transit_only_attributes))
+    parallel_context['args'] = (transit_only_attributes, new_nodes_from, w_bffr, i_bffr, gtfs_stop_times_df, gtfs_stops_df)
+    parallel_context['plot_bool'] = plot_bool
+
+def match_shp_parallel_worker(shp_id, shp_id_index):
+    # Transit-only node IDs are provisional (from new_nodes_from on) until merge_parallel_shps
+    transit_only_attributes = parallel_context['args'][0]
+    transit_only_nodes, transit_only_links = create_transit_only_nodes(), create_transit_only_links(transit_only_attributes)
+    path_cache = parallel_context['network']['path_cache'] # path cache of the worker, its counts for the shape ID are sent back
+    path_cache_counts = (path_cache['hits'], path_cache['misses'])
+    start_profile_shp(shp_id)
+    line_node_seq_df, line_link_seq_df, links_intersecting_shp_df, transit_only_nodes, transit_only_links, _ = match_shp_to_network(shp_id, shp_id_index, parallel_context['network'], transit_only_nodes, transit_only_links, *parallel_context['args'])
+    shp_result = {'shp_id':shp_id, 'node_seq':line_node_seq_df.N.to_list(), 'transit_only_nodes':transit_only_nodes['cols'], 'transit_only_links':transit_only_links['cols'],
+                  'path_cache':{'hits':path_cache['hits'] - path_cache_counts[0], 'misses':path_cache['misses'] - path_cache_counts[1]}, 'profile':end_profile_shp()}
+    if parallel_context['plot_bool'] == 1:
+        shp_result['plot'] = (line_node_seq_df, line_link_seq_df, links_intersecting_shp_df)
+    return shp_result
+
+def match_shps_parallel(shp_ids, gtfs_shape_index, n_workers, nodes_df, links_df, transit_only_attributes, new_nodes_from, w_bffr, i_bffr, gtfs_stop_times_df, gtfs_stops_df, plot_bool=0, profile_bool=0):
+    # Results are yielded in the order of shp_ids whatever the order the workers finish, as soon as they are ready, so they can be
+    # merged while the next shapes are being matched
+    initargs = (nodes_df, links_df, transit_only_attributes, new_nodes_from, w_bffr, i_bffr, gtfs_stop_times_df, gtfs_stops_df, plot_bool, profile_bool)
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_parallel_worker, initargs=initargs) as executor:
+        yield from executor.map(match_shp_parallel_worker, shp_ids, [gtfs_shape_index[shp_id] for shp_id in shp_ids])
+
+def remap_node_ids(node_ids, ids_map):
+    # Keep the sign (negative for non-stop nodes) and the type (float when a stop is not matched), only remap the IDs found in ids_map
+    return [type(n)(np.sign(n) * ids_map[abs(n)]) if abs(n) in ids_map else n for n in node_ids]
+
+def insert_merged_transit_only_link(merged_sindex, merged_links, nodes_geoms, A, B, geometry):
+    # Transit-only link and its end nodes as seen by the next shapes of merge_parallel_shps
+    link = (geometry, nodes_geoms.get(abs(A)), nodes_geoms.get(abs(B)))
+    bounds = np.array([g.bounds for g in link if g is not None])
+    merged_sindex.insert(len(merged_links), (bounds[:,0].min(), bounds[:,1].min(), bounds[:,2].max(), bounds[:,3].max()))
+    merged_links.append(link)
+
+def read_merged_transit_only_link(shp_bffr_prep, link):
+    # Whether the serial match of a shape would read the link: the link is within the shape buffer, or both its end nodes are
+    # (a network link with the same AB would be within the buffer)
+    geometry, A_geom, B_geom = link
+    return shp_bffr_prep.contains(geometry) or (A_geom is not None and B_geom is not None and shp_bffr_prep.intersects(A_geom) and shp_bffr_prep.intersects(B_geom))
+
+@profiled
+def merge_parallel_shps(shp_results, network, transit_only_nodes, transit_only_links, transit_only_attributes, new_nodes_from, gtfs_shape_index, w_bffr, i_bffr, gtfs_stop_times_df, gtfs_stops_df, plot_bool=0):
+    # Merge the results of the workers (an iterable, see match_shps_parallel), in their order, as if the shapes had been matched one after the other (serial run).
+    # A worker matched its shape to the original network only, so its result is kept when the serial match would read no transit-only
+    # link already merged (read_merged_transit_only_link): its nodes and links are appended with the node IDs the serial run gives them
+    # (from new_nodes_from on). Otherwise the shape is matched again here, with the transit-only layer merged.
+    base_nodes_df = network['nodes'].drop_duplicates(subset=['N'])
+    nodes_geoms = dict(zip(base_nodes_df.N, base_nodes_df.geometry))
+    nodes_geoms.update(zip(transit_only_nodes['cols']['N'], transit_only_nodes['cols']['geometry']))
+    merged_sindex, merged_links = rtree.index.Index(), list()
+    for A, B, geometry in zip(transit_only_links['cols']['A'], transit_only_links['cols']['B'], transit_only_links['cols']['geometry']):
+        insert_merged_transit_only_link(merged_sindex, merged_links, nodes_geoms, A, B, geometry)
+    merged_results = list()
+    for shp_result in shp_results:
+        shp_id, shp_id_index = shp_result['shp_id'], gtfs_shape_index[shp_result['shp_id']]
+        nodes_pos, links_pos = len(transit_only_nodes['cols']['N']), len(transit_only_links['cols']['A'])
+        shp_id_bffr = shp_id_index['line'].buffer(w_bffr, cap_style=3)
+        shp_id_bffr_prep = prep(shp_id_bffr)
+        if any(read_merged_transit_only_link(shp_id_bffr_prep, merged_links[l]) for l in merged_sindex.intersection(shp_id_bffr.bounds)):
+            # Matched again in this process, its profile is the one of this match
+            start_profile_shp(shp_id)
+            line_node_seq_df, line_link_seq_df, links_intersecting_shp_df, transit_only_nodes, transit_only_links, new_nodes_from = match_shp_to_network(shp_id, shp_id_index, network, transit_only_nodes, transit_only_links, transit_only_attributes, new_nodes_from, w_bffr, i_bffr, gtfs_stop_times_df, gtfs_stops_df)
+            end_profile_shp()
+            shp_result = {'shp_id':shp_id, 'node_seq':line_node_seq_df.N.to_list(), 'ids_map':dict(), 'rematched':True, 'path_cache':shp_result['path_cache'], 'profile':None}
+            if plot_bool == 1:
+                shp_result['plot'] = (line_node_seq_df, line_link_seq_df, links_intersecting_shp_df)
+        else:
+            if plot_bool == 1: # links hidden by the transit-only links merged so far, as in the serial match
+                line_node_seq_df, line_link_seq_df, links_intersecting_shp_df = shp_result['plot']
+                links_intersecting_shp_df = links_intersecting_shp_df[~isin_keys(links_intersecting_shp_df.AB, transit_only_keys(transit_only_links))] if links_pos != 0 else links_intersecting_shp_df
+                shp_result['plot'] = (line_node_seq_df, line_link_seq_df, links_intersecting_shp_df)
+            ids_map = dict()
+            shp_nodes = shp_result['transit_only_nodes']
+            for N, X, Y, geometry in zip(shp_nodes['N'], shp_nodes['X'], shp_nodes['Y'], shp_nodes['geometry']):
+                ids_map[abs(int(N))] = new_nodes_from
+                transit_only_nodes = append_transit_only_nodes(transit_only_nodes, {'N':new_nodes_from, 'X':X, 'Y':Y, 'geometry':geometry}, transit_only_attributes)
+                new_nodes_from += 1
+            shp_links = shp_result['transit_only_links']
+            for A, B, geometry in zip(shp_links['A'], shp_links['B'], shp_links['geometry']):
+                A, B = remap_node_ids([A, B], ids_map)
+                transit_only_links = append_transit_only_links(transit_only_links, {'A':A, 'B':B, 'geometry':geometry}, transit_only_attributes)
+            shp_result['ids_map'] = ids_map
+            shp_result['node_seq'] = remap_node_ids(shp_result['node_seq'], ids_map)
+            shp_result['rematched'] = False
+        nodes_geoms.update(zip(transit_only_nodes['cols']['N'][nodes_pos:], transit_only_nodes['cols']['geometry'][nodes_pos:]))
+        for A, B, geometry in zip(transit_only_links['cols']['A'][links_pos:], transit_only_links['cols']['B'][links_pos:], transit_only_links['cols']['geometry'][links_pos:]):
+            insert_merged_transit_only_link(merged_sindex, merged_links, nodes_geoms, A, B, geometry)
+        shp_result['created_pos'] = (nodes_pos, links_pos) # Position in transit_only_nodes and transit_only_links of the first node and link merged
+        shp_result['created_end'] = (len(transit_only_nodes['cols']['N']), len(transit_only_links['cols']['A']))
+        merged_results.append(shp_result)
+    return merged_results, transit_only_nodes, transit_only_links, new_nodes_from
+
+def create_sweep_variants(w_bffrs, i_bffrs, factypes_to_avoid):
+    # All combinations of the buffers and facility types to avoid
+    return [{'w_bffr':w_bffr, 'i_bffr':i_bffr, 'factype_to_avoid':factype_to_avoid} for factype_to_avoid in factypes_to_avoid for w_bffr in w_bffrs for i_bffr in i_bffrs]
+
+# Read-only inputs of the sweep workers, set once per worker process by init_sweep_worker
+sweep_context = dict()
+
+def init_sweep_worker(context):
+    # With fork the context (GTFS, network, shape index) is shared with the main process, it is only copied to the workers with spawn (Windows)
+    sweep_context.update(context)
+
+def run_sweep_variant(variant):
+    # Match all shape IDs of sweep_context with the buffers and facility types to avoid of the variant, from an empty transit-only layer.
+    # Shape IDs of the same group (see group_duplicate_shps) are matched once. Returns the counts of the variant
+    t = time.perf_counter()
+    context = sweep_context
+    start_profile()
+    if variant['factype_to_avoid'] == context['factype_to_avoid']:
+        nodes_df, links_df = context['nodes_df'], context['links_df']
+        links_sindex = create_links_sindex(links_df, context['links_bounds'])
+    else:
+        nodes_df, links_df, links_sindex = net_cleaning(context['base_nodes_df'], context['base_links_df'], context['nodes_ranges_to_avoid'], variant['factype_to_avoid'])
+    transit_only_nodes, transit_only_links = create_transit_only_nodes(), create_transit_only_links(context['transit_only_attributes'])
+    network = create_network_overlay(nodes_df, links_df, links_sindex, transit_only_nodes, transit_only_links)
+    new_nodes_from = context['new_nodes_from']
+    group_results = dict()
+    for shp_id in context['shp_ids']:
+        group = context['shp_groups'][shp_id]
+        if group in group_results:
+            continue
+        unmatched_stops = run_profile['counters'].get('unmatched_stops', 0)
+        try:
+            line_node_seq_df, _, _, transit_only_nodes, transit_only_links, new_nodes_from = match_shp_to_network(shp_id, context['gtfs_shape_index'][shp_id], network, transit_only_nodes, transit_only_links, context['transit_only_attributes'], new_nodes_from, variant['w_bffr'], variant['i_bffr'], context['gtfs_stop_times_df'], context['gtfs_stops_df'])
+            group_results[group] = (line_node_seq_df.shape[0] != 0, run_profile['counters'].get('unmatched_stops', 0) - unmatched_stops, None)
+        except Exception as e:
+            group_results[group] = (False, run_profile['counters'].get('unmatched_stops', 0) - unmatched_stops, f'{shp_id}: {e}')
+    stop_profile()
+    shp_results = [group_results[context['shp_groups'][shp_id]] for shp_id in context['shp_ids']]
+    return dict(variant, factype_to_avoid=str(variant['factype_to_avoid']), lines=sum(r[0] for r in shp_results), skipped_lines=sum(not r[0] for r in shp_results),
+                errors=sum(r[2] is not None for r in shp_results), transit_only_nodes=len(transit_only_nodes['cols']['N']), transit_only_links=len(transit_only_links['cols']['A']),
+                unmatched_stops=sum(r[1] for r in shp_results), seconds=round(time.perf_counter() - t, 2), error_msgs=[r[2] for r in group_results.values() if r[2] is not None])
+
+@profiled
+def run_sweep(variants, n_workers, context):
+    # Variants run in parallel, each in one worker. Returns the comparison table (one row per variant, in the order of variants)
+    n_workers = n_workers if n_workers > 0 else min(len(variants), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_sweep_worker, initargs=(context,)) as executor:
+        sweep_results = list(executor.map(run_sweep_variant, variants))
+    for sweep_result in sweep_results:
+        for error_msg in sweep_result.pop('error_msgs'):
+            print(f"\tw_bffr={sweep_result['w_bffr']}, i_bffr={sweep_result['i_bffr']}, factype_to_avoid={sweep_result['factype_to_avoid']}. Shape ID {error_msg}")
+    return pd.DataFrame(sweep_results, columns=['w_bffr', 'i_bffr', 'factype_to_avoid', 'lines', 'skipped_lines', 'errors', 'transit_only_nodes', 'transit_only_links', 'unmatched_stops', 'seconds'])
+
+@profiled
+def hash_shps(gtfs_shape_index, gtfs_stop_times_df, gtfs_stops_df):
+    # Per shape ID, hash of the shape geometry and hash of the stop sequence (stop IDs and locations) of the trip used for matching
+    trip_rows = gtfs_stop_times_df.groupby('trip_id', sort=False).indices
+    stop_sequences, stop_ids = gtfs_stop_times_df.stop_sequence.values, gtfs_stop_times_df.stop_id.values
+    stops_xy = dict(zip(gtfs_stops_df.stop_id, zip(gtfs_stops_df.geometry.x, gtfs_stops_df.geometry.y)))
+    shp_hashes = dict()
+    for shp_id, shp_id_index in gtfs_shape_index.items():
+        shape_hash = hashlib.md5(np.array([(p.x, p.y) for p in shp_id_index['shape_df'].geometry], dtype=float).tobytes()).hexdigest()
+        rows = trip_rows.get(shp_id_index['route_trip_id'], np.array([], dtype=int))
+        rows = rows[np.argsort(stop_sequences[rows], kind='mergesort')]
+        stops_hash = hashlib.md5(repr([(s, stops_xy.get(s)) for s in stop_ids[rows]]).encode()).hexdigest()
+        shp_hashes[shp_id] = (shape_hash, stops_hash)
+    return shp_hashes
+
+@profiled
+def group_duplicate_shps(gtfs_shape_index, shp_hashes, tolerance=10):
+    # Shape IDs with the same stop sequence and the same shape, or a shape within tolerance (Hausdorff distance in network units),
+    # are matched once and share the node sequence. Shape IDs sharing only a prefix or suffix of their stops are not grouped and are
+    # matched separately. Returns the group (first shape ID of the group) of each shape ID
+    shp_groups, groups_by_stops = dict(), dict()
+    for shp_id, (shape_hash, stops_hash) in shp_hashes.items():
+        line = gtfs_shape_index[shp_id]['line']
+        shp_groups[shp_id] = shp_id
+        for group in groups_by_stops.setdefault(stops_hash, list()):
+            group_line = gtfs_shape_index[group]['line']
+            if shp_hashes[group][0] == shape_hash or (line is not None and group_line is not None and line.hausdorff_distance(group_line) <= tolerance):
+                shp_groups[shp_id] = group
+                break
+        if shp_groups[shp_id] == shp_id:
+            groups_by_stops[stops_hash].append(shp_id)
+    return shp_groups
+
+def create_network_key(nodes_df, links_df, links_bounds):
+    return hash_cache_key([np.asarray(nodes_df.N, dtype='int64').tobytes(), np.asarray(links_df[['A','B']], dtype='int64').tobytes(), np.asarray(links_bounds).tobytes()])
+
+def create_run_key(nodes_df, links_df, links_sindex, w_bffr, transit_only_attributes):
+    # Manifest entries are only reused by runs with the same cleaned network (whole network, not only its cells in the service area) and matching parameters
+    network_key = links_sindex['network_key'] if 'network_key' in links_sindex else create_network_key(nodes_df, links_df, links_sindex['bounds'])
+    return hash_cache_key([network_key, repr((w_bffr, transit_only_attributes))])
+
+def manifest_paths(scen_dir):
+    return os.path.join(scen_dir, 'transit-only', 'PTlines_manifest.json'), os.path.join(scen_dir, 'transit-only', 'PTlines_checkpoint.jsonl')
+
+@profiled
+def read_manifest(scen_dir, run_key):
+    # Entries of the last complete run, updated with the entries checkpointed by a run interrupted afterwards. Only entries with the same run key.
+    manifest_file, checkpoint_file = manifest_paths(scen_dir)
+    manifest_shps = dict()
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest['run_key'] == run_key:
+            manifest_shps = {m['shp_id']:m for m in manifest['shps']}
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            checkpoint = f.read().splitlines()
+        if len(checkpoint) != 0 and json.loads(checkpoint[0])['run_key'] == run_key:
+            for m in checkpoint[1:]:
+                try:
+                    m = json.loads(m)
+                except json.JSONDecodeError: # last line not fully written
+                    break
+                manifest_shps[m['shp_id']] = m
+    return manifest_shps
+
+def create_checkpoint(scen_dir, run_key):
+    with open(manifest_paths(scen_dir)[1], 'w') as f:
+        f.write(json.dumps({'run_key':run_key}) + '\n')
+
+def write_checkpoint(scen_dir, manifest_shp):
+    with open(manifest_paths(scen_dir)[1], 'a') as f:
+        f.write(json.dumps(manifest_shp) + '\n')
+
+@profiled
+def write_manifest(scen_dir, run_key, manifest_shps):
+    manifest_file, checkpoint_file = manifest_paths(scen_dir)
+    with open(f'{manifest_file}.tmp', 'w') as f:
+        json.dump({'run_key':run_key, 'shps':manifest_shps}, f)
+    os.replace(f'{manifest_file}.tmp', manifest_file)
+    if os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+
+def create_manifest_shp(shp_id, shp_hashes, node_seq, transit_only_nodes, transit_only_links, created_pos, created_end=(None, None)):
+    # created_pos (created_end): position in transit_only_nodes and transit_only_links of the first (after the last) node and link created by the shape ID
+    nodes, links = transit_only_nodes['cols'], transit_only_links['cols']
+    nodes_pos, links_pos = slice(created_pos[0], created_end[0]), slice(created_pos[1], created_end[1])
+    return {'shp_id':shp_id, 'shape_hash':shp_hashes[shp_id][0], 'stops_hash':shp_hashes[shp_id][1], 'node_seq':[int(n) for n in node_seq],
+            'nodes':[[int(N), float(X), float(Y)] for N, X, Y in zip(nodes['N'][nodes_pos], nodes['X'][nodes_pos], nodes['Y'][nodes_pos])],
+            'links':[[json_number(A), json_number(B), [list(c) for c in g.coords]] for A, B, g in zip(links['A'][links_pos], links['B'][links_pos], links['geometry'][links_pos])]}
+
+def json_number(x):
+    # Keep int or float type of numpy scalars (as written in the outputs)
+    return x.item() if isinstance(x, np.generic) else x
+
+def find_reusable_shps(manifest_shps, shp_hashes):
+    return {shp_id for shp_id, m in manifest_shps.items() if shp_id in shp_hashes and (m['shape_hash'], m['stops_hash']) == tuple(shp_hashes[shp_id])}
+
+@profiled
+def preserve_manifest_shps(manifest_shps, reuse_shp_ids, transit_only_nodes, transit_only_links, transit_only_attributes, new_nodes_from):
+    # Load the transit-only nodes and links of the previous run that the reused shape IDs created or use, keeping their IDs.
+    # Elements created by a changed shape ID but used by a reused one are moved to the manifest entry of the first reused shape ID using them.
+    created_nodes, created_links = dict(), dict()
+    for m in manifest_shps.values():
+        for N, X, Y in m['nodes']:
+            created_nodes.setdefault(N, (N, X, Y))
+        for A, B, coords in m['links']:
+            created_links.setdefault(ab_key(A, B), (A, B, coords))
+    owned_nodes, owned_links = set(), set()
+    for shp_id in reuse_shp_ids:
+        owned_nodes |= {n[0] for n in manifest_shps[shp_id]['nodes']}
+        owned_links |= {ab_key(l[0], l[1]) for l in manifest_shps[shp_id]['links']}
+    for shp_id in [s for s in manifest_shps if s in reuse_shp_ids]:
+        m = manifest_shps[shp_id]
+        node_seq = [abs(n) for n in m['node_seq']]
+        used_links = [ab for ab in [ab_key(a, b) for a, b in zip(node_seq[:-1], node_seq[1:])] if ab in created_links and ab not in owned_links]
+        used_nodes = [n for n in node_seq if n in created_nodes] + [int(abs(n)) for ab in used_links for n in created_links[ab][:2] if int(abs(n)) in created_nodes]
+        used_nodes = [n for n in dict.fromkeys(used_nodes) if n not in owned_nodes]
+        if len(used_nodes) + len(used_links) != 0:
+            manifest_shps[shp_id] = dict(m, nodes=m['nodes'] + [list(created_nodes[n]) for n in used_nodes], links=m['links'] + [list(created_links[ab]) for ab in dict.fromkeys(used_links)])
+            owned_nodes |= set(used_nodes)
+            owned_links |= set(used_links)
+    for shp_id in [s for s in manifest_shps if s in reuse_shp_ids]:
+        for N, X, Y in manifest_shps[shp_id]['nodes']:
+            transit_only_nodes = append_transit_only_nodes(transit_only_nodes, {'N':N, 'X':X, 'Y':Y, 'geometry':Point(X, Y)}, transit_only_attributes)
+            new_nodes_from = max(new_nodes_from, N + 1)
+        for A, B, coords in manifest_shps[shp_id]['links']:
+            transit_only_links = append_transit_only_links(transit_only_links, {'A':A, 'B':B, 'geometry':LineString(coords)}, transit_only_attributes)
+    return manifest_shps, transit_only_nodes, transit_only_links, new_nodes_from
+
+def append_transit_only_nodes(transit_only_nodes, new_node, transit_only_attributes):
+    for c in transit_only_nodes['cols']:
+        transit_only_nodes['cols'][c].append(new_node[c])
+    transit_only_nodes['gdf'], transit_only_nodes['keys'] = None, None
+    if transit_only_nodes['stops_registry'] is not None:
+        register_transit_only_node(transit_only_nodes['stops_registry'], len(transit_only_nodes['cols']['N']) - 1, new_node['N'], new_node['geometry'].x, new_node['geometry'].y)
+    return transit_only_nodes
+
+def append_transit_only_links(transit_only_links, new_link, transit_only_attributes):
+    new_link = dict(new_link, **transit_only_attributes)
+    new_link['DIST'] = new_link['geometry'].length/5280
+    new_link['AB'] = ab_key(new_link['A'], new_link['B'])
+    for c in transit_only_links['cols']:
+        transit_only_links['cols'][c].append(new_link[c])
+    transit_only_links['gdf'], transit_only_links['keys'] = None, None
+    if transit_only_links['sindex'] is not None:
+        insert_transit_only_link_sindex(transit_only_links['sindex'], len(transit_only_links['cols']['geometry']) - 1, new_link['geometry'])
+    return transit_only_links
+
+def insert_transit_only_link_sindex(links_sindex, link_pos, link_geom):
+    links_sindex['index'].insert(links_sindex['n_links'] + link_pos, link_geom.bounds)
+
+def import_pyplot():
+    # matplotlib is only imported by the processes rendering figures (plot_bool = 1)
+    import matplotlib
+    matplotlib.interactive(False)
+    import matplotlib.pyplot as plt
+    return plt
+
+def plot(scen_dir, shp_id_df, gtfs_trips_df, line_node_seq_df, line_link_seq_df, links_intersecting_shp_df, transit_only_nodes_df, transit_only_links_df, w_bffr, i_bffr, title, figsize=(20,20), plot_dpi=600, plot_format='jpeg'):
+    plt = import_pyplot()
     fig, ax = plt.subplots(figsize=figsize)
     
     links_intersecting_shp_df.plot(ax=ax, color='grey', linewidth=1, alpha=0.3, zorder=1, label=f'Highway links in a range of {i_bffr} ft (~{i_bffr/3281:.2f} km)')
@@ -395,10 +1678,11 @@ def plot(scen_dir, shp_id_df, gtfs_trips_df, line_node_seq_df, line_link_seq_df,
     shp_id_line_df = gpd.GeoDataFrame({'geometry':[LineString(shp_id_df.geometry.values)]})
     shp_id_line_df.plot(ax=ax, color='green', linewidth=10, alpha=0.25, zorder=2, label="Line shape buffer.")
     
-    line_link_seq_df['AB'] = abs(line_link_seq_df.A).astype('int').astype('str') + '_' +  abs(line_link_seq_df.B).astype('int').astype('str')
+    line_link_seq_df['AB'] = ab_keys(line_link_seq_df.A, line_link_seq_df.B)
     if transit_only_links_df.shape[0] != 0:
-        net_links = line_link_seq_df[~line_link_seq_df.AB.isin(transit_only_links_df.AB.to_list())].drop_duplicates(subset=['AB'])
-        created_links = line_link_seq_df[line_link_seq_df.AB.isin(transit_only_links_df.AB.to_list())].drop_duplicates(subset=['AB'])
+        links_created = isin_keys(line_link_seq_df.AB, create_keys_index(transit_only_links_df.AB))
+        net_links = line_link_seq_df[~links_created].drop_duplicates(subset=['AB'])
+        created_links = line_link_seq_df[links_created].drop_duplicates(subset=['AB'])
         created_links.plot(ax=ax, color='yellow', linestyle='dotted', linewidth=2, zorder=4, label="Transit-only links created.")
     else:
         net_links = line_link_seq_df.copy()
@@ -408,8 +1692,9 @@ def plot(scen_dir, shp_id_df, gtfs_trips_df, line_node_seq_df, line_link_seq_df,
     net_nodes.plot(ax=ax, color='blue', alpha=0.6, marker="s", markersize=25, zorder=4, label="Non-stop highway nodes already coded.")
     
     if transit_only_nodes_df.shape[0] != 0:
-        net_stops = line_node_seq_df[(line_node_seq_df.N>0) & (~abs(line_node_seq_df.N).isin(transit_only_nodes_df.N.to_list()))].drop_duplicates(subset=['N'])
-        created_stops = line_node_seq_df[(line_node_seq_df.N>0) & (abs(line_node_seq_df.N).isin(transit_only_nodes_df.N.to_list()))].drop_duplicates(subset=['N'])
+        nodes_created = isin_keys(abs(line_node_seq_df.N), create_keys_index(transit_only_nodes_df.N))
+        net_stops = line_node_seq_df[(line_node_seq_df.N>0) & (~nodes_created)].drop_duplicates(subset=['N'])
+        created_stops = line_node_seq_df[(line_node_seq_df.N>0) & nodes_created].drop_duplicates(subset=['N'])
         created_stops.plot(ax=ax, color='magenta', alpha=0.6, marker="^", markersize=25, zorder=5, label="Transit-only stop nodes created.")
     else:
         net_stops = line_node_seq_df[(line_node_seq_df.N>0)].drop_duplicates(subset=['N'])
@@ -420,81 +1705,281 @@ def plot(scen_dir, shp_id_df, gtfs_trips_df, line_node_seq_df, line_link_seq_df,
     ax.set_title(title, fontsize=20)
     ax.legend(fontsize=16, loc='upper right', framealpha=0.3)
     
-    filename = valid_filename_alphanumeric_spaces(f'{title}.jpeg')
-    fig.savefig(os.path.join(scen_dir, 'images', filename), dpi=600, bbox_inches = 'tight', pad_inches = 0.2)
+    filename = valid_filename_alphanumeric_spaces(f'{title}.{plot_format}')
+    fig.savefig(os.path.join(scen_dir, 'images', filename), dpi=plot_dpi, bbox_inches = 'tight', pad_inches = 0.2)
     plt.close(fig)
+    return filename
+
+def create_plot_renderer(scen_dir, plot_workers=1, plot_queue=8, plot_changed_only=0):
+    # Figures are rendered by a pool of processes while the main process keeps matching. At most plot_queue figures wait in memory.
+    # rendered_images.csv keeps the signature of each figure saved, so figures of unchanged shapes can be skipped in the next run
+    rendered_csv = os.path.join(scen_dir, 'images', 'rendered_images.csv')
+    rendered = dict(pd.read_csv(rendered_csv, dtype='str').values) if os.path.exists(rendered_csv) else dict()
+    return {'executor':ProcessPoolExecutor(max_workers=plot_workers), 'pending':list(), 'plot_queue':plot_queue, 'plot_changed_only':plot_changed_only,
+            'scen_dir':scen_dir, 'rendered':rendered, 'rendered_csv':rendered_csv, 'saved':0, 'skipped':0}
+
+def plot_signature(shp_id_df, line_node_seq_df, w_bffr, i_bffr, plot_dpi, plot_format):
+    signature = hashlib.md5()
+    signature.update(np.array([(p.x, p.y) for p in shp_id_df.geometry], dtype=float).tobytes())
+    signature.update(np.array(line_node_seq_df.N, dtype='int64').tobytes())
+    signature.update(repr((w_bffr, i_bffr, plot_dpi, plot_format)).encode())
+    return signature.hexdigest()
+
+@profiled
+def submit_plot(plot_renderer, shp_id_df, line_node_seq_df, line_link_seq_df, links_intersecting_shp_df, transit_only_nodes_df, transit_only_links_df, w_bffr, i_bffr, title, figsize=(20,20), plot_dpi=600, plot_format='jpeg'):
+    # Same inputs as plot. Returns False if the figure is skipped because its shape did not change
+    filename = valid_filename_alphanumeric_spaces(f'{title}.{plot_format}')
+    signature = plot_signature(shp_id_df, line_node_seq_df, w_bffr, i_bffr, plot_dpi, plot_format)
+    if plot_renderer['plot_changed_only'] == 1 and plot_renderer['rendered'].get(filename) == signature and os.path.exists(os.path.join(plot_renderer['scen_dir'], 'images', filename)):
+        plot_renderer['skipped'] += 1
+        return False
     
+    # Lightweight snapshot: only the columns and transit-only IDs used by plot
+    line_link_seq_df = line_link_seq_df[['A','B','geometry']].copy()
+    if transit_only_nodes_df.shape[0] != 0:
+        transit_only_nodes_df = transit_only_nodes_df.loc[isin_keys(transit_only_nodes_df.N, create_keys_index(abs(line_node_seq_df.N))), ['N']]
+    if transit_only_links_df.shape[0] != 0:
+        transit_only_links_df = transit_only_links_df.loc[isin_keys(transit_only_links_df.AB, create_keys_index(ab_keys(line_link_seq_df.A, line_link_seq_df.B))), ['AB']]
+    snapshot = (plot_renderer['scen_dir'], shp_id_df[['geometry']], None, line_node_seq_df[['N','geometry']].copy(), line_link_seq_df, links_intersecting_shp_df[['geometry']],
+                transit_only_nodes_df, transit_only_links_df, w_bffr, i_bffr, title, figsize, plot_dpi, plot_format)
+    
+    # Bounded queue: wait for a figure to be saved before queuing another one
+    while len(plot_renderer['pending']) >= plot_renderer['plot_queue']:
+        wait([f for f,_,_ in plot_renderer['pending']], return_when=FIRST_COMPLETED)
+        collect_plots(plot_renderer)
+    plot_renderer['pending'].append((plot_renderer['executor'].submit(plot, *snapshot), filename, signature))
+    return True
+
+def collect_plots(plot_renderer):
+    pending = list()
+    for future, filename, signature in plot_renderer['pending']:
+        if not future.done():
+            pending.append((future, filename, signature))
+        elif future.exception() is not None:
+            print(f'\tFigure {filename} not saved: {future.exception()}')
+        else:
+            plot_renderer['rendered'][filename] = signature
+            plot_renderer['saved'] += 1
+    plot_renderer['pending'] = pending
+
+@profiled
+def close_plot_renderer(plot_renderer):
+    wait([f for f,_,_ in plot_renderer['pending']])
+    collect_plots(plot_renderer)
+    plot_renderer['executor'].shutdown()
+    pd.DataFrame(list(plot_renderer['rendered'].items()), columns=['filename','signature']).to_csv(plot_renderer['rendered_csv'], index=False)
+    return plot_renderer['saved'], plot_renderer['skipped']
+
 def valid_filename_alphanumeric_spaces(filename):
     return "".join(x for x in filename if x.isalnum() or x.isspace() or x == '.')
 
-def list_arrival_times_by_shp_service_time(gtfs_trips_df, gtfs_calendar_df, gtfs_stop_times_df, shp_id, day_type, period_time):
-    start_time, end_time = period_time
+def find_service_id(gtfs_calendar_df, day_type):
     gtfs_calendar_df = gtfs_calendar_df.copy()
     gtfs_calendar_df['start_date'] = pd.to_datetime(gtfs_calendar_df['start_date'], format='%Y%m%d')
     gtfs_calendar_df['end_date'] = pd.to_datetime(gtfs_calendar_df['end_date'], format='%Y%m%d')
     gtfs_calendar_df['total_days'] = (gtfs_calendar_df['end_date'] - gtfs_calendar_df['start_date']).dt.days # The service will be chosen based on the longest service that includes the day of interest (e.g., longest service including Monday)
-    srvc_id = gtfs_calendar_df.loc[(gtfs_calendar_df[day_type] == 1) & (gtfs_calendar_df['total_days'] == gtfs_calendar_df['total_days'].max()),'service_id'].values[0]
-    arr_times_by_shp_srvc_stop_time = dict()
-    route_trip_ids = list(gtfs_trips_df[gtfs_trips_df.shape_id == shp_id].trip_id.unique())
-    for stop in gtfs_stop_times_df[gtfs_stop_times_df.trip_id.isin(route_trip_ids)].stop_id.unique():
-        gtfs_srvc_time_df = gtfs_trips_df.merge(gtfs_stop_times_df[gtfs_stop_times_df.stop_id == stop][['trip_id','arrival_time']])
-        arr_times_by_shp_srvc_stop_time[stop] = gtfs_srvc_time_df[(gtfs_srvc_time_df.shape_id == shp_id) & 
-                                                                  (gtfs_srvc_time_df.service_id == srvc_id) & 
-                                                                  (gtfs_srvc_time_df.arrival_time.dt.strftime('%H:%M:%S') >= start_time) &
-                                                                  (gtfs_srvc_time_df.arrival_time.dt.strftime('%H:%M:%S') < end_time)].arrival_time.to_list()
-    return arr_times_by_shp_srvc_stop_time
-
-def calculate_headway(arr_times_by_shp_srvc_stop_time):
-    stop_headways = []
-    stop_headway_counts = []
-    for stop in arr_times_by_shp_srvc_stop_time:
-        start_times = arr_times_by_shp_srvc_stop_time[stop]
-        start_times.sort()
-        headways = [(pd.to_datetime(t) - pd.to_datetime(s)).total_seconds() for s, t in zip(start_times, start_times[1:])]
-        if headways:
-            stop_headways.append(round(sum(headways)/(len(headways)*60)))
-        else:
-            stop_headways.append(0.0)
-        stop_headway_counts.append(len(headways))
-    if np.sum(stop_headway_counts) > 0 :
-        return round(np.average(stop_headways, weights=stop_headway_counts),2)
-    else:
-        return 0.00
-        
+    return gtfs_calendar_df.loc[(gtfs_calendar_df[day_type] == 1) & (gtfs_calendar_df['total_days'] == gtfs_calendar_df['total_days'].max()),'service_id'].values[0]
+
+def time_to_seconds(time_str):
+    h, m, s = [int(t) for t in time_str.strip().split(':')]
+    return h*3600 + m*60 + s
+
+@profiled
+def calculate_headways_by_shp(gtfs_trips_df, gtfs_calendar_df, gtfs_stop_times_df, day_type, period_times):
+    # Headways of every shape ID and period in one pass, with arrival times as integer seconds
+    srvc_id = find_service_id(gtfs_calendar_df, day_type)
+    shp_ids = gtfs_trips_df.shape_id.unique()
+    shp_headways = {shp_id:[0.00 for t in period_times] for shp_id in shp_ids}
+    srvc_trips_df = gtfs_trips_df.loc[gtfs_trips_df.service_id == srvc_id, ['trip_id','shape_id']]
+    arr_times_df = gtfs_stop_times_df[['trip_id','stop_id','arrival_time']].merge(srvc_trips_df)
+    arr_times_df = arr_times_df[arr_times_df.arrival_time >= 0]
+    arr_secs = arr_times_df.arrival_time.values.astype('int64')
+    day_secs = arr_secs % 86400 # time of day, as shown in 'HH:MM:SS' (i.e., times past midnight wrap to next day)
+    periods_df = list()
+    for p, t in enumerate(period_times):
+        start_time, end_time = [time_to_seconds(s) for s in period_times[t]]
+        in_period = (day_secs >= start_time) & (day_secs < end_time)
+        periods_df.append(pd.DataFrame({'shape_id':arr_times_df.shape_id.values[in_period],
+                                        'period':p,
+                                        'stop_id':arr_times_df.stop_id.values[in_period],
+                                        'arr_secs':arr_secs[in_period]}))
+    if len(periods_df) == 0:
+        return shp_headways
+    periods_df = pd.concat(periods_df, ignore_index=True)
+    # Per stop, the average headway is (last - first arrival) / (arrivals - 1), rounded to minutes and weighted by the number of headways
+    stops_df = periods_df.groupby(['shape_id','period','stop_id']).arr_secs.agg(['min','max','count']).reset_index()
+    stops_df = stops_df[stops_df['count'] > 1]
+    stops_df['weight'] = stops_df['count'] - 1
+    stops_df['headway'] = np.round((stops_df['max'] - stops_df['min']) / (stops_df['weight']*60))
+    stops_df['weighted_headway'] = stops_df['headway'] * stops_df['weight']
+    shp_periods_df = stops_df.groupby(['shape_id','period'])[['weighted_headway','weight']].sum().reset_index()
+    for shp_id, p, weighted_headway, weight in shp_periods_df.itertuples(index=False, name=None):
+        shp_headways[shp_id][p] = np.round(weighted_headway/weight, 2)
+    return shp_headways
+
 def set_line_name(head_sign, shp_id):
     shp_id = str(shp_id)[-3:]
     tot_len = 10
     return head_sign[:tot_len-len(shp_id)-1] + '_' + shp_id
 
-def write_lin_file(lines, outfile):
+def lin_line_text(line, width=254):
+    # Text of a line in the .lin file, wrapped in one pass to lines of width characters at most (Cube reads up to 255).
+    # Same wrapping as textwrap.fill: nodes in groups of those fitting in a line as ' N1, N2,...', written without spaces
+    header = f'LINE NAME="{line["name"]}", MODE={line["mode"]},' + ''.join(f' HEADWAY[{i + 1}]={hdw:.2f},' for i, hdw in enumerate(line["headways"]))
+    chunks = [c if c.strip() != '' else ' ' * len(c) for c in re.findall(r'\s+|\S+', (header + ' ONEWAY=T, ALLSTOPS=F, VEHICLETYPE=1,').expandtabs())]
+    groups, group, group_len = list(), list(), 0
+    for node in line["node_seq"]:
+        node_str = f'{int(node)},'
+        if len(group) != 0 and group_len + len(node_str) + 1 > width + (len(groups) != 0): # the first group is written after a space
+            groups.append(''.join(group))
+            group, group_len = list(), 0
+        group.append(node_str)
+        group_len += len(node_str) + 1
+    if len(group) != 0:
+        groups.append(''.join(group))
+    chunks += [' ', 'N=' + (groups[0] if len(groups) != 0 else '')]
+    for group in groups[1:]:
+        chunks += [' ', group]
+    chunks += [' ', 'CIRCULAR=F']
+    
+    # Greedy wrap: whitespace dropped at the start (but of the first row) and end of the rows, words longer than width broken
+    rows, row, row_len, i = list(), list(), 0, 0
+    while i < len(chunks):
+        chunk = chunks[i]
+        if len(row) == 0 and len(rows) != 0 and chunk.strip() == '':
+            i += 1
+        elif row_len + len(chunk) <= width:
+            row.append(chunk)
+            row_len += len(chunk)
+            i += 1
+        else:
+            if len(chunk) > width:
+                row.append(chunk[:max(width - row_len, 1)])
+                chunks[i] = chunk[max(width - row_len, 1):]
+            if len(row) != 0 and row[-1].strip() == '':
+                row.pop()
+            rows.append(''.join(row))
+            row, row_len = list(), 0
+    if len(row) != 0 and row[-1].strip() == '':
+        row.pop()
+    if len(row) != 0:
+        rows.append(''.join(row))
+    return '\n'.join(rows)
+
+def open_lin_writer(outfile):
+    # Lines of the .lin file in their order. Each line is written as soon as its node sequence is set and the lines before it are written
     print('Writing Line file...')
-    with open(outfile, 'w') as file:
-        # file.write(header)
-        for line in lines:
-            if lines.index(line) != 0:
-                file.write('\n')
-            line_content = f'LINE NAME="{line["name"]}", MODE={line["mode"]},'
-            hdw_nmbr = 1
-            for hdw in line["headways"]:
-                line_content += f' HEADWAY[{hdw_nmbr}]={hdw:.2f},'
-                hdw_nmbr += 1
-            line_content += ' ONEWAY=T, ALLSTOPS=F, VEHICLETYPE=1,\nN='
-            nodes_string = ''
-            for node in line["node_seq"]:
-                nodes_string += f' {int(node)},'
-            line_content += textwrap.fill(nodes_string, width=254).replace(' ','')
-            line_content += ' CIRCULAR=F'
-            file.write(textwrap.fill(line_content, width=254))
+    return {'file':open(outfile, 'w'), 'lines':list(), 'next':0, 'n_written':0}
+
+def add_lin_line(lin_writer, line):
+    lin_writer['lines'].append(line)
+    write_lin_lines(lin_writer)
+
+@profiled
+def write_lin_lines(lin_writer):
+    # Write the lines ready, in order. Lines with no node sequence are not written
+    lines = lin_writer['lines']
+    while lin_writer['next'] < len(lines) and 'node_seq' in lines[lin_writer['next']]:
+        line = lines[lin_writer['next']]
+        if len(line["node_seq"]) != 0:
+            if lin_writer['n_written'] != 0:
+                lin_writer['file'].write('\n')
+            lin_writer['file'].write(lin_line_text(line))
+            lin_writer['n_written'] += 1
+        lines[lin_writer['next']] = None
+        lin_writer['next'] += 1
+    lin_writer['file'].flush()
+
+def close_lin_writer(lin_writer):
+    write_lin_lines(lin_writer)
+    lin_writer['file'].close()
+    if lin_writer['next'] != len(lin_writer['lines']):
+        raise Exception(f"Line file {lin_writer['file'].name} closed with {len(lin_writer['lines']) - lin_writer['next']} lines without node sequence.")
+
+@profiled
+def write_lin_file(lines, outfile):
+    lin_writer = open_lin_writer(outfile)
+    for line in lines:
+        add_lin_line(lin_writer, line)
+    close_lin_writer(lin_writer)
+
+@profiled
+def read_lin_file(lin_file):
+    # Lines of a .lin file as arrays: name, mode, headways (lines x headway number, nan if not given) and the node sequences of all lines
+    # one after the other, signed as in the file (line i has nodes node_seq[node_seq_pos[i]:node_seq_pos[i+1]]). Comments (;) are skipped
+    with open(lin_file) as file:
+        text = re.sub(r'^\s*;.*$', '', file.read(), flags=re.M)
+    names, modes, headways, nodes, node_seq_pos = list(), list(), list(), list(), [0]
+    next_key_re = re.compile(r',\s*[A-Z][\w\[\]]*\s*=', flags=re.I)
+    for record in re.split(r'^\s*LINE\s', text, flags=re.M | re.I)[1:]:
+        name = re.search(r'NAME\s*=\s*"([^"]*)"', record, flags=re.I)
+        names.append(name.group(1) if name is not None else '')
+        if name is not None:
+            record = record[:name.start()] + record[name.end():]
+        # Node lists (N= up to the next keyword) read with one scan each, then the keywords of the line
+        keys_text, pos, line_nodes = '', 0, [np.zeros(0, dtype='int64')]
+        for n in re.finditer(r'(?:^|,)\s*N\s*=', record, flags=re.I):
+            if n.start() < pos:
+                continue
+            next_key = next_key_re.search(record, n.end())
+            end = next_key.start() if next_key is not None else len(record)
+            line_nodes.append(np.fromstring(record[n.end():end].strip().rstrip(','), dtype='int64', sep=','))
+            keys_text += record[pos:n.start()]
+            pos = end
+        keys_text += record[pos:]
+        mode, line_headways = -1, dict()
+        for token in keys_text.split(','):
+            if '=' in token:
+                key, value = [t.strip() for t in token.split('=', 1)]
+                key = key.upper()
+                if key == 'MODE':
+                    mode = int(value)
+                elif key == 'HEADWAY' or key.startswith('HEADWAY['):
+                    line_headways[int(key[8:-1]) if key != 'HEADWAY' else 1] = float(value)
+        modes.append(mode)
+        headways.append(line_headways)
+        nodes.append(np.concatenate(line_nodes))
+        node_seq_pos.append(node_seq_pos[-1] + len(nodes[-1]))
+    lin = {'name':np.array(names, dtype=str), 'mode':np.array(modes, dtype='int64'),
+           'headways':np.full((len(names), max([max(h, default=0) for h in headways], default=0)), np.nan),
+           'node_seq':np.concatenate(nodes) if len(nodes) != 0 else np.zeros(0, dtype='int64'), 'node_seq_pos':np.array(node_seq_pos, dtype='int64')}
+    for i, line_headways in enumerate(headways):
+        for hdw_nmbr, hdw in line_headways.items():
+            lin['headways'][i, hdw_nmbr - 1] = hdw
+    return lin
+
+def lin_node_seq(lin, i):
+    return lin['node_seq'][lin['node_seq_pos'][i]:lin['node_seq_pos'][i + 1]]
+
+def compare_lin(lin_a, lin_b):
+    # Line names only in a, only in b, and in both with a different mode, headways or node sequence. Lines are matched by name, which
+    # is all a .lin file keeps of a line (headsign and shape ID cut to 10 characters), so names found more than once are an error
+    for lin_name, lin in [('lin_a', lin_a), ('lin_b', lin_b)]:
+        names, names_count = np.unique(lin['name'], return_counts=True)
+        if (names_count > 1).any():
+            raise Exception(f"Line names {names[names_count > 1].tolist()} found more than once in {lin_name}, lines cannot be matched by name.")
+    lines_a, lines_b = {name:i for i, name in enumerate(lin_a['name'].tolist())}, {name:i for i, name in enumerate(lin_b['name'].tolist())}
+    changed = list()
+    for name in [name for name in lines_a if name in lines_b]:
+        i, j = lines_a[name], lines_b[name]
+        hdw_a, hdw_b = lin_a['headways'][i], lin_b['headways'][j]
+        if (lin_a['mode'][i] != lin_b['mode'][j] or not np.array_equal(np.flatnonzero(~np.isnan(hdw_a)), np.flatnonzero(~np.isnan(hdw_b)))
+            or not np.array_equal(hdw_a[~np.isnan(hdw_a)], hdw_b[~np.isnan(hdw_b)])
+            or not np.array_equal(lin_node_seq(lin_a, i), lin_node_seq(lin_b, j))):
+            changed.append(name)
+    return {'removed':[name for name in lines_a if name not in lines_b], 'added':[name for name in lines_b if name not in lines_a], 'changed':changed}
 
 def column_dbf_type(col_df):
+    # DBF type of the column for Cube: N(L,0) for integers, N(L,D) for floats (L = integer digits + D + 1) and C(L) for strings.
+    # Field widths are computed on the whole column without converting the numbers to str
     f_type = None
-    if col_df.dtype in [int, np.int32, np.int64]:
-        f_length = len(max(col_df.astype('str'), key=len))
+    if pd.api.types.is_integer_dtype(col_df):
+        f_length = int(number_str_len(col_df.to_numpy(dtype='int64')).max(initial=1))
         if f_length > 32:
             raise Exception('f_length too big. (>32)')
         f_type = f'N({f_length},0)'
-    elif col_df.dtype in [float, np.float32, np.float64]:
-        f_length = len(max((col_df // 1).astype('str'), key=len).split('.')[0])
+    elif pd.api.types.is_float_dtype(col_df):
+        f_length = int(number_str_len(np.floor(col_df.to_numpy(dtype=float))).max(initial=1))
         f_decimals = 6
         if f_length < 32:
             while f_length + f_decimals + 1 > 32:
@@ -502,27 +1987,73 @@ def column_dbf_type(col_df):
         else:
             raise Exception('f_length too big. (>=32)')
         f_type = f'N({f_length + f_decimals + 1},{f_decimals})'
-    elif col_df.dtype in [str, object]:
-        f_length = len(max(col_df.to_list(), key=len))
+    elif pd.api.types.is_string_dtype(col_df) or col_df.dtype == object:
+        f_length = int(col_df.str.len().max()) if col_df.shape[0] != 0 else 1
         f_type = f'C({f_length})'
     return f_type
 
+def number_str_len(values):
+    # Length of the integer part of each number written as '%.0f' (minus sign included): number of digits from a search in the powers of 10.
+    # Floats of 1e15 or more and inf are measured with '%.0f', and nan (written blank) counts as 0
+    powers = 10 ** np.arange(19, dtype='int64') if values.dtype.kind == 'i' else 10.0 ** np.arange(16)
+    plain = np.ones(values.shape[0], dtype=bool) if values.dtype.kind == 'i' else np.isfinite(values) & (np.abs(values) < 1e15)
+    lengths = np.zeros(values.shape[0], dtype='int64')
+    lengths[plain] = np.maximum(np.searchsorted(powers, np.abs(values[plain]), side='right'), 1) + np.signbit(values[plain])
+    lengths[~plain] = [len('%.0f' % v) if not np.isnan(v) else 0 for v in values[~plain]]
+    return lengths
+
+@profiled
+def write_dbf(df, dbf_file):
+    # dBase III table written at once from the columns: one fixed-width byte array per field, joined in a numpy record array.
+    # Same file as the dbf library: ascii, field names in upper case, numbers formatted as '%L.Df' right aligned, text left aligned
+    fields, records = list(), [('deleted', 'S1')]
+    for c in df.columns:
+        f_type = column_dbf_type(df[c])
+        if f_type is None:
+            raise Exception(f'Column {c} of type {df[c].dtype} can not be written to {dbf_file}.')
+        if len(c) > 10:
+            raise Exception(f"Maximum field name length is 10. '{c}' is {len(c)} characters long.")
+        f_length, f_decimals = [int(n) for n in f_type[2:-1].split(',')] if f_type[0] == 'N' else (int(f_type[2:-1]), 0)
+        fields.append((c, f_type[0], f_length, f_decimals))
+        records.append((f'f{len(fields)}', f'S{f_length}'))
+    
+    records = np.empty(df.shape[0], dtype=records)
+    records['deleted'] = b' '
+    for i, (c, f_type, f_length, f_decimals) in enumerate(fields):
+        if f_type == 'N' and pd.api.types.is_integer_dtype(df[c]) and np.all(np.abs(df[c].to_numpy(dtype='int64')) < 2**53): # integers written exactly as floats
+            col_bytes = np.char.mod(f'%{f_length}d', df[c].to_numpy(dtype='int64')).astype('S')
+        elif f_type == 'N':
+            values = df[c].to_numpy(dtype=float)
+            col_bytes = np.char.mod(f'%{f_length}.{f_decimals}f', values).astype('S')
+            col_bytes[np.isnan(values)] = b' ' * f_length # empty numbers are blank
+        else:
+            col_bytes = df[c].fillna('').astype(str).str.strip().str.ljust(f_length).to_numpy(dtype=str).astype('S') # ascii
+        if col_bytes.dtype.itemsize > f_length:
+            raise Exception(f'Values of column {c} too long for field {f_type}({f_length},{f_decimals}).')
+        records[f'f{i+1}'] = col_bytes
+    
+    today = datetime.date.today()
+    header = struct.pack('<4BIHH20x', 3, today.year - 1900, today.month, today.day, records.shape[0], 32 * len(fields) + 33, records.dtype.itemsize)
+    offset = 1
+    for c, f_type, f_length, f_decimals in fields:
+        header += struct.pack('<11scIBB14x', c.upper().encode('ascii'), f_type.encode('ascii'), offset, f_length, f_decimals)
+        offset += f_length
+    with open(dbf_file, 'wb') as file:
+        file.write(header + b'\r')
+        file.write(records.tobytes())
+        file.write(b'\x1a')
+
 def write_nodes_dbf(nodes_df, nodes_dbf):
-    field_types = ';'.join([f'{c} {column_dbf_type(nodes_df[c])}' for c in nodes_df.columns])
-    nodes_dbf_tbl = dbf.Table(nodes_dbf, field_types) #length and decimals in Numeric must be: L_informed = L_int + (D+1); D_informed = D. This is to avoid errors in the dbf library.
-    nodes_dbf_tbl.open(mode=dbf.READ_WRITE)
-    for node in list(nodes_df.itertuples(index=False, name=None)):
-        nodes_dbf_tbl.append(node)
-    nodes_dbf_tbl.close()
-        
+    write_dbf(nodes_df, nodes_dbf)
+
 def write_links_dbf(links_df, links_dbf):
-    field_types = ';'.join([f'{c} {column_dbf_type(links_df[c])}' for c in links_df.columns])
-    links_dbf_tbl = dbf.Table(links_dbf, field_types)  #length and decimals in Numeric must be: L_informed = L_int + (D+1); D_informed = D. This is to avoid errors in the dbf library.
-    links_dbf_tbl.open(mode=dbf.READ_WRITE)
-    for link in list(links_df.itertuples(index=False, name=None)):
-        links_dbf_tbl.append(link)
-    links_dbf_tbl.close()
-    
+    write_dbf(links_df, links_dbf)
+
+def write_csv_dbf(df, csv_file):
+    # CSV and DBF (same name) files of a table
+    write_csv(df, csv_file)
+    write_dbf(df, csv_file.replace('csv','dbf'))
+
 def write_net_attributes_renaming_file(cols, outfile, dbf_filename, link_or_node):
     text = f"FILEI {link_or_node.upper()}I[1] = \"{dbf_filename}\""
     cols = [c for c in cols if c != c[:10]]
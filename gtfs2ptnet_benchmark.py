@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the GTFS to Public Transit Network tool on synthetic networks and GTFS feeds.
+
+Generates seeded grid or radial networks with the routes, stops and trips of a GTFS feed for a list of sizes,
+runs gtfs2ptnet_main.py on each of them and times each stage. With --n-workers above 1, each case is also run serially to report
+the shape IDs matched again by the parallel merge and the speed-up of the workers. Runs offline, no real data needed.
+
+Usage:
+    python gtfs2ptnet_benchmark.py --sizes 1,2,4 --layouts grid,radial --out benchmark
+    python gtfs2ptnet_benchmark.py --sizes 1,2,4 --baseline benchmark/baseline.json
+    python gtfs2ptnet_benchmark.py --sizes 1,2,4 --n-workers 4
+"""
+
+#%% Libraries and hard-coded inputs below
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import LineString, Point
+from pyproj import Transformer
+import gtfs2ptnet
+import argparse
+import contextlib
+import functools
+import platform
+import random
+import runpy
+import shutil
+import json
+import time
+import math
+import sys
+import os
+
+net_proj = 'ESRI:102723'
+x0, y0 = 1820000.0, 700000.0 # origin of the synthetic networks (ft), around Columbus, OH
+
+# Stages timed and the gtfs2ptnet functions that belong to each stage. The stages do not call each other, so their times do not overlap
+benchmark_stages = {'read_gtfs':['read_gtfs'],
+                    'read_network':['read_network_shp', 'read_network_cells', 'read_network_keys'],
+                    'net_cleaning':['net_cleaning'],
+                    'sjoin':['sjoin_overlay_links'],
+                    'match_stops_and_nodes':['match_stops_and_nodes'],
+                    'create_node_seq':['create_node_seq'],
+                    'headways':['calculate_headways_by_shp'],
+                    'writers':['write_outputs', 'write_lin_lines'],
+                    'plot':['submit_plot', 'close_plot_renderer']}
+
+#%% Synthetic network and GTFS
+
+def create_synthetic_network(layout, size, rng, spacing=1000.0, drop=0.08):
+    # Grid of size x size nodes, or radial network of size//2 rings and 2*size spokes (about the same number of nodes).
+    # Returns the nodes {N:(X,Y)}, the street edges (A,B) and the edges coded as links (dropped edges are gaps that routes still follow)
+    nodes, edges = dict(), list()
+    if layout == 'grid':
+        node_id = lambda i, j: 10001 + i * size + j
+        for i in range(size):
+            for j in range(size):
+                nodes[node_id(i, j)] = (x0 + i * spacing, y0 + j * spacing)
+                if i + 1 < size:
+                    edges.append((node_id(i, j), node_id(i + 1, j)))
+                if j + 1 < size:
+                    edges.append((node_id(i, j), node_id(i, j + 1)))
+    elif layout == 'radial':
+        n_rings, n_spokes = max(size // 2, 1), 2 * size
+        node_id = lambda r, k: 10001 if r == 0 else 10002 + (r - 1) * n_spokes + k
+        nodes[node_id(0, 0)] = (x0, y0)
+        for r in range(1, n_rings + 1):
+            for k in range(n_spokes):
+                angle = 2 * math.pi * k / n_spokes
+                nodes[node_id(r, k)] = (x0 + r * spacing * math.cos(angle), y0 + r * spacing * math.sin(angle))
+                edges.append((node_id(r - 1, k), node_id(r, k)))
+                edges.append((node_id(r, k), node_id(r, (k + 1) % n_spokes)))
+        edges = list(dict.fromkeys(edges)) # spokes from the center node are added once
+    else:
+        raise Exception(f'Layout {layout} not found. Use grid or radial.')
+    coded_edges = [e for e in edges if rng.random() >= drop]
+    return nodes, edges, coded_edges
+
+def create_synthetic_routes(nodes, edges, n_routes, rng):
+    # Random walks on the streets always moving away from the first node, so that routes do not cross themselves
+    neighbors = dict()
+    for A, B in edges:
+        neighbors.setdefault(A, list()).append(B)
+        neighbors.setdefault(B, list()).append(A)
+    node_ids = sorted(nodes)
+    distance = lambda A, B: math.hypot(nodes[A][0] - nodes[B][0], nodes[A][1] - nodes[B][1])
+    routes = list()
+    for r in range(n_routes):
+        path = [rng.choice(node_ids)]
+        for _ in range(rng.randint(10, 22)):
+            next_nodes = [n for n in neighbors[path[-1]] if n not in path and distance(path[0], n) > distance(path[0], path[-1])]
+            if len(next_nodes) == 0:
+                break
+            path.append(rng.choice(next_nodes))
+        if len(path) > 2:
+            routes.append(path)
+    return routes
+
+def write_synthetic_case(case_dir, layout, size, n_routes, seed):
+    # Network shapefiles, GTFS feed, modes_table.csv and parameters.txt of one synthetic case
+    rng = random.Random(seed)
+    for d in ['gtfs', 'network', 'route-info', 'scen/images', 'scen/network', 'scen/transit-only']:
+        os.makedirs(os.path.join(case_dir, d), exist_ok=True)
+
+    # Network
+    nodes, edges, coded_edges = create_synthetic_network(layout, size, rng)
+    nodes_df = gpd.GeoDataFrame({'N':list(nodes), 'X':[xy[0] for xy in nodes.values()], 'Y':[xy[1] for xy in nodes.values()], 'ZONE':[rng.randint(1, 50) for _ in nodes]},
+                                geometry=[Point(xy) for xy in nodes.values()], crs=net_proj)
+    links = list()
+    for A, B in coded_edges:
+        factype = 70 if rng.random() < 0.02 else rng.choice([1, 2, 3, 4])
+        links.append((A, B, factype, LineString([nodes[A], nodes[B]])))
+        links.append((B, A, factype, LineString([nodes[B], nodes[A]])))
+    links_df = gpd.GeoDataFrame({'A':[l[0] for l in links], 'B':[l[1] for l in links], 'FACTYPE':[l[2] for l in links],
+                                 'DISTANCE':[l[3].length/5280 for l in links], 'LANES_LONG':[rng.randint(1, 3) for l in links]},
+                                geometry=[l[3] for l in links], crs=net_proj)
+    nodes_df.to_file(os.path.join(case_dir, 'network', 'nodes.shp'))
+    links_df.to_file(os.path.join(case_dir, 'network', 'links.shp'))
+
+    # GTFS: up to 3 shape IDs per route (both directions and a short turn), stops at nodes and mid-block, trips every headway
+    to_lonlat = Transformer.from_crs(net_proj, 'EPSG:4326', always_xy=True)
+    stops, shapes, trips, stop_times, routes, modes = list(), list(), list(), list(), list(), list()
+    stop_ids = dict()
+    def stop_at(x, y):
+        if (round(x, 1), round(y, 1)) not in stop_ids:
+            stop_id = f'S{len(stop_ids) + 1:05d}'
+            lon, lat = to_lonlat.transform(x, y)
+            stop_ids[(round(x, 1), round(y, 1))] = stop_id
+            stops.append((stop_id, f'STOP {stop_id}', round(lat, 7), round(lon, 7)))
+        return stop_ids[(round(x, 1), round(y, 1))]
+    shape_id, trip_id = 50000, 700000
+    for r, path in enumerate(create_synthetic_routes(nodes, edges, n_routes, rng)):
+        route_id = f'R{r + 1}'
+        routes.append((route_id, 'SYN', str(r + 1), f'ROUTE {r + 1}', 3))
+        modes.append((route_id, r + 1, f'ROUTE {r + 1}', 10 + (r % 3)))
+        for v in range(rng.choice([1, 2, 2, 3])):
+            shp_path = path if v % 2 == 0 else path[::-1]
+            if v == 2:
+                shp_path = path[:max(3, len(path) * 2 // 3)]
+            shape_id += 1
+            shp_points, stop_seq = list(), list()
+            for k, N in enumerate(shp_path):
+                (x, y) = nodes[N]
+                shp_points.append((x, y))
+                if rng.random() < 0.55 or k == 0 or k == len(shp_path) - 1:
+                    stop_seq.append(stop_at(x + 20, y + 20))
+                if k < len(shp_path) - 1:
+                    (x_next, y_next) = nodes[shp_path[k + 1]]
+                    for f in (0.25, 0.5, 0.75):
+                        jitter = 3 if rng.random() < 0.8 else 150
+                        shp_points.append((x + (x_next - x) * f + rng.uniform(-jitter, jitter), y + (y_next - y) * f + rng.uniform(-jitter, jitter)))
+                    if rng.random() < 0.25:
+                        stop_seq.append(stop_at(x + (x_next - x) * 0.5 + 30, y + (y_next - y) * 0.5 + 30))
+            for s, (x, y) in enumerate(shp_points):
+                lon, lat = to_lonlat.transform(x, y)
+                shapes.append((shape_id, round(lat, 7), round(lon, 7), s + 1))
+            headway, t = rng.choice([10, 15, 20, 30, 45, 60]), 5 * 3600 + rng.randint(0, 600)
+            while t < 24 * 3600 + 1800:
+                for service_id in ([1, 2] if rng.random() < 0.3 else [1]):
+                    trip_id += 1
+                    trips.append((route_id, service_id, trip_id, f'{r + 1} ROUTE {r + 1} TO {"NORTH" if v % 2 == 0 else "SOUTH"} V{v}', v % 2, shape_id))
+                    stop_t = t
+                    for q, stop_id in enumerate(stop_seq):
+                        stop_time = f'{stop_t // 3600:02d}:{(stop_t % 3600) // 60:02d}:{stop_t % 60:02d}'
+                        stop_times.append((trip_id, stop_time, stop_time, stop_id, q + 1))
+                        stop_t += rng.randint(40, 150)
+                t += headway * 60 + rng.randint(-120, 120)
+    gtfs_path = os.path.join(case_dir, 'gtfs')
+    pd.DataFrame(stops, columns=['stop_id','stop_name','stop_lat','stop_lon']).to_csv(os.path.join(gtfs_path, 'stops.txt'), index=False)
+    pd.DataFrame(shapes, columns=['shape_id','shape_pt_lat','shape_pt_lon','shape_pt_sequence']).to_csv(os.path.join(gtfs_path, 'shapes.txt'), index=False)
+    pd.DataFrame(trips, columns=['route_id','service_id','trip_id','trip_headsign','direction_id','shape_id']).to_csv(os.path.join(gtfs_path, 'trips.txt'), index=False)
+    pd.DataFrame(stop_times, columns=['trip_id','arrival_time','departure_time','stop_id','stop_sequence']).to_csv(os.path.join(gtfs_path, 'stop_times.txt'), index=False)
+    pd.DataFrame(routes, columns=['route_id','agency_id','route_short_name','route_long_name','route_type']).to_csv(os.path.join(gtfs_path, 'routes.txt'), index=False)
+    pd.DataFrame([(1, 1, 1, 1, 1, 1, 0, 0, 20180903, 20190106), (2, 0, 0, 0, 0, 0, 1, 0, 20180903, 20190106)],
+                 columns=['service_id','monday','tuesday','wednesday','thursday','friday','saturday','sunday','start_date','end_date']).to_csv(os.path.join(gtfs_path, 'calendar.txt'), index=False)
+    pd.DataFrame(modes, columns=['ROUTE_ID','ROUTE_NO','LONG_NAME','MODE']).to_csv(os.path.join(case_dir, 'route-info', 'modes_table.csv'), index=False)
+
+    with open(os.path.join(case_dir, 'parameters.txt'), 'w') as par_file:
+        par_file.write('\n'.join(['### Synthetic benchmark case',
+                                  'day_type="monday"',
+                                  'period_times={"AM":["06:00:00","09:00:00"],"MD":["09:00:00","15:00:00"],"PM":["15:00:00","19:00:00"],"NT":["19:00:00","24:00:00"],"EA":["04:30:00","06:00:00"]}',
+                                  'modes_gtfs=[3]',
+                                  'transit_only_attributes={"FACTYPE":65,"LINKGRP":22,"CSPEEDAM":15,"NOTE":"BUS"}',
+                                  'factype_to_avoid=[70]',
+                                  'nodes_ranges_to_avoid=[[0,0],[0,2500]]',
+                                  'w_bffr=150',
+                                  'i_bffr=3000',
+                                  f'net_proj="{net_proj}"',
+                                  'plot_bool=0',
+                                  f'gtfs_path={json.dumps(gtfs_path)}',
+                                  f'net_folder={json.dumps(os.path.join(case_dir, "network"))}',
+                                  'nodes_file="nodes.shp"',
+                                  'links_file="links.shp"',
+                                  f'rte_mode_table={json.dumps(os.path.join(case_dir, "route-info", "modes_table.csv"))}',
+                                  f'scen_dir={json.dumps(os.path.join(case_dir, "scen"))}',
+                                  'use_cache=0']) + '\n')
+    return {'n_nodes':nodes_df.shape[0], 'n_links':links_df.shape[0], 'n_shapes':shape_id - 50000, 'n_stops':len(stops), 'n_trips':len(trips), 'n_stop_times':len(stop_times)}
+
+#%% Timing
+
+def time_stage(stage_times, stage, stage_depth, func):
+    # Only the outermost call of a stage is timed, so that nested calls of the same stage are not counted twice
+    @functools.wraps(func)
+    def timed_func(*args, **kwargs):
+        stage_depth[stage] += 1
+        t = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stage_depth[stage] -= 1
+            if stage_depth[stage] == 0:
+                stage_times[stage] += time.perf_counter() - t
+    return timed_func
+
+def count_merged_shps(merge_counts, func):
+    # merge_parallel_shps counting the shape IDs merged from the workers and the ones matched again in the main process
+    @functools.wraps(func)
+    def counted_func(*args, **kwargs):
+        merged_results, *merged_rest = func(*args, **kwargs)
+        merge_counts['shapes'] += len(merged_results)
+        merge_counts['rematched'] += sum(shp_result['rematched'] for shp_result in merged_results)
+        return (merged_results, *merged_rest)
+    return counted_func
+
+def run_case(case_dir, plot_bool=0, n_workers=1):
+    # Run gtfs2ptnet_main.py on a case with the stage functions of gtfs2ptnet wrapped by timers. With n_workers > 1, the stages run
+    # by the workers are not timed, only the total time. Returns the stage times and the counts of the parallel merge
+    stage_times, stage_depth = {stage:0.0 for stage in benchmark_stages}, {stage:0 for stage in benchmark_stages}
+    merge_counts = {'shapes':0, 'rematched':0}
+    parameters = os.path.join(case_dir, 'parameters.txt')
+    with open(parameters) as par_file:
+        par_lines = [l for l in par_file.read().splitlines() if not l.startswith(('plot_bool', 'n_workers'))]
+    with open(parameters, 'w') as par_file:
+        par_file.write('\n'.join(par_lines + [f'plot_bool={plot_bool}', f'n_workers={n_workers}']) + '\n')
+    for d in ['images', 'network', 'transit-only']:
+        shutil.rmtree(os.path.join(case_dir, 'scen', d), ignore_errors=True)
+        os.makedirs(os.path.join(case_dir, 'scen', d))
+
+    funcs = {name:getattr(gtfs2ptnet, name) for names in benchmark_stages.values() for name in names}
+    funcs['merge_parallel_shps'] = gtfs2ptnet.merge_parallel_shps
+    for stage, names in benchmark_stages.items():
+        for name in names:
+            setattr(gtfs2ptnet, name, time_stage(stage_times, stage, stage_depth, funcs[name]))
+    gtfs2ptnet.merge_parallel_shps = count_merged_shps(merge_counts, funcs['merge_parallel_shps'])
+    argv = sys.argv
+    sys.argv = ['gtfs2ptnet_main.py', parameters]
+    t = time.perf_counter()
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gtfs2ptnet_main.py'), run_name='__main__')
+    finally:
+        stage_times['total'] = time.perf_counter() - t
+        sys.argv = argv
+        for name, func in funcs.items():
+            setattr(gtfs2ptnet, name, func)
+    return stage_times, merge_counts
+
+#%% Results
+
+def case_key(case):
+    return f"{case['layout']}_{case['size']}"
+
+def compare_to_baseline(results, baseline, tolerance=0.25, min_seconds=0.05):
+    # A stage regressed if it is more than tolerance (relative) and min_seconds (absolute) slower than in the baseline
+    for setting in ['seed', 'plot', 'n_workers']:
+        if results[setting] != baseline[setting]:
+            raise Exception(f'Baseline run with {setting} = {baseline[setting]}, not comparable with {setting} = {results[setting]}.')
+    baseline_cases = {case_key(case):case for case in baseline['cases']}
+    regressions = list()
+    for case in results['cases']:
+        if case_key(case) not in baseline_cases:
+            continue
+        for stage, seconds in case['stages'].items():
+            baseline_seconds = baseline_cases[case_key(case)]['stages'].get(stage)
+            if baseline_seconds is not None and seconds > baseline_seconds * (1 + tolerance) and seconds - baseline_seconds > min_seconds:
+                regressions.append({'case':case_key(case), 'stage':stage, 'baseline':baseline_seconds, 'seconds':seconds, 'ratio':seconds / max(baseline_seconds, 1e-9)})
+    return regressions
+
+def write_scaling_curves(results, out_dir):
+    # One row per case with its size, stage times and parallel counts (CSV), and stage time by number of links per layout (figure)
+    scaling_df = pd.DataFrame([dict({'layout':case['layout'], 'size':case['size']}, **case['counts'], **case['stages'], **case.get('parallel', dict())) for case in results['cases']])
+    scaling_df.to_csv(os.path.join(out_dir, 'scaling.csv'), index=False)
+    layouts = scaling_df.layout.unique()
+    fig, axs = plt.subplots(1, len(layouts), figsize=(8 * len(layouts), 6), squeeze=False)
+    for ax, layout in zip(axs[0], layouts):
+        layout_df = scaling_df[scaling_df.layout == layout].sort_values(by='n_links')
+        for stage in list(benchmark_stages) + ['total']:
+            if layout_df[stage].max() > 0:
+                ax.plot(layout_df.n_links, layout_df[stage], marker='o', label=stage)
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_xlabel('Network links')
+        ax.set_ylabel('Seconds')
+        ax.set_title(f'{layout} network')
+        ax.legend(fontsize=8)
+    fig.savefig(os.path.join(out_dir, 'scaling.png'), dpi=100, bbox_inches='tight')
+    plt.close(fig)
+    return scaling_df
+
+#%% Main process below
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of gtfs2ptnet on synthetic networks and GTFS feeds.')
+    parser.add_argument('--sizes', default='1,2,4', help='Comma-separated size factors. Size s has about s times the base nodes and routes.')
+    parser.add_argument('--layouts', default='grid', help='Comma-separated network layouts: grid, radial.')
+    parser.add_argument('--base-grid', type=int, default=12, help='Nodes per side of the grid of size 1.')
+    parser.add_argument('--base-routes', type=int, default=6, help='Routes of size 1 (1 to 3 shape IDs each).')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per case, the fastest time of each stage is kept.')
+    parser.add_argument('--plot', action='store_true', help='Also render the figures (plot_bool = 1).')
+    parser.add_argument('--n-workers', type=int, default=1)
+    parser.add_argument('--out', default='benchmark', help='Output folder for results.json, scaling.csv, scaling.png and the synthetic cases.')
+    parser.add_argument('--baseline', default=None, help='results.json of a previous run to check for regressions.')
+    parser.add_argument('--save-baseline', default=None, help='Also save the results as a baseline to this file.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Relative slowdown flagged as regression.')
+    parser.add_argument('--min-seconds', type=float, default=0.05, help='Absolute slowdown, in seconds, below which a stage is never flagged.')
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    results = {'python':sys.version.split()[0], 'platform':platform.platform(), 'seed':args.seed, 'plot':int(args.plot), 'n_workers':args.n_workers, 'cases':list()}
+    for layout in args.layouts.split(','):
+        for size in [int(s) for s in args.sizes.split(',')]:
+            case_dir = os.path.abspath(os.path.join(args.out, 'cases', f'{layout}_{size}'))
+            shutil.rmtree(case_dir, ignore_errors=True)
+            counts = write_synthetic_case(case_dir, layout, max(round(args.base_grid * math.sqrt(size)), 2), args.base_routes * size, args.seed + size)
+            print(f'Case {layout}_{size}: {counts}')
+            stages, serial_total = None, None
+            for _ in range(args.repeat):
+                stage_times, merge_counts = run_case(case_dir, int(args.plot), args.n_workers)
+                stages = stage_times if stages is None else {stage:min(stages[stage], stage_times[stage]) for stage in stages}
+                if args.n_workers > 1: # serial run of the same case for the speed-up
+                    serial_times, _ = run_case(case_dir, int(args.plot), 1)
+                    serial_total = serial_times['total'] if serial_total is None else min(serial_total, serial_times['total'])
+            print('\t' + ', '.join([f'{stage} {seconds:.2f}s' for stage, seconds in stages.items()]))
+            results['cases'].append({'layout':layout, 'size':size, 'counts':counts, 'stages':stages})
+            if args.n_workers > 1:
+                parallel = {'parallel_shapes':merge_counts['shapes'], 'rematched':merge_counts['rematched'], 'rematch_rate':merge_counts['rematched'] / max(merge_counts['shapes'], 1),
+                            'serial_total':serial_total, 'speedup':serial_total / stages['total']}
+                print(f"\t{parallel['rematched']} of {parallel['parallel_shapes']} shape IDs matched again in the merge ({parallel['rematch_rate']:.0%}), "
+                      f"{parallel['speedup']:.2f}x the speed of n_workers = 1 ({serial_total:.2f}s).")
+                results['cases'][-1]['parallel'] = parallel
+
+    with open(os.path.join(args.out, 'results.json'), 'w') as results_file:
+        json.dump(results, results_file, indent=1)
+    if args.save_baseline is not None:
+        shutil.copyfile(os.path.join(args.out, 'results.json'), args.save_baseline)
+    write_scaling_curves(results, args.out)
+    print(f'Results saved in {args.out} (results.json, scaling.csv, scaling.png).')
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), args.tolerance, args.min_seconds)
+        for r in regressions:
+            print(f"REGRESSION {r['case']} {r['stage']}: {r['seconds']:.2f}s vs {r['baseline']:.2f}s in baseline ({r['ratio']:.2f}x).")
+        if len(regressions) != 0:
+            sys.exit(1)
+        print('No regressions against the baseline.')
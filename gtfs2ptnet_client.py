@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Client of the resident worker of the GTFS to Public Transit Network tool (gtfs2ptnet_worker.py).
+
+Sends a scenario job (a parameters.txt path) to the worker and prints its run log, exiting with the exit code of the run.
+Only standard libraries are imported, so the client starts at once. If no worker is listening, the job is run in this
+process as gtfs2ptnet_main.py would (unless --no-fallback). The key of the worker is read from the file it created
+(~/.gtfs2ptnet_worker.key by default).
+
+Usage:
+    python gtfs2ptnet_client.py "FULL/PATH/TO/parameters.txt" --port 6310
+    python gtfs2ptnet_client.py --stop --port 6310
+"""
+
+#%% Libraries and hard-coded inputs below
+
+from multiprocessing.connection import Client
+import argparse
+import runpy
+import sys
+import os
+
+main_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gtfs2ptnet_main.py')
+authkey_file = os.path.join(os.path.expanduser('~'), '.gtfs2ptnet_worker.key')
+
+#%% Key
+
+def read_authkey(path):
+    # Key created by the worker in path, or None if there is none (no worker was started by this user)
+    try:
+        with open(path, 'rb') as f:
+            authkey = f.read().strip()
+    except OSError:
+        return None
+    return authkey if len(authkey) != 0 else None
+
+#%% Jobs
+
+def send_job(port, authkey, job):
+    # Returns the exit code of the job, or None if there is no key or no worker is listening on port
+    if authkey is None:
+        return None
+    try:
+        conn = Client(('localhost', port), authkey=authkey)
+    except ConnectionRefusedError:
+        return None
+    with conn:
+        conn.send(job)
+        while True:
+            try:
+                message = conn.recv()
+            except EOFError:
+                print('Worker closed the connection before the end of the job.')
+                return 1
+            if message[0] == 'log':
+                sys.stdout.write(message[1])
+                sys.stdout.flush()
+            else:
+                return message[1]
+
+#%% Main process below
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Send a scenario job to gtfs2ptnet_worker.py and print its run log.')
+    parser.add_argument('parameters', nargs='?', default=None, help='Full path to parameters.txt.')
+    parser.add_argument('--port', type=int, default=6310, help='Local port the worker listens on.')
+    parser.add_argument('--authkey-file', default=authkey_file, help='File with the key created by the worker.')
+    parser.add_argument('--stop', action='store_true', help='Stop the worker.')
+    parser.add_argument('--no-fallback', action='store_true', help='Fail if no worker is listening, instead of running the job in this process.')
+    args = parser.parse_args()
+    authkey = read_authkey(args.authkey_file)
+
+    if args.stop:
+        exit_code = send_job(args.port, authkey, ('stop',))
+        print('Worker stopped.' if exit_code is not None else f'No worker listening on localhost:{args.port}.')
+        sys.exit(0)
+    if args.parameters is None:
+        parser.error('the path to parameters.txt is required')
+
+    parameters = os.path.abspath(args.parameters)
+    exit_code = send_job(args.port, authkey, ('run', parameters))
+    if exit_code is None:
+        if args.no_fallback:
+            print(f'No worker listening on localhost:{args.port}.')
+            sys.exit(1)
+        print(f'No worker listening on localhost:{args.port}, running the job in this process.')
+        sys.argv = [main_file, parameters]
+        runpy.run_path(main_file, run_name='__main__')
+        exit_code = 0
+    sys.exit(exit_code)
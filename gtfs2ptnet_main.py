@@ -11,7 +11,6 @@ Tool development: Nov 2022 - Feb 2023.
 #%% Libraries and hard-coded inputs below
 
 import pandas as pd
-import geopandas as gpd
 import os
 # import warnings
 # warnings.filterwarnings("ignore")
@@ -36,8 +35,20 @@ if __name__=='__main__':
     net_proj,
     plot_bool,
     nodes_files,
-    links_file
+    links_file,
+    n_workers, plot_workers, plot_queue, plot_dpi, plot_format, plot_changed_only, use_cache, cache_dir, incremental, dedup_shps, dedup_tolerance, profile_bool, profile_top, profile_cprofile, net_cell_size, sweep_w_bffr, sweep_i_bffr, sweep_factype_to_avoid, sweep_workers (optional)
     '''
+    n_workers = 1 # Shape IDs matched in parallel if n_workers > 1
+    plot_workers, plot_queue = 1, 8 # Processes rendering figures in background and maximum number of figures waiting to be rendered
+    plot_dpi, plot_format = 600, 'jpeg'
+    plot_changed_only = 0 # Only render figures of shape IDs that changed since the last run
+    use_cache, cache_dir = 1, None # Cache of the inputs already read (default folder scen_dir/cache)
+    incremental = 0 # Reuse the lines of the previous run (or interrupted run) whose shape and stops did not change
+    dedup_shps, dedup_tolerance = 1, 10 # Match once the shape IDs with the same stops and shapes within dedup_tolerance (ft)
+    profile_bool, profile_top, profile_cprofile = 0, 10, 0 # Run report with the time of each stage and shape ID, number of slowest shape IDs listed, cProfile stats
+    net_cell_size = 10560 # Size of the grid cells (network units) used to restrict the cleaned network to the service area of the shapes for matching (0: whole network)
+    sweep_w_bffr, sweep_i_bffr, sweep_factype_to_avoid = None, None, None # Lists of values to compare (sweep mode, no outputs but the comparison table)
+    sweep_workers = 0 # Processes running the sweep variants (0: one per CPU, up to the number of variants)
 
     # Read parameters.txt and execute each line
     print(f'Importing parameters/inputs from {parameters}.')
@@ -60,146 +71,239 @@ if __name__=='__main__':
                 exec(line)
                 print(f"\tInput: {line}.")
     print('\tDone importing parameters/inputs.')
+    cache_dir = (cache_dir or os.path.join(scen_dir, 'cache')) if use_cache == 1 else None
+    if profile_bool == 1:
+        start_profile(profile_cprofile)
     
     t0 = time.time()
-    # Read network nodes and links
-    base_nodes_df, base_links_df = read_network_shp(net_folder, nodes_file, links_file, net_proj)
-    new_nodes_from = max(base_nodes_df.N) + 1
+    # Read GTFS files
+    gtfs_stops_df, gtfs_shapes_df, gtfs_trips_df, gtfs_routes_df, gtfs_stop_times_df, gtfs_calendar_df = read_gtfs(gtfs_path, net_proj, cache_dir, day_type, modes_gtfs)
     
-    # Network cleaning
-    nodes_df, links_df = net_cleaning(base_nodes_df, base_links_df, nodes_ranges_to_avoid, factype_to_avoid)
+    # Index trips, route and shape points by shape ID
+    gtfs_shape_index = create_gtfs_shape_index(gtfs_shapes_df, gtfs_trips_df, gtfs_routes_df)
+    route_modes = read_route_modes(rte_mode_table)
     
-    # Read GTFS files
-    gtfs_stops_df, gtfs_shapes_df, gtfs_trips_df, gtfs_routes_df, gtfs_stop_times_df, gtfs_calendar_df = read_gtfs(gtfs_path, net_proj)
+    # Read network nodes and links, and network cleaning. Only the network cells within the largest buffer of the shapes are read for matching
+    service_area = create_service_area(gtfs_shape_index, modes_gtfs, max([w_bffr, i_bffr] + list(sweep_w_bffr or []) + list(sweep_i_bffr or []))) if net_cell_size > 0 else None
+    base_network, nodes_df, links_df, links_sindex = read_clean_network(net_folder, nodes_file, links_file, net_proj, nodes_ranges_to_avoid, factype_to_avoid, cache_dir, service_area, net_cell_size)
+    new_nodes_from = base_network['N'].max() + 1
+    
+    # Calculate headways of all shapes and periods
+    shp_headways = calculate_headways_by_shp(gtfs_trips_df, gtfs_calendar_df, gtfs_stop_times_df, day_type, period_times)
+    
+    # Sweep mode: all shape IDs matched once per combination of the sweep values, with the GTFS and network read above, and compared in sweep.csv
+    if sweep_w_bffr is not None or sweep_i_bffr is not None or sweep_factype_to_avoid is not None:
+        t1 = time.time()
+        variants = create_sweep_variants(sweep_w_bffr or [w_bffr], sweep_i_bffr or [i_bffr], sweep_factype_to_avoid or [factype_to_avoid])
+        shp_ids = [shp_id for shp_id in gtfs_shapes_df.shape_id.unique() if shp_id in gtfs_shape_index and gtfs_shape_index[shp_id]['route_mode'] in modes_gtfs and np.sum(shp_headways[shp_id]) != 0]
+        shp_groups = group_duplicate_shps(gtfs_shape_index, hash_shps(gtfs_shape_index, gtfs_stop_times_df, gtfs_stops_df), dedup_tolerance) if dedup_shps == 1 else {shp_id:shp_id for shp_id in gtfs_shape_index}
+        print(f'Sweep of {len(variants)} variants over {len(shp_ids)} shape IDs.')
+        sweep_context = {'base_nodes_df':base_network['nodes'], 'base_links_df':base_network['links'], 'nodes_df':nodes_df, 'links_df':links_df, 'links_bounds':links_sindex['bounds'],
+                         'nodes_ranges_to_avoid':nodes_ranges_to_avoid, 'factype_to_avoid':factype_to_avoid, 'transit_only_attributes':transit_only_attributes, 'new_nodes_from':new_nodes_from,
+                         'shp_ids':shp_ids, 'shp_groups':shp_groups, 'gtfs_shape_index':gtfs_shape_index, 'gtfs_stop_times_df':gtfs_stop_times_df, 'gtfs_stops_df':gtfs_stops_df}
+        sweep_df = run_sweep(variants, sweep_workers, sweep_context)
+        os.makedirs(os.path.join(scen_dir, 'sweep'), exist_ok=True)
+        sweep_df.to_csv(os.path.join(scen_dir, 'sweep', 'sweep.csv'), index=False)
+        print(sweep_df.to_string(index=False))
+        print(f"\tSweep table saved in {os.path.join(scen_dir, 'sweep', 'sweep.csv')}. Total time {time.time()-t1:.2f} seconds.")
+        print(f'GTFS to Public Transit Network sweep done. Total time {time.time()-t0:.2f} seconds.')
+        sys.exit()
+    
+    # Lines written to PTlines.lin in shape order, as soon as they are matched
+    lin_writer = open_lin_writer(os.path.join(scen_dir,'transit-only','PTlines.lin'))
+    transit_only_nodes = create_transit_only_nodes()
+    transit_only_links = create_transit_only_links(transit_only_attributes)
+    
+    # Manifest of the lines matched, checkpointed after each shape ID. In incremental mode, the lines of unchanged shape IDs are reused
+    # with the transit-only nodes and links they created or use, and the changed shape IDs are matched to the network with them.
+    shp_hashes = hash_shps(gtfs_shape_index, gtfs_stop_times_df, gtfs_stops_df)
+    run_key = create_run_key(nodes_df, links_df, links_sindex, w_bffr, transit_only_attributes)
+    manifest_shps = read_manifest(scen_dir, run_key) if incremental == 1 else dict()
+    reuse_shp_ids = find_reusable_shps(manifest_shps, shp_hashes)
+    manifest_shps, transit_only_nodes, transit_only_links, new_nodes_from = preserve_manifest_shps(manifest_shps, reuse_shp_ids, transit_only_nodes, transit_only_links, transit_only_attributes, new_nodes_from)
+    if incremental == 1:
+        print(f'Incremental mode: {len(reuse_shp_ids)} shape IDs reused from previous run.')
+    create_checkpoint(scen_dir, run_key)
+    new_manifest_shps = list()
+    parallel_lines = list()
+    
+    # Shape IDs with the same stops and shape take the node sequence of the first one of their group
+    shp_groups = group_duplicate_shps(gtfs_shape_index, shp_hashes, dedup_tolerance) if dedup_shps == 1 else {shp_id:shp_id for shp_id in gtfs_shape_index}
+    group_lines = dict()
+    dedup_lines = list()
     
-    lines = list()
-    transit_only_nodes_df = pd.DataFrame()
-    transit_only_links_df = pd.DataFrame()
+    network = create_network_overlay(nodes_df, links_df, links_sindex, transit_only_nodes, transit_only_links)
+    plot_renderer = create_plot_renderer(scen_dir, plot_workers, plot_queue, plot_changed_only) if plot_bool == 1 else None
     for shp_id in gtfs_shapes_df.shape_id.unique():
         t1 = time.time()
         
         # Line/Route ID, mode, and first trip ID
-        if shp_id not in gtfs_trips_df.shape_id.tolist():
+        if shp_id not in gtfs_shape_index:
             print(f"Shape ID {shp_id} not found in GTFS 'trips.txt'.")
             continue
         
-        route_id = gtfs_trips_df.loc[gtfs_trips_df.shape_id == shp_id, 'route_id'].unique()[0]
-        route_mode = gtfs_routes_df[gtfs_routes_df['route_id'] == route_id].route_type.values[0]
-        route_trip_id = gtfs_trips_df.loc[gtfs_trips_df.shape_id == shp_id, 'trip_id'].unique()[0]
+        shp_id_index = gtfs_shape_index[shp_id]
+        route_id = shp_id_index['route_id']
+        route_mode = shp_id_index['route_mode']
+        route_trip_id = shp_id_index['route_trip_id']
         
         if route_mode not in modes_gtfs: # If shp_id's mode not in the list of modes to be processed, move to next shp_id
             print(f"Shape ID {shp_id} is a Route Mode {route_mode} not of interest.")    
             continue
         
-        shp_id_headsign = gtfs_trips_df.loc[gtfs_trips_df.shape_id == shp_id,'trip_headsign'].values[0]
+        shp_id_headsign = shp_id_index['headsign']
         print(f'Processing Shape ID {shp_id}.\n\tRoute headsign: {shp_id_headsign}')
        
         # Create the line dictionary to store line's attributes as id, name, mode, and headways for .LIN file.
         line = dict()
         line['id'] = shp_id
-        line['mode'] = read_route_mode_id(rte_mode_table, route_id)
+        line['mode'] = read_route_mode_id(route_modes, route_id)
         
         # Line name
-        head_sign = gtfs_trips_df.loc[gtfs_trips_df.shape_id == shp_id, 'trip_headsign'].unique()[0]
-        line_name = set_line_name(head_sign, shp_id)
+        line_name = set_line_name(shp_id_headsign, shp_id)
         line['name'] = line_name
         
-        # Calculate headways
-        line['headways'] = list()
-        for t in period_times:
-            period_time = period_times[t]
-            arr_times_by_shp_srvc_time = list_arrival_times_by_shp_service_time(gtfs_trips_df, gtfs_calendar_df, gtfs_stop_times_df, shp_id, day_type, period_time)
-            headway_by_shp_srvc_time = calculate_headway(arr_times_by_shp_srvc_time)
-            line['headways'].append(headway_by_shp_srvc_time)
+        # Headways
+        line['headways'] = list(shp_headways[shp_id])
         
         # Skip line if headways all zeros
         if np.sum(line['headways'])==0:
-            print(f'\tLINE SKIPPED DUE TO HEADWAYS ALL ZEROS.')
+            print('\tLINE SKIPPED DUE TO HEADWAYS ALL ZEROS.')
             print(f'\tShape ID {shp_id} processing done. Total time {time.time()-t1:.2f} seconds.')
             continue
         
-        # Filter gtfs_shapes_df by shp_id and create the shape id line
-        shp_id_df = gtfs_shapes_df[gtfs_shapes_df.shape_id == shp_id].copy().reset_index(drop=True)
-        shp_id_line = LineString(shp_id_df.geometry.values)
-        
-        # Find links within route shape and intersecting route shape
-        shp_id_line_buffer_w = gpd.GeoDataFrame({'shp_id':shp_id, 'geometry':[shp_id_line.buffer(w_bffr, cap_style=3)]}, crs=shp_id_df.crs)
-        links_within_shp_df = gpd.sjoin(links_df, shp_id_line_buffer_w, how='inner', predicate='within')
-        links_within_shp_df['AB'] = links_within_shp_df.A.astype('int').astype('str') + '_' + links_within_shp_df.B.astype('int').astype('str')
-        links_within_shp_no_transit_df = links_within_shp_df[~links_within_shp_df.AB.isin(transit_only_links_df.AB.to_list())] if transit_only_links_df.shape[0] != 0 else links_within_shp_df
-        shp_id_line_buffer_i = gpd.GeoDataFrame({'shp_id':shp_id, 'geometry':[shp_id_line.buffer(i_bffr)]}, crs=shp_id_df.crs)
-        links_intersecting_shp_df = gpd.sjoin(links_df, shp_id_line_buffer_i, how='inner', predicate='intersects')
-        links_intersecting_shp_df['AB'] = links_intersecting_shp_df.A.astype('int').astype('str') + '_' + links_intersecting_shp_df.B.astype('int').astype('str')
-        links_intersecting_shp_no_transit_df = links_intersecting_shp_df[~links_intersecting_shp_df.AB.isin(transit_only_links_df.AB.to_list())] if transit_only_links_df.shape[0] != 0 else links_intersecting_shp_df
-        
-        # Find nodes within route shape
-        nodes_within_shp_df = find_nodes_within_shp(nodes_df, links_within_shp_df, shp_id_df)
-        nodes_within_shp_no_transit_df = nodes_within_shp_df[~nodes_within_shp_df.N.isin(transit_only_nodes_df.N.to_list())] if transit_only_nodes_df.shape[0] != 0 else nodes_within_shp_df
-        
-        # Line's stops matched to nodes
-        line_stops = match_stops_and_nodes(gtfs_stop_times_df, gtfs_stops_df, nodes_within_shp_no_transit_df, route_trip_id)
-        
-        # Set node to None if stop not within original network links
-        links_within_shp_buffer_df = gpd.GeoDataFrame({'geometry':[link.buffer(w_bffr, cap_style=3) for link in links_within_shp_no_transit_df.geometry]}, crs=shp_id_df.crs)
-        stops_within_links_df = gpd.sjoin(line_stops, links_within_shp_buffer_df, how='inner', predicate='within').sort_values(by='stop_sequence').drop_duplicates(subset=['stop_sequence'])
-        line_stops.loc[line_stops.stop_sequence.isin([s for s in line_stops.stop_sequence.to_list() if s not in stops_within_links_df.stop_sequence.to_list()]), 'N'] = None
+        # Line of a shape ID with the same stops and shape as a shape ID already processed. Its node sequence is set now, or after
+        # matching if the shape ID of the group is matched by the process pool
+        if shp_groups[shp_id] in group_lines:
+            group_line = group_lines[shp_groups[shp_id]]
+            if "node_seq" in group_line:
+                line["node_seq"] = list(group_line["node_seq"])
+                created_pos = (len(transit_only_nodes['cols']['N']), len(transit_only_links['cols']['A']))
+                new_manifest_shps.append(create_manifest_shp(shp_id, shp_hashes, line["node_seq"], transit_only_nodes, transit_only_links, created_pos))
+                write_checkpoint(scen_dir, new_manifest_shps[-1])
+            else:
+                dedup_lines.append((line, group_line))
+            add_lin_line(lin_writer, line)
+            print(f'\tSame stops and shape as Shape ID {group_line["id"]}, node sequence reused.')
+            continue
+        group_lines[shp_groups[shp_id]] = line
         
-        # Before creating new nodes for the nodes with None values, search for them in the transit-only nodes
-        line_stops = match_stops_and_transit_nodes(line_stops, transit_only_nodes_df, gtfs_stop_times_df, gtfs_stops_df, nodes_within_shp_df, route_trip_id)
+        # Line of unchanged shape ID reused from previous run
+        if shp_id in reuse_shp_ids:
+            line["node_seq"] = manifest_shps[shp_id]['node_seq']
+            new_manifest_shps.append(manifest_shps[shp_id])
+            write_checkpoint(scen_dir, manifest_shps[shp_id])
+            add_lin_line(lin_writer, line)
+            print('\tLine reused from previous run.')
+            continue
         
-        # Create networkx
-        G = create_netx(nodes_within_shp_df, links_within_shp_df)
+        # Shape IDs matched later by the process pool
+        if n_workers > 1:
+            add_lin_line(lin_writer, line)
+            parallel_lines.append(line)
+            continue
         
-        # Create node and link sequence
-        line_node_seq, G, line_stops, transit_only_nodes_df, transit_only_links_df, new_nodes_from = create_node_seq(G, line_stops, transit_only_nodes_df, transit_only_links_df, transit_only_attributes, shp_id_line, nodes_within_shp_df, new_nodes_from, w_bffr, gtfs_stop_times_df, gtfs_stops_df, route_trip_id)
-        line_node_seq_df, line_link_seq_df = create_node_and_link_seq_gdf(line_node_seq, line_stops, nodes_within_shp_df, links_within_shp_df, transit_only_nodes_df, transit_only_links_df)
+        # Match shape to the network and create transit-only nodes and links for the gaps
+        start_profile_shp(shp_id)
+        created_pos = (len(transit_only_nodes['cols']['N']), len(transit_only_links['cols']['A']))
+        line_node_seq_df, line_link_seq_df, links_intersecting_shp_no_transit_df, transit_only_nodes, transit_only_links, new_nodes_from = match_shp_to_network(shp_id, shp_id_index, network, transit_only_nodes, transit_only_links, transit_only_attributes, new_nodes_from, w_bffr, i_bffr, gtfs_stop_times_df, gtfs_stops_df)
         line["node_seq"] = line_node_seq_df.N.to_list()
-        
-        # Update nodes and links for next routes
-        nodes_df, links_df = update_nodes_links_with_transit_only(nodes_df, links_df, transit_only_nodes_df, transit_only_links_df)
+        new_manifest_shps.append(create_manifest_shp(shp_id, shp_hashes, line["node_seq"], transit_only_nodes, transit_only_links, created_pos))
+        write_checkpoint(scen_dir, new_manifest_shps[-1])
         
         # Skip line if no node sequence
         if len(line["node_seq"]) == 0:
-            print(f'\tLINE SKIPPED DUE TO NO NODE SEQUENCE.')
+            end_profile_shp()
+            print('\tLINE SKIPPED DUE TO NO NODE SEQUENCE.')
             print(f'\tShape ID {shp_id} processing done. Total time {time.time()-t1:.2f} seconds.')
             continue
         
-        # Append line to list of lines that will be saved later as PTlines.LIN
-        lines.append(line)
+        # Write line to PTlines.LIN
+        add_lin_line(lin_writer, line)
         print(f'\tShape ID {shp_id} processing done. Total time {time.time()-t1:.2f} seconds.')
         
-        # Plot and save figure
+        # Queue figure to be rendered in background
         if plot_bool == 1:
-            t2 = time.time()
+            transit_only_nodes_df, transit_only_links_df = transit_only_gdf(transit_only_nodes), transit_only_gdf(transit_only_links)
             title = f'{shp_id_headsign} - Shape ID {shp_id}'
-            plot(scen_dir, shp_id_df, gtfs_trips_df, line_node_seq_df, line_link_seq_df, links_intersecting_shp_no_transit_df, transit_only_nodes_df, transit_only_links_df, w_bffr, i_bffr, title, figsize=(20,20))
-            print(f'\tFigure saved. Total time for plotting and saving figure {time.time()-t2:.2f} seconds.')
-        
-    # Save new base_nodes.shp and base_links.shp
-    new_base_nodes_df, new_base_links_df = update_nodes_links_with_transit_only(base_nodes_df, base_links_df, transit_only_nodes_df, transit_only_links_df)
-    write_network_csv_shp(scen_dir, new_base_nodes_df, new_base_links_df, nodes_file, links_file)
-    print('New nodes and links shapefiles saved.')
+            if submit_plot(plot_renderer, shp_id_index['shape_df'], line_node_seq_df, line_link_seq_df, links_intersecting_shp_no_transit_df, transit_only_nodes_df, transit_only_links_df, w_bffr, i_bffr, title, (20,20), plot_dpi, plot_format):
+                print('\tFigure queued.')
+            else:
+                print('\tFigure skipped, shape ID did not change.')
+        end_profile_shp()
     
-    # Write lin file
-    write_lin_file(lines, os.path.join(scen_dir,'transit-only','PTlines.lin'))
+    # Parallel matching against the base network, then merge in shape order, as in a serial run
+    if n_workers > 1:
+        t1 = time.time()
+        print(f'Matching {len(parallel_lines)} shape IDs with {n_workers} workers.')
+        shp_results = match_shps_parallel([line['id'] for line in parallel_lines], gtfs_shape_index, n_workers, nodes_df, links_df, transit_only_attributes, new_nodes_from, w_bffr, i_bffr, gtfs_stop_times_df, gtfs_stops_df, plot_bool, profile_bool)
+        shp_results, transit_only_nodes, transit_only_links, new_nodes_from = merge_parallel_shps(shp_results, network, transit_only_nodes, transit_only_links, transit_only_attributes, new_nodes_from, gtfs_shape_index, w_bffr, i_bffr, gtfs_stop_times_df, gtfs_stops_df, plot_bool)
+        print(f"\tDone matching shape IDs, {sum(shp_result['rematched'] for shp_result in shp_results)} matched again after the transit-only links of previous shape IDs. Total time {time.time()-t1:.2f} seconds.")
+        for line, shp_result in zip(parallel_lines, shp_results):
+            add_profile_shp(shp_result['profile'])
+            for c in shp_result['path_cache']:
+                network['path_cache'][c] += shp_result['path_cache'][c]
+            line["node_seq"] = shp_result['node_seq']
+            new_manifest_shps.append(create_manifest_shp(line['id'], shp_hashes, line["node_seq"], transit_only_nodes, transit_only_links, shp_result['created_pos'], shp_result['created_end']))
+            write_checkpoint(scen_dir, new_manifest_shps[-1])
+            write_lin_lines(lin_writer)
+            if len(line["node_seq"]) == 0:
+                print(f'\tShape ID {line["id"]} SKIPPED DUE TO NO NODE SEQUENCE.')
+                continue
+            
+            # Queue figure to be rendered in background
+            if plot_bool == 1:
+                line_node_seq_df, line_link_seq_df, links_intersecting_shp_no_transit_df = shp_result['plot']
+                line_node_seq_df['N'] = remap_node_ids(line_node_seq_df.N.to_list(), shp_result['ids_map'])
+                line_link_seq_df['A'] = remap_node_ids(line_link_seq_df.A.to_list(), shp_result['ids_map'])
+                line_link_seq_df['B'] = remap_node_ids(line_link_seq_df.B.to_list(), shp_result['ids_map'])
+                transit_only_nodes_df, transit_only_links_df = transit_only_gdf(transit_only_nodes).iloc[:shp_result['created_end'][0]], transit_only_gdf(transit_only_links).iloc[:shp_result['created_end'][1]] # as when the shape ID was merged
+                title = f'{gtfs_shape_index[line["id"]]["headsign"]} - Shape ID {line["id"]}'
+                submit_plot(plot_renderer, gtfs_shape_index[line["id"]]['shape_df'], line_node_seq_df, line_link_seq_df, links_intersecting_shp_no_transit_df, transit_only_nodes_df, transit_only_links_df, w_bffr, i_bffr, title, (20,20), plot_dpi, plot_format)
+    
+    # Node sequence of the shape IDs deduplicated whose group was matched by the process pool, each line keeps its own name and headways
+    for line, group_line in dedup_lines:
+        line["node_seq"] = list(group_line["node_seq"])
+        created_pos = (len(transit_only_nodes['cols']['N']), len(transit_only_links['cols']['A']))
+        new_manifest_shps.append(create_manifest_shp(line['id'], shp_hashes, line["node_seq"], transit_only_nodes, transit_only_links, created_pos))
+        write_checkpoint(scen_dir, new_manifest_shps[-1])
+    close_lin_writer(lin_writer)
     print('PTLines.lin file saved.')
+    print(f"Stop pair path cache: {network['path_cache']['hits']} hits, {network['path_cache']['misses']} misses.")
     
-    # Save transit only nodes and links file (CSV and DBF)
+    # Save new base_nodes.shp and base_links.shp and transit only nodes and links file (CSV and DBF), all at the same time
+    transit_only_nodes_df, transit_only_links_df = transit_only_gdf(transit_only_nodes), transit_only_gdf(transit_only_links)
+    writers = [(write_network_csv_shp, (scen_dir, base_network, transit_only_nodes_df, transit_only_links_df, nodes_file, links_file))]
     if transit_only_nodes_df.shape[0] != 0:
         nodes_cols = list(transit_only_nodes_df.columns)
         nodes_cols.remove('geometry')
-        nodes_csv = os.path.join(scen_dir,'transit-only','PTOnlyNodes.csv')
-        transit_only_nodes_df[nodes_cols].to_csv(nodes_csv, index=False)
-        nodes_dbf = nodes_csv.replace('csv','dbf')
-        write_nodes_dbf(transit_only_nodes_df[nodes_cols], nodes_dbf)
-        print('PTOnlyNodes CSV and DBF files saved.')
+        writers.append((write_csv_dbf, (pd.DataFrame(transit_only_nodes_df[nodes_cols]), os.path.join(scen_dir,'transit-only','PTOnlyNodes.csv'))))
     if transit_only_links_df.shape[0] != 0:
         links_cols = list(transit_only_links_df.columns)
         links_cols = [c for c in links_cols if c not in ['AB', 'geometry']]
-        links_csv = os.path.join(scen_dir,'transit-only','PTOnlyLinks.csv')
-        transit_only_links_df[links_cols].to_csv(links_csv, index=False)
-        links_dbf = links_csv.replace('csv','dbf')
-        write_links_dbf(transit_only_links_df[links_cols], links_dbf)
+        writers.append((write_csv_dbf, (pd.DataFrame(transit_only_links_df[links_cols]), os.path.join(scen_dir,'transit-only','PTOnlyLinks.csv'))))
+    write_outputs(writers)
+    print('New nodes and links shapefiles saved.')
+    if transit_only_nodes_df.shape[0] != 0:
+        print('PTOnlyNodes CSV and DBF files saved.')
+    if transit_only_links_df.shape[0] != 0:
         print('PTOnlyLinks CSV and DBF files saved.')
     
+    # Manifest of this run, for the next incremental run
+    write_manifest(scen_dir, run_key, new_manifest_shps)
+    
+    # Wait for the figures still being rendered
+    if plot_bool == 1:
+        t1 = time.time()
+        print('Waiting for figures to be saved.')
+        plots_saved, plots_skipped = close_plot_renderer(plot_renderer)
+        print(f'\t{plots_saved} figures saved and {plots_skipped} skipped. Total time waiting for figures {time.time()-t1:.2f} seconds.')
+    
+    # Run report with the time of each stage and shape ID
+    if profile_bool == 1:
+        slowest_shps = write_profile_report(stop_profile(), os.path.join(scen_dir, 'profile'), profile_top)
+        print(f"Run report saved in {os.path.join(scen_dir, 'profile')}. Slowest shape IDs:")
+        for shp in slowest_shps:
+            print(f"\tShape ID {shp['shp_id']}: {shp['seconds']:.2f} seconds, mostly in {', '.join(shp['top_spans'])}.")
+    
     print(f'GTFS to Public Transit Network done. Total time {time.time()-t0:.2f} seconds.')
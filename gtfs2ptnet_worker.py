@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Resident worker of the GTFS to Public Transit Network tool for repeated scenario runs.
+
+Imports the libraries once and keeps the GTFS and network already read in memory, then runs gtfs2ptnet_main.py for each
+scenario job (a parameters.txt path) received on a local address, one job at a time. The run log is sent back to
+gtfs2ptnet_client.py, which is the step called by the Cube application (GNPIL00A.S).
+
+Jobs are only accepted from clients with the key of the worker: a random key created on the first start in a file that only
+the user can read (~/.gtfs2ptnet_worker.key by default), which the client reads from the same file.
+
+Usage:
+    python gtfs2ptnet_worker.py --port 6310
+    python gtfs2ptnet_client.py "FULL/PATH/TO/parameters.txt" --port 6310
+    python gtfs2ptnet_client.py --stop --port 6310
+"""
+
+#%% Libraries and hard-coded inputs below
+
+import gtfs2ptnet
+from multiprocessing.connection import Listener
+from multiprocessing import AuthenticationError
+import argparse
+import contextlib
+import traceback
+import secrets
+import runpy
+import time
+import sys
+import os
+
+main_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gtfs2ptnet_main.py')
+authkey_file = os.path.join(os.path.expanduser('~'), '.gtfs2ptnet_worker.key')
+
+#%% Key
+
+def read_or_create_authkey(path):
+    # Key shared with the clients: created at random in path (readable by the user only) if missing, otherwise read from it
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        if os.name == 'posix' and os.stat(path).st_mode & 0o077:
+            raise Exception(f"Key file {path} can be read by other users. Remove it or restrict it to the user (chmod 600).")
+        with open(path, 'rb') as f:
+            authkey = f.read().strip()
+        if len(authkey) == 0:
+            raise Exception(f"Key file {path} is empty. Remove it to create a new key.")
+        return authkey
+    authkey = secrets.token_hex(32).encode()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(authkey)
+    print(f'Worker key created in {path}.')
+    return authkey
+
+#%% Jobs
+
+class LogWriter:
+    # stdout of a job: each line is printed in the worker terminal and sent to the client. If the client is gone, the job goes on
+    def __init__(self, conn):
+        self.conn, self.text = conn, ''
+
+    def write(self, text):
+        sys.__stdout__.write(text)
+        self.text += text
+        if '\n' in self.text:
+            lines, self.text = self.text.rsplit('\n', 1)
+            self.send(lines + '\n')
+        return len(text)
+
+    def flush(self):
+        if self.text != '':
+            self.send(self.text)
+            self.text = ''
+        sys.__stdout__.flush()
+
+    def send(self, text):
+        if self.conn is not None:
+            try:
+                self.conn.send(('log', text))
+            except OSError:
+                self.conn = None
+
+def run_job(conn, parameters):
+    # Run gtfs2ptnet_main.py in this process, as if called with parameters. Returns the exit code of the run
+    log_writer = LogWriter(conn)
+    argv = sys.argv
+    sys.argv = [main_file, parameters]
+    exit_code = 0
+    try:
+        with contextlib.redirect_stdout(log_writer):
+            try:
+                runpy.run_path(main_file, run_name='__main__')
+            except SystemExit as e:
+                exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception:
+                traceback.print_exc(file=sys.stdout)
+                exit_code = 1
+            log_writer.flush()
+    finally:
+        sys.argv = argv
+        gtfs2ptnet.stop_profile() # run report of a job stopped before the end
+    return exit_code
+
+def serve_jobs(port, authkey, memory_entries):
+    # Jobs are ('run', parameters) or ('stop',). Clients waiting while a job runs are served in order
+    gtfs2ptnet.keep_tables_in_memory(memory_entries)
+    with Listener(('localhost', port), authkey=authkey) as listener:
+        print(f'GTFS to Public Transit Network worker listening on localhost:{port}.')
+        while True:
+            try:
+                conn = listener.accept()
+            except (AuthenticationError, OSError):
+                continue
+            with conn:
+                try:
+                    job = conn.recv()
+                except (EOFError, OSError):
+                    continue
+                if job[0] == 'stop':
+                    conn.send(('done', 0, 0.0))
+                    print('Worker stopped.')
+                    return
+                t = time.time()
+                print(f'Job received: {job[1]}.')
+                exit_code = run_job(conn, job[1])
+                print(f'Job done with exit code {exit_code}. Total time {time.time()-t:.2f} seconds.')
+                try:
+                    conn.send(('done', exit_code, time.time()-t))
+                except OSError:
+                    pass
+
+#%% Main process below
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Resident worker running gtfs2ptnet_main.py for the jobs sent by gtfs2ptnet_client.py.')
+    parser.add_argument('--port', type=int, default=6310, help='Local port the worker listens on.')
+    parser.add_argument('--authkey-file', default=authkey_file, help='File with the key shared with the client, created at random if missing.')
+    parser.add_argument('--memory-entries', type=int, default=4, help='GTFS and network caches kept in memory (0: always read from the cache folders).')
+    args = parser.parse_args()
+
+    serve_jobs(args.port, read_or_create_authkey(args.authkey_file), args.memory_entries)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Shortest paths on the routing graph compared with networkx shortest_path on a grid with many ties.
+
+Usage:
+    python -m unittest discover tests
+"""
+
+import unittest
+import random
+import geopandas as gpd
+from shapely.geometry import LineString
+import gtfs2ptnet
+
+try:
+    import networkx as nx
+except ImportError:
+    nx = None
+
+def create_grid_links(size, seed):
+    # Links of a size x size grid with unit spacing in both directions, in shuffled order, so that many paths have the same length
+    rng = random.Random(seed)
+    node_id = lambda i, j: 1001 + i * size + j
+    links = list()
+    for i in range(size):
+        for j in range(size):
+            for (di, dj) in [(1, 0), (0, 1)]:
+                if i + di < size and j + dj < size:
+                    links.append((node_id(i, j), node_id(i + di, j + dj), LineString([(i, j), (i + di, j + dj)])))
+                    links.append((node_id(i + di, j + dj), node_id(i, j), LineString([(i + di, j + dj), (i, j)])))
+    rng.shuffle(links)
+    return gpd.GeoDataFrame({'A':[l[0] for l in links], 'B':[l[1] for l in links]}, geometry=[l[2] for l in links])
+
+def create_netx(links):
+    G = nx.DiGraph()
+    G.add_edges_from([(A, B, {'length':geometry.length}) for A, B, geometry in zip(links.A, links.B, links.geometry)])
+    return G
+
+def netx_shortest_path(G, source, target):
+    try:
+        return nx.shortest_path(G, source=source, target=target, weight='length')
+    except (nx.NetworkXNoPath, nx.NodeNotFound):
+        return None
+
+@unittest.skipIf(nx is None, 'networkx not installed')
+class FindShortestPathTest(unittest.TestCase):
+    def assert_same_paths(self, G, nx_G, nodes):
+        for source in nodes:
+            for target in nodes:
+                self.assertEqual(gtfs2ptnet.find_shortest_path(G, source, target), netx_shortest_path(nx_G, source, target), (source, target))
+
+    def test_grid(self):
+        links_df = create_grid_links(8, seed=1)
+        G = gtfs2ptnet.create_shp_graph(gtfs2ptnet.create_routing_graph(links_df), links_df)
+        self.assert_same_paths(G, create_netx(links_df), sorted(set(links_df.A)))
+
+    def test_shape_view_with_new_links(self):
+        # View of part of the links, with links added (new and already in the view) and removed as in test_new_link
+        links_df = create_grid_links(7, seed=2)
+        shp_links_df = links_df[[random.Random(3).random() < 0.8 for _ in range(links_df.shape[0])]]
+        G, nx_G = gtfs2ptnet.create_shp_graph(gtfs2ptnet.create_routing_graph(links_df), shp_links_df), create_netx(shp_links_df)
+        for A, B, length in [(1001, 1049, 1.0), (1049, 1001, 1.0), (1010, 1011, 0.5), (1020, 1027, 1.0), (1027, 1020, 1.0), (1001, 1060, 3.0)]:
+            gtfs2ptnet.add_shp_graph_edge(G, A, B, length)
+            nx_G.add_edges_from([(A, B, {'length':length})])
+        for A, B in [(1020, 1027), (shp_links_df.A.iloc[0], shp_links_df.B.iloc[0])]:
+            gtfs2ptnet.remove_shp_graph_edge(G, A, B)
+            nx_G.remove_edge(A, B)
+        gtfs2ptnet.add_shp_graph_edge(G, shp_links_df.A.iloc[0], shp_links_df.B.iloc[0], 1.0)
+        nx_G.add_edges_from([(shp_links_df.A.iloc[0], shp_links_df.B.iloc[0], {'length':1.0})])
+        self.assert_same_paths(G, nx_G, sorted(set(links_df.A)) + [1060])
+
+    def test_path_cache(self):
+        # Paths are shared by views with the same edges and not reused once a view is changed
+        links_df = create_grid_links(6, seed=4)
+        routing_graph, path_cache = gtfs2ptnet.create_routing_graph(links_df), gtfs2ptnet.create_path_cache()
+        G = gtfs2ptnet.create_shp_graph(routing_graph, links_df, path_cache)
+        path = gtfs2ptnet.find_shortest_path(G, 1001, 1036)
+        G_same = gtfs2ptnet.create_shp_graph(routing_graph, links_df, path_cache)
+        self.assertEqual(gtfs2ptnet.find_shortest_path(G_same, 1001, 1036), path)
+        self.assertEqual((path_cache['hits'], path_cache['misses']), (1, 1))
+        gtfs2ptnet.add_shp_graph_edge(G_same, 1001, 1036, 1.0)
+        self.assertEqual(gtfs2ptnet.find_shortest_path(G_same, 1001, 1036), [1001, 1036])
+        gtfs2ptnet.remove_shp_graph_edge(G_same, 1001, 1036)
+        nx_G = create_netx(links_df)
+        self.assert_same_paths(G_same, nx_G, [1001, 1008, 1036])
+        self.assertEqual(gtfs2ptnet.find_shortest_path(G, 1001, 1036), path)
+        self.assertEqual(path_cache['hits'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
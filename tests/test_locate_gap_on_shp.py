@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Gap location on loop and out-and-back shapes.
+
+Usage:
+    python -m unittest discover tests
+"""
+
+import unittest
+import numpy as np
+import pandas as pd
+from shapely.geometry import LineString, Point
+import gtfs2ptnet
+
+class LocateGapOnShpTest(unittest.TestCase):
+    def test_loop_shape(self):
+        # Out along y=0 and back along y=60. The stops are on the outbound leg, but both are closer to a point of the return leg
+        shp_points_xy = gtfs2ptnet.densify_line(LineString([(0,0), (3000,0), (3000,60), (0,60)]))
+        source = pd.Series({'N':1, 'geometry':Point(100,40)})
+        target = pd.Series({'N':2, 'geometry':Point(1000,-10)})
+        shp_points_gap_df, shp_start, near_point_to_source, near_point_to_target = gtfs2ptnet.locate_gap_on_shp(shp_points_xy, 0, source, target)
+        self.assertEqual((near_point_to_source, near_point_to_target), (3, 33))
+        self.assertEqual(shp_start, 33)
+        self.assertEqual(shp_points_gap_df.N.to_list(), list(range(3, 34)))
+        self.assertTrue((shp_points_gap_df.Y == 0).all())
+
+    def test_shp_start(self):
+        # Points before shp_start are already used by the line
+        shp_points_xy = gtfs2ptnet.densify_line(LineString([(0,0), (3000,0), (3000,60), (0,60)]))
+        source = pd.Series({'N':1, 'geometry':Point(1000,-10)})
+        target = pd.Series({'N':2, 'geometry':Point(100,40)})
+        _, _, near_point_to_source, near_point_to_target = gtfs2ptnet.locate_gap_on_shp(shp_points_xy, 101, source, target)
+        self.assertTrue(np.allclose(shp_points_xy[near_point_to_source], (990,60)))
+        self.assertTrue(np.allclose(shp_points_xy[near_point_to_target], (90,60)))
+
+if __name__ == '__main__':
+    unittest.main()